@@ -0,0 +1,41 @@
+"""Общие утилиты для бенчмарков: импорт бота без побочных эффектов и перцентили."""
+
+import os
+import sys
+import tempfile
+import time
+import importlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def load_bot():
+    """Импортирует telegram_crm_bot с фиктивным токеном и одноразовой БД."""
+    os.environ.setdefault('BOT_TOKEN', '0:bench')
+    os.environ.setdefault('CRM_DB', os.path.join(tempfile.mkdtemp(prefix='crm-bench-'), 'crm.db'))
+    return importlib.import_module('telegram_crm_bot')
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, int(round(p / 100.0 * (len(s) - 1)))))
+    return s[k]
+
+
+def timed(fn, n: int):
+    """Вызывает fn(i) n раз, возвращает список длительностей в микросекундах."""
+    out = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        fn(i)
+        out.append((time.perf_counter() - t0) * 1e6)
+    return out
+
+
+def summary(name: str, samples_us) -> str:
+    return (f"{name:<34} n={len(samples_us):<6} p50={percentile(samples_us, 50):>9.1f}us "
+            f"p99={percentile(samples_us, 99):>9.1f}us")
@@ -0,0 +1,134 @@
+"""Архивация холодных данных: размер базы и горячие запросы до/после, сверка чтений.
+
+    python bench/bench_archive.py --years 4 --sessions 400000 --payments 100000
+
+База из bench/datagen.py с историей на --years лет назад. Снимаются размер
+main, время его бэкапа и горячих запросов (окно расписания тренера, свободные слоты,
+баланс клиента, ближайшие тренировки) и «эталон» чтений, которые должны
+видеть всё: история клиента, экспорт тренера, trainer_stats, балансы,
+check_ledger, окно расписания через границу архива, последние платежи. Затем проход archive_cold + VACUUM main — и всё повторяется;
+эталон обязан совпасть.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from _common import load_bot, timed, summary
+import datagen
+
+
+def snapshot(bot, conn, clients, trainers, now):
+    edge = bot.archive_cutoff(now)
+    history, exported = {}, {}
+    for cid in clients:
+        pages, pos = [], None
+        while True:
+            rows = bot.history_entries(conn, cid, True, pos)
+            pages += rows[:bot.HISTORY_PAGE]
+            if len(rows) <= bot.HISTORY_PAGE:
+                break
+            pos = rows[bot.HISTORY_PAGE - 1][:3]
+        history[cid] = pages
+    for tid in trainers:
+        for table in bot.EXPORT_TABLES:
+            exported[tid, table] = list(bot.export_rows(conn, tid, table, [0]))
+    return {
+        'history': history,
+        'export': exported,
+        'stats': conn.execute('SELECT * FROM trainer_stats ORDER BY 1, 2').fetchall(),
+        'active': conn.execute('SELECT * FROM stats_client_month ORDER BY 1, 2, 3').fetchall(),
+        'balances': conn.execute('SELECT id, balance FROM clients ORDER BY id').fetchall(),
+        'ledger': bot.check_ledger(conn),
+        # горячие чтения с границей архива: окно через cutoff и последние платежи
+        'schedule': {tid: bot.schedule_window(conn, tid, edge - timedelta(days=45), edge + timedelta(days=45))
+                     for tid in trainers},
+        'payments': {cid: bot.last_payments(conn, cid) for cid in clients},
+    }
+
+
+def hot(bot, conn, rnd, args, now):
+    def schedule(i):
+        bot.schedule_window(conn, rnd.randint(1, args.trainers), now, now + timedelta(days=7))
+
+    def slots(i):
+        bot.free_slots(conn, rnd.randint(1, args.trainers), now)
+
+    def balance(i):
+        bot.last_payments(conn, rnd.randint(1, args.clients))
+
+    def upcoming(i):
+        conn.execute('SELECT id, datetime, status, comment FROM sessions WHERE client_id = ? AND datetime BETWEEN ? AND ? '
+                     'ORDER BY datetime', (rnd.randint(1, args.clients), now.isoformat(),
+                                           (now + timedelta(days=60)).isoformat())).fetchall()
+
+    return [summary(name, timed(fn, args.n)) for name, fn in (
+        ('schedule week', schedule), ('free_slots', slots), ('balance + last payments', balance),
+        ('client upcoming 60d', upcoming))]
+
+
+def sizes(bot, conn, backup_dir):
+    """(МБ main, МБ архива, секунды бэкапа main)."""
+    t0 = time.perf_counter()
+    bot.backup_to(conn, backup_dir, 'bench', 0)
+    spent = time.perf_counter() - t0
+    main = os.path.getsize(bot.db.path) + (os.path.getsize(bot.db.path + '-wal') if os.path.exists(bot.db.path + '-wal') else 0)
+    return main / 1e6, os.path.getsize(bot.archive_path(bot.db.path)) / 1e6, spent
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--trainers', type=int, default=200)
+    ap.add_argument('--clients', type=int, default=20_000)
+    ap.add_argument('--sessions', type=int, default=400_000)
+    ap.add_argument('--payments', type=int, default=100_000)
+    ap.add_argument('--years', type=int, default=4)
+    ap.add_argument('--sample', type=int, default=50, help='клиентов/тренеров в сверке')
+    ap.add_argument('-n', type=int, default=500)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    conn = bot.db.writer_conn
+    backup_dir = tempfile.mkdtemp(prefix='crm-archive-bak-')
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    datagen.generate(conn, args.trainers, args.clients, args.sessions, args.payments,
+                     seed=2, now=now, days_back=365 * args.years)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    rnd = random.Random(6)
+    clients = rnd.sample(range(1, args.clients + 1), args.sample)
+    trainers = rnd.sample(range(1, args.trainers + 1), min(args.sample, args.trainers))
+
+    before = snapshot(bot, conn, clients, trainers, now)
+    hot(bot, conn, random.Random(8), args, now)
+    main_mb, arch_mb, backup_s = sizes(bot, conn, backup_dir)
+    print(f"before: main {main_mb:.1f} MB, archive {arch_mb:.1f} MB, backup of main {backup_s:.2f} s")
+    for line in hot(bot, conn, random.Random(7), args, now):
+        print('  ' + line)
+
+    t0 = time.perf_counter()
+    moved = asyncio.run(bot.archive_cold(now))
+    spent = time.perf_counter() - t0
+    conn.execute('VACUUM')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    left = {t: conn.execute(f'SELECT count(*) FROM main.{t}').fetchone()[0] for t in bot.ARCHIVE_TABLES}
+    print(f"archive_cold: moved {moved} in {spent:.1f} s (batch {bot.ARCHIVE_BATCH}); left in main {left}")
+
+    after = snapshot(bot, conn, clients, trainers, now)
+    hot(bot, conn, random.Random(8), args, now)  # VACUUM переписал файл — кэш страниц прогревается заново
+    main_mb, arch_mb, backup_s = sizes(bot, conn, backup_dir)
+    print(f"after:  main {main_mb:.1f} MB, archive {arch_mb:.1f} MB, backup of main {backup_s:.2f} s")
+    for line in hot(bot, conn, random.Random(7), args, now):
+        print('  ' + line)
+
+    for key in before:
+        assert before[key] == after[key], f"{key} differs after archiving"
+    print(f"reads unchanged: {', '.join(before)}")
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Экспорт тренера в CSV/zip: строк в секунду и пик памяти.
+
+    python bench/bench_export.py --sessions 1000000
+
+Все данные принадлежат одному тренеру. Первый прогон меряет скорость,
+второй — пик Python-аллокаций через tracemalloc (он же проверяет, что
+память не растёт с числом строк). --xlsx дополнительно гоняет XLSX, если
+установлен openpyxl.
+"""
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+from _common import load_bot
+import datagen
+
+
+def run(fn, conn, tid, path):
+    t0 = time.perf_counter()
+    rows = fn(conn, tid, path)
+    return rows, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--clients', type=int, default=20_000)
+    ap.add_argument('--sessions', type=int, default=1_000_000)
+    ap.add_argument('--payments', type=int, default=200_000)
+    ap.add_argument('--xlsx', action='store_true')
+    args = ap.parse_args()
+
+    bot = load_bot()
+    conn = bot.db.writer_conn
+    t0 = time.perf_counter()
+    datagen.generate(conn, 1, args.clients, args.sessions, args.payments)
+    print(f"data: {args.clients} clients / {args.sessions} sessions / {args.payments} payments "
+          f"in {time.perf_counter() - t0:.1f}s")
+    for table, (_, sql) in bot.EXPORT_TABLES.items():
+        for schema in ('main', 'archive') if table in bot.ARCHIVE_TABLES else ('main',):
+            plan = ' | '.join(r[3] for r in conn.execute('EXPLAIN QUERY PLAN ' + sql.format(schema), (1,)))
+            print(f"  {table}@{schema}: {plan}")
+
+    out = tempfile.mkdtemp(prefix='crm-export-')
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    formats = [('csv.zip', bot.export_csv_zip)]
+    if args.xlsx and bot.openpyxl is not None:
+        formats.append(('xlsx', bot.export_xlsx))
+    for label, fn in formats:
+        path = os.path.join(out, f"export.{label}")
+        rows, dt = run(fn, conn, 1, path)
+        size = os.path.getsize(path)
+        print(f"{label:<8} rows={rows} time={dt:.2f}s rows/s={rows / dt:,.0f} file={size / 2**20:.1f}MB")
+        tracemalloc.start()
+        run(fn, conn, 1, path)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{'':<8} python peak alloc={peak / 2**20:.2f}MB")
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"max RSS growth during export: {(rss1 - rss0) / 1024:.1f}MB")
+    with zipfile.ZipFile(os.path.join(out, 'export.csv.zip')) as zf:
+        print('zip members:', [(i.filename, i.file_size) for i in zf.infolist()])
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    main()
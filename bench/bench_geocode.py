@@ -0,0 +1,68 @@
+"""Шаг выбора города против локального стаба Nominatim.
+
+    python bench/bench_geocode.py --delay 0.08
+
+Поднимает aiohttp-стаб на 127.0.0.1, гоняет через Geocoder смесь
+запросов (локальные совпадения, повторы, одновременные одинаковые,
+новые удалённые) и печатает счётчики и p50/p99 шага.
+"""
+
+import argparse
+import asyncio
+import json
+
+from aiohttp import web
+
+from _common import load_bot
+
+
+async def start_stub(delay: float):
+    calls = []
+
+    async def search(request):
+        q = request.query['q']
+        calls.append(q)
+        await asyncio.sleep(delay)
+        body = [{'address': {'town': f"{q.capitalize()}-{i}"}, 'display_name': q} for i in range(3)]
+        return web.Response(text=json.dumps(body, ensure_ascii=False), content_type='application/json')
+
+    app = web.Application()
+    app.router.add_get('/search', search)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/search", calls
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--delay', type=float, default=0.08, help='задержка стаба, с')
+    ap.add_argument('--remote', type=int, default=5, help='сколько разных удалённых запросов')
+    args = ap.parse_args()
+
+    bot = load_bot()
+    runner, url, calls = await start_stub(args.delay)
+    geo = bot.Geocoder(url=url)
+
+    # 1) локальные совпадения — без сети
+    await asyncio.gather(*(geo.search(q) for q in ['Казань', 'Санкт', 'Екате', 'ростов'] * 25))
+    # 2) 50 одновременных одинаковых запросов — один HTTP-вызов
+    await asyncio.gather(*(geo.search('Малиновка') for _ in range(50)))
+    # 3) разные удалённые запросы — упираются в 1 req/s
+    await asyncio.gather(*(geo.search(f"Посёлок{i}") for i in range(args.remote)))
+    # 4) повторы — из кэша в SQLite
+    for i in range(args.remote):
+        await geo.search(f"Посёлок{i}")
+
+    s = geo.stats.snapshot()
+    print(f"searches={s['count']} http_calls={len(calls)} counters={geo.counters}")
+    print(f"city step latency: p50={s['p50']:.2f}ms p99={s['p99']:.2f}ms")
+    await geo.close()
+    await runner.cleanup()
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
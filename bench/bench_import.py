@@ -0,0 +1,79 @@
+"""Импорт клиентов из CSV: время на 50k строк.
+
+    python bench/bench_import.py --rows 50000
+
+Файл в духе выгрузки из Excel: «;», cp1251, заголовок по-русски, телефоны
+в разных форматах, ~3% битых строк и ~5% повторов. Второй прогон того же
+файла должен целиком уйти в дубли. «loop lag» — самая долгая задержка
+тикера на event loop во время импорта: разбор идёт в потоке-писателе, и
+остальные чаты не должны его ждать.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from _common import load_bot
+import datagen
+
+
+def make_csv(rows: int, seed: int = 2) -> bytes:
+    rnd = random.Random(seed)
+    formats = ['+7 ({a}) {b}-{c}-{d}', '8{a}{b}{c}{d}', '{a}{b}{c}{d}', '+7{a}{b}{c}{d}', '8 {a} {b} {c} {d}']
+    lines = ['Имя;Телефон;Заметка']
+    phones = []
+    for i in range(rows):
+        r = rnd.random()
+        if r < 0.05 and phones:
+            phone = rnd.choice(phones)  # повтор
+        elif r < 0.08:
+            phone = rnd.choice(['не помню', '123', '+7916abc'])
+        else:
+            a, b, c, d = f"9{rnd.randrange(100):02d}", f"{rnd.randrange(1000):03d}", f"{rnd.randrange(100):02d}", f"{rnd.randrange(100):02d}"
+            phone = rnd.choice(formats).format(a=a, b=b, c=c, d=d)
+            phones.append(phone)
+        name = f"{rnd.choice(datagen.FIRST)} {rnd.choice(datagen.LAST)}"
+        lines.append(f"{name};{phone};{'утро' if i % 3 else ''}")
+    return '\r\n'.join(lines).encode('cp1251')
+
+
+async def loop_lag(stop: asyncio.Event, tick: float = 0.005) -> float:
+    """Максимальное опоздание asyncio.sleep(tick), мс."""
+    worst = 0.0
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(tick)
+        worst = max(worst, (time.perf_counter() - t0 - tick) * 1000)
+    return worst
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--rows', type=int, default=50_000)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    bot.db.writer_conn.execute("INSERT INTO trainers (id, chat_id, name) VALUES (1, 1, 'Тренер')")
+    bot.db.writer_conn.commit()
+    data = make_csv(args.rows)
+    print(f"CSV: {args.rows} rows, {len(data) / 2**20:.1f}MB")
+    for label in ('first import', 'same file again'):
+        stop = asyncio.Event()
+        lag = asyncio.create_task(loop_lag(stop))
+        t0 = time.perf_counter()
+        report = await bot.import_clients(1, data)
+        dt = time.perf_counter() - t0
+        stop.set()
+        print(f"{label:<16} {dt:.2f}s ({args.rows / dt:,.0f} rows/s): inserted={report['inserted']} "
+              f"duplicates={report['duplicates']} errors={len(report['errors'])} e.g. {report['errors'][:2]}; "
+              f"loop lag max {await lag:.1f} ms")
+    n = bot.db.writer_conn.execute('SELECT count(*) FROM clients WHERE trainer_id = 1').fetchone()[0]
+    sample = bot.db.writer_conn.execute('SELECT name, phone FROM clients WHERE trainer_id = 1 LIMIT 3').fetchall()
+    print(f"clients of trainer: {n}; sample: {sample}")
+    print('FTS by phone:', await bot.search_clients(1, '8' + sample[0][1][2:9]))
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""Латентность горячих выборок до и после миграции с индексами.
+
+    python bench/bench_indexes.py --clients 100000 --sessions 1000000
+
+Строит БД на схеме версии 1 (без индексов), меряет запросы, затем
+догоняет миграции до последней версии и меряет их снова.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from _common import load_bot, timed, summary
+import datagen
+
+
+def queries(trainers: int, clients: int, now: datetime):
+    rnd = random.Random(7)
+    cities = ['Москва', 'Казань', 'Сочи', 'Тула']
+    in24 = now + timedelta(hours=24)
+    return [
+        ('get_client_by_chat',
+         'SELECT id, name, phone, trainer_id, status, balance, tg_id, username FROM clients WHERE chat_id = ?',
+         lambda: (datagen.CLIENT_CHAT_BASE + rnd.randint(1, clients),)),
+        ('get_role (client miss on trainers)',
+         'SELECT id FROM clients WHERE chat_id = ?',
+         lambda: (datagen.CLIENT_CHAT_BASE + rnd.randint(1, clients),)),
+        ('trainers by city',
+         'SELECT id, name FROM trainers WHERE city = ? ORDER BY id LIMIT 11',
+         lambda: (rnd.choice(cities),)),
+        ('clients of trainer',
+         'SELECT id, name FROM clients WHERE trainer_id = ? AND status = ? ORDER BY id LIMIT 11',
+         lambda: (rnd.randint(1, trainers), 'approved')),
+        ('invite_code lookup',
+         'SELECT id, chat_id, name FROM trainers WHERE invite_code = ?',
+         lambda: (f"{rnd.randint(1, trainers):08X}",)),
+        ('my_sessions (60d window)',
+         'SELECT id, datetime, status, comment FROM sessions WHERE client_id = ? AND datetime BETWEEN ? AND ? ORDER BY datetime',
+         lambda: (rnd.randint(1, clients), now.isoformat(), (now + timedelta(days=60)).isoformat())),
+        ('reminder 24h scan',
+         "SELECT s.id FROM sessions s JOIN clients c ON s.client_id = c.id "
+         "WHERE s.remind24_sent = 0 AND s.status = 'planned' AND s.datetime BETWEEN ? AND ?",
+         lambda: (in24.isoformat(), (in24 + timedelta(minutes=1)).isoformat())),
+        ('last payments of client',
+         'SELECT amount, date, note FROM payments WHERE client_id = ? ORDER BY date DESC LIMIT 5',
+         lambda: (rnd.randint(1, clients),)),
+    ]
+
+
+def measure(conn, qs, n):
+    for name, sql, params in qs:
+        samples = timed(lambda i: conn.execute(sql, params()).fetchall(), n)
+        print(summary(name, samples))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--trainers', type=int, default=2000)
+    ap.add_argument('--clients', type=int, default=100_000)
+    ap.add_argument('--sessions', type=int, default=1_000_000)
+    ap.add_argument('--payments', type=int, default=300_000)
+    ap.add_argument('-n', type=int, default=50, help='запросов на каждый тип')
+    args = ap.parse_args()
+
+    bot = load_bot()
+    path = os.path.join(tempfile.mkdtemp(prefix='crm-idx-'), 'crm.db')
+    conn = sqlite3.connect(path)
+    bot.migrate(conn, target=1)
+    now = datetime.utcnow()
+    t0 = time.perf_counter()
+    datagen.generate(conn, args.trainers, args.clients, args.sessions, args.payments, now=now)
+    print(f"data: {args.clients} clients / {args.sessions} sessions in {time.perf_counter() - t0:.1f}s ({path})")
+
+    qs = queries(args.trainers, args.clients, now)
+    print('\n-- schema v1 (без индексов) --')
+    measure(conn, qs, args.n)
+
+    t0 = time.perf_counter()
+    version = bot.migrate(conn)
+    print(f"\nmigrated to v{version} in {time.perf_counter() - t0:.1f}s")
+    conn.execute('ANALYZE')
+    print('-- с индексами --')
+    measure(conn, qs, args.n)
+
+
+if __name__ == '__main__':
+    main()
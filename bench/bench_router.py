@@ -0,0 +1,112 @@
+"""Стоимость диспетчеризации callback_query: цепочка lambda-фильтров против CallbackRouter.
+
+    python bench/bench_router.py -n 20000
+
+Два Dispatcher с одинаковым набором префиксов и пустыми обработчиками:
+в первом каждый префикс — отдельный callback_query_handler с lambda-фильтром
+(как было), во втором — один обработчик и словарь маршрутов. Меряется
+dp.process_update на CallbackQuery-апдейтах вплоть до вызова обработчика.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime
+
+from _common import load_bot, percentile
+
+# префиксы бота в порядке регистрации; у последних в цепочке худший случай
+PREFIXES = [
+    'pick_city', 'trainers_page', 'search_trainers', 'pick_trainer', 'leave_trainer', 'myclients_page',
+    'search_clients', 'req_page', 'approve', 'reject', 'tprof_city', 'tprof_pricing', 'tariff:add',
+    'tariff:delete', 'client', 'delete_client', 'cancel_del_client', 'confirm_del_client', 'add_session',
+    'slot', 'slot_manual', 'add_payment', 'done_session', 'history', 'edit_client', 'link_client',
+    'export', 'stats', 'cal', 'series',
+]
+# кнопки без полей — сравнение всей строки
+EXACT = {'search_trainers', 'search_clients', 'tprof_city', 'tprof_pricing', 'tariff:add', 'tariff:delete',
+         'cancel_del_client', 'slot_manual'}
+
+
+def update(i: int, data: str) -> dict:
+    user = {'id': 1000 + i % 50, 'is_bot': False, 'first_name': 'u'}
+    return {'update_id': i, 'callback_query': {
+        'id': str(i), 'from': user, 'chat_instance': 'x', 'data': data,
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': user['id'], 'type': 'private'}, 'text': '.'},
+    }}
+
+
+def payloads(bot, n: int):
+    rnd = random.Random(5)
+    when = datetime(2024, 5, 1, 18, 0)
+    samples = {
+        'slot': lambda: bot.cb('slot', rnd.randint(1, 10**6), when, fields=(bot.CB_INT, bot.CB_DT)),
+        'trainers_page': lambda: bot.cb('trainers_page', 'n', rnd.randint(1, 10**6), 'Москва'),
+        'pick_city': lambda: bot.cb('pick_city', 'Санкт-Петербург'),
+    }
+    out = []
+    for _ in range(n):
+        p = rnd.choice(PREFIXES)
+        out.append(samples[p]() if p in samples else p if p in EXACT else f"{p}:{rnd.randint(1, 10**6)}")
+    return out
+
+
+def chain_dispatcher(bot, hits):
+    dp = bot.Dispatcher(bot.bot, storage=bot.MemoryStorage())
+    for p in PREFIXES:
+        async def handler(call, _p=p):
+            # прежний стиль: разбор payload внутри обработчика
+            hits.append(call.data.split(':'))
+        flt = (lambda c, _p=p: c.data == _p) if p in EXACT else (lambda c, _p=p + ':': c.data.startswith(_p))
+        dp.register_callback_query_handler(handler, flt)
+    return dp
+
+
+def router_dispatcher(bot, hits):
+    dp = bot.Dispatcher(bot.bot, storage=bot.MemoryStorage())
+    router = bot.CallbackRouter()
+    fields = {'slot': (bot.CB_INT, bot.CB_DT), 'trainers_page': (bot.CB_STR, bot.CB_INT, bot.CB_STR),
+              'pick_city': (bot.CB_STR,)}
+    for p in PREFIXES:
+        f = fields.get(p, () if p in EXACT else (bot.CB_INT,))
+
+        async def handler(call, *args):
+            hits.append(args)
+        router.route(p, *f)(handler)
+
+    async def route_callback(call, state):
+        await router.dispatch(call, state)
+    dp.register_callback_query_handler(route_callback, state='*')
+    return dp
+
+
+async def measure(dp, updates):
+    types = load_bot().types
+    out = []
+    for u in updates:
+        upd = types.Update(**u)
+        t0 = time.perf_counter()
+        await dp.process_update(upd)
+        out.append((time.perf_counter() - t0) * 1e6)
+    return out
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('-n', type=int, default=20000)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    updates = [update(i, d) for i, d in enumerate(payloads(bot, args.n))]
+    for label, build in (('lambda filter chain', chain_dispatcher), ('CallbackRouter', router_dispatcher)):
+        hits = []
+        dp = build(bot, hits)
+        samples = await measure(dp, updates)
+        print(f"{label:<20} n={len(samples)} handled={len(hits)} mean={sum(samples) / len(samples):>7.1f}us "
+              f"p50={percentile(samples, 50):>7.1f}us p99={percentile(samples, 99):>7.1f}us")
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+"""Расписание загруженного тренера: список на 30 дней против окна недели/дня.
+
+    python bench/bench_schedule.py --per-day 14 --history 50000
+
+У тренера --per-day тренировок в день на ближайшие 60 дней и --history
+проведённых в прошлом. «list» — прежний вывод: всё за 30 дней через JOIN
+clients, одна кнопка на тренировку, обрезка до 50. «week»/«day» —
+build_schedule. Кроме времени печатается размер ответа (текст + клавиатура
+в JSON) и сколько тренировок окна не попало на экран.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+from _common import load_bot, timed, summary
+
+
+def build(bot, per_day: int, history: int, now: datetime, clients: int = 300):
+    conn = sqlite3.connect(bot.DB_FILE)
+    rnd = random.Random(5)
+    conn.execute("INSERT INTO trainers (id, chat_id, name) VALUES (1, 1, 'Busy')")
+    conn.executemany("INSERT INTO clients (id, name, trainer_id, status) VALUES (?, ?, 1, 'approved')",
+                     [(i, f"Клиент {i}") for i in range(1, clients + 1)])
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    rows = [(today + timedelta(days=d, hours=8, minutes=45 * k), 'planned')
+            for d in range(60) for k in range(per_day)]
+    rows += [(today - timedelta(days=1 + i // per_day, hours=-8, minutes=-45 * (i % per_day)), 'completed')
+             for i in range(history)]
+    conn.executemany("INSERT INTO sessions (client_id, datetime, status) VALUES (?, ?, ?)",
+                     [(rnd.randint(1, clients), dt.isoformat(), st) for dt, st in rows])
+    conn.commit()
+    conn.close()
+
+
+def legacy_list(bot, conn, now: datetime):
+    rows = conn.execute('''SELECT s.id, s.client_id, s.datetime, s.status, c.name
+                   FROM sessions s LEFT JOIN clients c ON s.client_id=c.id
+                   WHERE c.trainer_id = ? AND s.datetime BETWEEN ? AND ? AND s.status <> 'cancelled'
+                   ORDER BY s.datetime''', (1, now.isoformat(), (now + timedelta(days=30)).isoformat())).fetchall()
+    kb = bot.InlineKeyboardMarkup(row_width=1)
+    for sid, _, dt_iso, status, cname in rows[:50]:
+        label = f"{sid}: {datetime.fromisoformat(dt_iso).strftime('%d.%m %H:%M')} — {cname} — {status}"
+        kb.add(bot.InlineKeyboardButton(f"✅ Завершить {label}", callback_data=bot.cb('done_session', sid)))
+    return 'Ваше расписание (30 дней):', kb, len(rows)
+
+
+def payload(text: str, kb) -> int:
+    return len(text.encode()) + len(json.dumps(kb.to_python(), ensure_ascii=False).encode())
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--per-day', type=int, default=14)
+    ap.add_argument('--history', type=int, default=50_000)
+    ap.add_argument('-n', type=int, default=300)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    build(bot, args.per_day, args.history, now)
+    conn = sqlite3.connect(bot.DB_FILE)
+    loop = asyncio.new_event_loop()
+    week, day = bot.schedule_start('w', now), bot.schedule_start('d', now)
+
+    text, kb, total = legacy_list(bot, conn, now)
+    print(f"list: {total} sessions in 30 days, {min(total, 50)} shown, payload {payload(text, kb)} bytes")
+    for view, start in (('w', week), ('d', day)):
+        text, kb = loop.run_until_complete(bot.build_schedule(1, view, start))
+        buttons = sum(len(r) for r in kb.inline_keyboard)
+        print(f"{view}: {len(text.splitlines())} lines, {buttons} buttons, payload {payload(text, kb)} bytes")
+
+    print(summary('list 30d (join clients)', timed(lambda i: legacy_list(bot, conn, now), args.n)))
+    print(summary('week view', timed(
+        lambda i: loop.run_until_complete(bot.build_schedule(1, 'w', week + timedelta(days=7 * (i % 4)))), args.n)))
+    print(summary('day view', timed(
+        lambda i: loop.run_until_complete(bot.build_schedule(1, 'd', day + timedelta(days=i % 30))), args.n)))
+    loop.close()
+    conn.close()
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Поиск тренеров: прежний LIKE '%q%' против FTS5-индекса.
+
+    python bench/bench_search.py --rows 100000
+
+Обе выборки идут через bot.db (поток-читатель), как в обработчике.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault('CRM_DB', os.path.join(tempfile.mkdtemp(prefix='crm-fts-'), 'crm.db'))
+
+from _common import load_bot, percentile
+
+SYL = ['ка', 'ро', 'ми', 'ла', 'ве', 'то', 'ну', 'ше', 'дар', 'ков', 'лин', 'ёв', 'сен', 'гор', 'пав', 'ти']
+
+
+def word(rnd, n):
+    return ''.join(rnd.choice(SYL) for _ in range(n)).capitalize()
+
+
+async def measure(fn, queries):
+    out = []
+    for q in queries:
+        t0 = time.perf_counter()
+        await fn(q)
+        out.append((time.perf_counter() - t0) * 1e6)
+    return out
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--rows', type=int, default=100_000)
+    ap.add_argument('-n', type=int, default=200)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    rnd = random.Random(3)
+    cities = [c for c in bot.CITIES if c != 'Другой']
+    t0 = time.perf_counter()
+    bot.db.writer_conn.executemany(
+        'INSERT INTO trainers (chat_id, name, city, username) VALUES (?, ?, ?, ?)',
+        ((i, f"{word(rnd, 2)} {word(rnd, 3)}", rnd.choice(cities), f"coach{i}") for i in range(1, args.rows + 1)))
+    bot.db.writer_conn.commit()
+    print(f"{args.rows} trainers indexed in {time.perf_counter() - t0:.1f}s")
+
+    # запросы: префиксы реальных имён (частые и редкие) + заведомые промахи
+    names = [r[0] for r in bot.db.writer_conn.execute('SELECT name FROM trainers ORDER BY random() LIMIT ?', (args.n,))]
+    queries = []
+    for i, name in enumerate(names):
+        first, last = name.split()
+        queries.append([first[:3], last[:5], name, 'Щщщ'][i % 4])
+
+    async def like(q):
+        return await bot.db.fetchall('SELECT id, name FROM trainers WHERE name LIKE ? ORDER BY id LIMIT 30', (f"%{q}%",))
+
+    for label, fn in (('LIKE %q%', like), ('FTS5 prefix + bm25', bot.search_trainers)):
+        samples = await measure(fn, queries)
+        print(f"{label:<20} n={len(samples)} p50={percentile(samples, 50):>9.1f}us "
+              f"p99={percentile(samples, 99):>9.1f}us")
+    # регистр кириллицы: LIKE без ICU его не учитывает
+    q = names[0].split()[1][:4]
+    print(f"case check '{q.upper()}': LIKE={len(await like(q.upper()))} FTS={len(await bot.search_trainers(q.upper()))}")
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+"""Окна расписания при сериях: ленивое разворачивание против материализованных строк.
+
+    python bench/bench_series.py --trainers 50 --series 20 --years 3
+
+У каждого тренера --series серий «два раза в неделю», идущих уже --years лет.
+Вариант «rows»: каждое повторение — строка sessions (как при ручном вводе);
+вариант «lazy»: в sessions только прошлое, будущее разворачивается из series.
+Меряются окна trainer_schedule (30 дней) и my_sessions (60 дней).
+"""
+
+import argparse
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+from _common import load_bot, timed, summary
+
+DAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA']
+
+
+def build(bot, trainers: int, per_trainer: int, years: int, now: datetime, lazy: bool):
+    conn = sqlite3.connect(':memory:')
+    bot.migrate(conn)
+    rnd = random.Random(4)
+    conn.executemany("INSERT INTO trainers (id, chat_id, name) VALUES (?, ?, ?)",
+                     [(t, t, f"t{t}") for t in range(1, trainers + 1)])
+    start, end = now - timedelta(days=365 * years), now + timedelta(days=365)
+    series, sessions, cid = [], [], 0
+    for t in range(1, trainers + 1):
+        for _ in range(per_trainer):
+            cid += 1
+            a, b = rnd.sample(DAYS, 2)
+            rule = f"FREQ=WEEKLY;BYDAY={a},{b}"
+            dtstart = start.replace(hour=rnd.randint(9, 20), minute=0, second=0, microsecond=0)
+            series.append((cid, t, rule, dtstart.isoformat()))
+            for when in bot.expand_series(rule, dtstart, start, now if lazy else end):
+                sessions.append((cid, t, when.isoformat(), 'completed' if when < now else 'planned'))
+    conn.executemany("INSERT INTO clients (id, name, trainer_id, status) VALUES (?, ?, ?, 'approved')",
+                     [(c, f"c{c}", (c - 1) // per_trainer + 1) for c in range(1, cid + 1)])
+    conn.executemany("INSERT INTO sessions (client_id, trainer_id, datetime, status) VALUES (?, ?, ?, ?)", sessions)
+    if lazy:
+        conn.executemany("INSERT INTO series (client_id, trainer_id, rule, dtstart, duration) VALUES (?, ?, ?, ?, 60)",
+                         series)
+    conn.commit()
+    return conn, len(sessions), cid
+
+
+def schedule(bot, conn, tid, now, lazy):
+    rows = conn.execute('''SELECT s.id, s.client_id, s.datetime, s.status, c.name
+                   FROM sessions s LEFT JOIN clients c ON s.client_id=c.id
+                   WHERE c.trainer_id = ? AND s.datetime BETWEEN ? AND ? AND s.status <> 'cancelled'
+                   ORDER BY s.datetime''', (tid, now.isoformat(), (now + timedelta(days=30)).isoformat())).fetchall()
+    if lazy:
+        rows += bot.series_occurrences(conn, now, now + timedelta(days=30), trainer_id=tid)
+    return rows
+
+
+def client_window(bot, conn, cid, now, lazy):
+    end = now + timedelta(days=60)
+    rows = conn.execute('SELECT id, datetime, status, comment FROM sessions WHERE client_id = ? AND datetime BETWEEN ? AND ? '
+                        'ORDER BY datetime', (cid, now.isoformat(), end.isoformat())).fetchall()
+    if lazy:
+        rows += bot.series_occurrences(conn, now, end, client_id=cid)
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--trainers', type=int, default=50)
+    ap.add_argument('--series', type=int, default=20, help='серий на тренера')
+    ap.add_argument('--years', type=int, default=3)
+    ap.add_argument('-n', type=int, default=500)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    rnd = random.Random(8)
+    for lazy in (False, True):
+        conn, rows, clients = build(bot, args.trainers, args.series, args.years, now, lazy)
+        label = 'lazy' if lazy else 'rows'
+        print(f"[{label}] sessions rows={rows}")
+        counts = {len(schedule(bot, conn, t, now, lazy)) for t in range(1, 4)}
+        print(summary(f"{label}: schedule 30d (~{max(counts)} items)",
+                      timed(lambda i: schedule(bot, conn, rnd.randint(1, args.trainers), now, lazy), args.n)))
+        print(summary(f"{label}: my_sessions 60d",
+                      timed(lambda i: client_window(bot, conn, rnd.randint(1, clients), now, lazy), args.n)))
+        conn.close()
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    main()
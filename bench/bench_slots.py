@@ -0,0 +1,98 @@
+"""Свободные слоты и проверка пересечений на загруженном календаре тренера.
+
+    python bench/bench_slots.py --sessions 50000 --busy 0.9
+
+У одного тренера --sessions тренировок: история на годы назад и ближайшие
+60 дней, занятые на долю --busy рабочих слотов. Меряется free_slots и
+find_conflict (диапазон по idx_sessions_trainer_dt) против наивного варианта:
+все тренировки тренера через JOIN clients и перебор в Python. Результаты
+обоих вариантов сверяются.
+"""
+
+import argparse
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+from _common import load_bot, timed, summary
+
+
+def build(bot, conn, sessions: int, busy: float, now: datetime, clients: int = 200):
+    rnd = random.Random(3)
+    conn.execute("INSERT INTO trainers (id, chat_id, name, work_start, work_end, session_minutes) "
+                 "VALUES (1, 1, 'Busy', 540, 1260, 60)")
+    conn.executemany("INSERT INTO clients (id, name, trainer_id, status) VALUES (?, ?, 1, 'approved')",
+                     [(i, f"c{i}") for i in range(1, clients + 1)])
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    rows = []
+    # ближайшие 60 дней: каждый рабочий час занят с вероятностью busy
+    for d in range(60):
+        for h in range(9, 21):
+            if rnd.random() < busy:
+                rows.append(today + timedelta(days=d, hours=h))
+    # остальное — прошлое, по 12 в день назад от сегодня
+    d = 1
+    while len(rows) < sessions:
+        for h in range(9, 21):
+            rows.append(today - timedelta(days=d, hours=-h))
+        d += 1
+    conn.executemany("INSERT INTO sessions (client_id, datetime, status, duration) VALUES (?, ?, ?, 60)",
+                     [(rnd.randint(1, clients), dt.isoformat(), 'completed' if dt < now else 'planned')
+                      for dt in rows[:sessions]])
+    conn.commit()
+
+
+def naive_free_slots(bot, conn, tid: int, after: datetime, count: int = 6):
+    """Как без индекса по тренеру: все его тренировки через clients, затем перебор сетки."""
+    work_start, work_end, minutes = bot.trainer_booking(conn, tid)
+    busy = sorted((datetime.fromisoformat(dt), datetime.fromisoformat(dt) + timedelta(minutes=dur))
+                  for dt, dur in conn.execute(
+                      "SELECT s.datetime, s.duration FROM sessions s JOIN clients c ON c.id = s.client_id "
+                      "WHERE c.trainer_id = ? AND s.status <> 'cancelled'", (tid,)))
+    length = timedelta(minutes=minutes)
+    t, out = bot._ceil_step(after, bot.SLOT_STEP), []
+    while len(out) < count and t < after + bot.SLOT_HORIZON:
+        day = t.replace(hour=0, minute=0)
+        if day + timedelta(minutes=work_start) <= t and t + length <= day + timedelta(minutes=work_end) \
+                and not any(s < t + length and e > t for s, e in busy):
+            out.append(t)
+            t += length
+        else:
+            t += timedelta(minutes=bot.SLOT_STEP)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--sessions', type=int, default=50_000)
+    ap.add_argument('--busy', type=float, default=0.9)
+    ap.add_argument('-n', type=int, default=200)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    conn = sqlite3.connect(':memory:')
+    bot.migrate(conn)
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    build(bot, conn, args.sessions, args.busy, now)
+
+    rnd = random.Random(9)
+    fast = bot.free_slots(conn, 1, now)
+    slow = naive_free_slots(bot, conn, 1, now)
+    assert fast == slow, (fast, slow)
+    print(f"trainer sessions={args.sessions} busy={args.busy:.0%}; next slots: "
+          + ', '.join(f"{s:%d.%m %H:%M}" for s in fast))
+
+    def at(i):
+        return now + timedelta(days=rnd.randrange(60), minutes=30 * rnd.randrange(48))
+
+    print(summary('free_slots (indexed windows)', timed(lambda i: bot.free_slots(conn, 1, now), args.n)))
+    print(summary('free_slots (naive full scan)', timed(lambda i: naive_free_slots(bot, conn, 1, now), max(1, args.n // 20))))
+    print(summary('find_conflict (index range)', timed(lambda i: bot.find_conflict(conn, 1, at(i), 60), args.n * 10)))
+    print(summary('book_session (check + insert)', timed(
+        lambda i: bot.book_session(conn, 1, 1, at(i) + timedelta(days=400), ''), args.n)))
+    conn.rollback()
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    main()
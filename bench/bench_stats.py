@@ -0,0 +1,76 @@
+"""Кнопка «📈 Статистика»: чтение агрегатов против прямого подсчёта по истории.
+
+    python bench/bench_stats.py --years 5 --sessions 1000000
+
+Данные пишутся через триггеры (как в работе бота), затем меряется
+trainer_stats_text для самых нагруженных тренеров и тот же отчёт, посчитанный
+GROUP BY по sessions/payments. В конце агрегаты сверяются с rebuild_stats.
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from _common import load_bot, timed, summary
+import datagen
+
+NAIVE = [
+    '''SELECT date(s.datetime, '-6 days', 'weekday 1'), count(*), sum(s.status = 'completed')
+       FROM sessions s JOIN clients c ON c.id = s.client_id
+       WHERE c.trainer_id = ? AND s.datetime >= ? GROUP BY 1''',
+    '''SELECT substr(s.datetime, 1, 7), count(*), sum(s.status = 'completed'), count(DISTINCT s.client_id)
+       FROM sessions s JOIN clients c ON c.id = s.client_id
+       WHERE c.trainer_id = ? AND s.datetime >= ? GROUP BY 1''',
+    '''SELECT substr(p.date, 1, 7), sum(p.amount) FROM payments p JOIN clients c ON c.id = p.client_id
+       WHERE c.trainer_id = ? AND p.date >= ? GROUP BY 1''',
+]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--years', type=int, default=5)
+    ap.add_argument('--trainers', type=int, default=20)
+    ap.add_argument('--clients', type=int, default=2000)
+    ap.add_argument('--sessions', type=int, default=1_000_000)
+    ap.add_argument('--payments', type=int, default=200_000)
+    ap.add_argument('-n', type=int, default=200)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    conn = bot.db.writer_conn
+    now = datetime.utcnow()
+    t0 = time.perf_counter()
+    datagen.generate(conn, args.trainers, args.clients, args.sessions, args.payments, now=now,
+                     days_back=args.years * 365, days_ahead=30)
+    print(f"{args.sessions} sessions / {args.years}y through triggers in {time.perf_counter() - t0:.1f}s")
+    conn.execute('ANALYZE')
+    conn.commit()
+
+    heavy = [r[0] for r in conn.execute(
+        'SELECT c.trainer_id FROM sessions s JOIN clients c ON c.id = s.client_id GROUP BY 1 ORDER BY count(*) DESC LIMIT 5')]
+    n_heavy = conn.execute('SELECT count(*) FROM sessions s JOIN clients c ON c.id = s.client_id WHERE c.trainer_id = ?',
+                           (heavy[0],)).fetchone()[0]
+    print(f"heaviest trainer: {n_heavy} sessions")
+    rnd = random.Random(1)
+    since = (now - timedelta(days=220)).isoformat()
+
+    print(summary('aggregates (trainer_stats_text)',
+                  timed(lambda i: bot.trainer_stats_text(conn, rnd.choice(heavy), now), args.n)))
+    print(summary('naive GROUP BY over history',
+                  timed(lambda i: [conn.execute(q, (rnd.choice(heavy), since)).fetchall() for q in NAIVE],
+                        max(5, args.n // 20))))
+
+    before = conn.execute('SELECT * FROM trainer_stats ORDER BY 1, 2').fetchall()
+    before_active = conn.execute('SELECT count(*) FROM stats_client_month').fetchone()[0]
+    bot.rebuild_stats(conn)
+    after = conn.execute('SELECT * FROM trainer_stats ORDER BY 1, 2').fetchall()
+    drift = sum(1 for a, b in zip(before, after) if a[:4] != b[:4] or abs(a[4] - b[4]) > 0.005)
+    print(f"triggers vs rebuild: {len(before)} rows, drift={drift + abs(len(before) - len(after))}, "
+          f"client-months {before_active} vs {conn.execute('SELECT count(*) FROM stats_client_month').fetchone()[0]}")
+    print(bot.trainer_stats_text(conn, heavy[0], now))
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Пропускная способность записи: журнал отката по умолчанию против WAL с прагмами.
+
+    python bench/bench_storage.py --writes 3000 --readers 4 --sessions 200000
+
+Для каждого режима — своя база из bench/datagen.py и свой Database: «before»
+открывается без прагм (DELETE-журнал, synchronous=FULL), «after» — с DB_PRAGMAS.
+Нагрузка как у бота: --writes коротких транзакций (платёж: INSERT + триггеры
+баланса и журнала) через поток-писатель, параллельно --readers корутин читают
+тренировки клиентов. Посередине снимается онлайн-бэкап backup_to — видно,
+ждут ли его писатели.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from _common import load_bot, percentile
+import datagen
+
+
+async def workload(bot, db, args, backup_dir):
+    rnd = random.Random(args.seed)
+    writes, reads, during_backup = [], [], []
+    backup = {'running': False}
+    done = asyncio.Event()
+
+    async def writer(n):
+        for i in range(n):
+            cid = rnd.randint(1, args.clients)
+            t0 = time.perf_counter()
+            await db.execute('INSERT INTO payments (client_id, amount, date, note) VALUES (?, ?, ?, ?)',
+                             (cid, 100.0, f"2026-01-01T00:00:{i % 60:02d}", 'bench'))
+            ms = (time.perf_counter() - t0) * 1000
+            writes.append(ms)
+            if backup['running']:
+                during_backup.append(ms)
+
+    async def reader():
+        while not done.is_set():
+            t0 = time.perf_counter()
+            await db.fetchall('SELECT id, datetime, status FROM sessions WHERE client_id = ? ORDER BY datetime DESC LIMIT 20',
+                              (rnd.randint(1, args.clients),))
+            reads.append((time.perf_counter() - t0) * 1000)
+
+    async def take_backup():
+        while len(writes) < args.writes // 2:
+            await asyncio.sleep(0.01)
+        backup['running'] = True
+        t0 = time.perf_counter()
+        await db.maintenance(bot.backup_to, backup_dir, 'bench', 1)
+        backup['seconds'] = time.perf_counter() - t0
+        backup['running'] = False
+
+    readers = [asyncio.create_task(reader()) for _ in range(args.readers)]
+    snap = asyncio.create_task(take_backup())
+    t0 = time.perf_counter()
+    per = args.writes // args.concurrency
+    await asyncio.gather(*(writer(per) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - t0
+    done.set()
+    await asyncio.gather(snap, *readers)
+    return len(writes) / elapsed, writes, reads, during_backup, backup.get('seconds', 0)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--writes', type=int, default=3000)
+    ap.add_argument('--concurrency', type=int, default=8, help='корутин-писателей')
+    ap.add_argument('--readers', type=int, default=4)
+    ap.add_argument('--trainers', type=int, default=200)
+    ap.add_argument('--clients', type=int, default=20_000)
+    ap.add_argument('--sessions', type=int, default=200_000)
+    ap.add_argument('--payments', type=int, default=50_000)
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+
+    bot = load_bot()
+    root = tempfile.mkdtemp(prefix='crm-storage-')
+    print(f"{'mode':<14} {'writes/s':>9} {'w p50 ms':>9} {'w p99 ms':>9} {'r p50 ms':>9} {'r p99 ms':>9} "
+          f"{'w max in backup':>16} {'backup s':>9}")
+    for mode, pragmas in (('before', {}), ('after', bot.DB_PRAGMAS)):
+        path = os.path.join(root, f"{mode}.db")
+        conn = sqlite3.connect(path)
+        bot.migrate(conn)
+        datagen.generate(conn, args.trainers, args.clients, args.sessions, args.payments, seed=args.seed)
+        conn.close()
+        db = bot.Database(path, readers=args.readers, pragmas=pragmas)
+        rate, writes, reads, during, backup_s = asyncio.run(workload(bot, db, args, os.path.join(root, mode)))
+        journal = db.writer_conn.execute('PRAGMA journal_mode').fetchone()[0]
+        db.close()
+        print(f"{mode + '/' + journal:<14} {rate:>9.0f} {percentile(writes, 50):>9.2f} {percentile(writes, 99):>9.2f} "
+              f"{percentile(reads, 50):>9.2f} {percentile(reads, 99):>9.2f} {max(during, default=0):>16.2f} "
+              f"{backup_s:>9.2f}")
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    main()
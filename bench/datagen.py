@@ -0,0 +1,106 @@
+"""Синтетические данные CRM (тренеры / клиенты / тренировки / платежи) заданного масштаба.
+
+    python bench/datagen.py --db /tmp/crm.db --trainers 2000 --clients 100000 --sessions 1000000
+"""
+
+import argparse
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from _common import load_bot
+
+CHUNK = 10000
+
+FIRST = ['Иван', 'Анна', 'Пётр', 'Мария', 'Олег', 'Ольга', 'Сергей', 'Елена', 'Дмитрий', 'Юлия', 'Алексей', 'Наталья']
+LAST = ['Иванов', 'Смирнова', 'Кузнецов', 'Попова', 'Васильев', 'Петрова', 'Соколов', 'Михайлова', 'Новиков', 'Фёдорова']
+
+# chat_id тренеров и клиентов из непересекающихся диапазонов
+TRAINER_CHAT_BASE = 10_000_000
+CLIENT_CHAT_BASE = 100_000_000
+
+
+def _chunks(rows):
+    buf = []
+    for r in rows:
+        buf.append(r)
+        if len(buf) >= CHUNK:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+def _name(rnd):
+    return f"{rnd.choice(FIRST)} {rnd.choice(LAST)}"
+
+
+def generate(conn: sqlite3.Connection, trainers: int, clients: int, sessions: int, payments: int,
+             seed: int = 1, now: datetime = None, days_back: int = 365, days_ahead: int = 60) -> None:
+    """Заполняет уже мигрированную БД. id идут подряд с 1, chat_id — TRAINER/CLIENT_CHAT_BASE + id."""
+    bot = load_bot()
+    rnd = random.Random(seed)
+    now = now or datetime.utcnow()
+    cities = [c for c in bot.CITIES if c != 'Другой']
+    span = (days_back + days_ahead) * 24 * 4  # шаг 15 минут
+
+    def trainer_rows():
+        for i in range(1, trainers + 1):
+            yield (i, TRAINER_CHAT_BASE + i, _name(rnd), now.isoformat(), rnd.choice(cities),
+                   i, f"trainer{i}", None, None, f"{i:08X}")
+
+    def client_rows():
+        for i in range(1, clients + 1):
+            status = 'approved' if rnd.random() < 0.9 else 'pending'
+            yield (i, _name(rnd), f"+79{rnd.randrange(10**9):09d}", None, 0.0, CLIENT_CHAT_BASE + i,
+                   rnd.randint(1, trainers), status, CLIENT_CHAT_BASE + i, f"client{i}")
+
+    def session_rows():
+        start = now - timedelta(days=days_back)
+        for i in range(1, sessions + 1):
+            dt = start + timedelta(minutes=15 * rnd.randrange(span))
+            past = dt < now
+            yield (i, rnd.randint(1, clients), dt.replace(microsecond=0).isoformat(),
+                   'completed' if past else 'planned', '', int(past), int(past))
+
+    def payment_rows():
+        start = now - timedelta(days=days_back)
+        for i in range(1, payments + 1):
+            dt = start + timedelta(minutes=rnd.randrange(days_back * 24 * 60))
+            yield (i, rnd.randint(1, clients), float(rnd.choice((1000, 1500, 2000, 3000, 6000))), dt.isoformat(), '')
+
+    plan = [
+        ('INSERT INTO trainers (id, chat_id, name, created_at, city, tg_id, username, first_name, last_name, invite_code) '
+         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', trainer_rows()),
+        ('INSERT INTO clients (id, name, phone, notes, balance, chat_id, trainer_id, status, tg_id, username) '
+         'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', client_rows()),
+        ('INSERT INTO sessions (id, client_id, datetime, status, comment, remind24_sent, remind2_sent) '
+         'VALUES (?, ?, ?, ?, ?, ?, ?)', session_rows()),
+        ('INSERT INTO payments (id, client_id, amount, date, note) VALUES (?, ?, ?, ?, ?)', payment_rows()),
+    ]
+    for sql, rows in plan:
+        for chunk in _chunks(rows):
+            conn.executemany(sql, chunk)
+            conn.commit()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--db', required=True)
+    ap.add_argument('--trainers', type=int, default=2000)
+    ap.add_argument('--clients', type=int, default=100_000)
+    ap.add_argument('--sessions', type=int, default=1_000_000)
+    ap.add_argument('--payments', type=int, default=300_000)
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+    bot = load_bot()
+    conn = sqlite3.connect(args.db)
+    bot.migrate(conn)
+    t0 = time.perf_counter()
+    generate(conn, args.trainers, args.clients, args.sessions, args.payments, seed=args.seed)
+    print(f"generated in {time.perf_counter() - t0:.1f}s -> {args.db}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Фейковый Telegram Bot API: отдаёт getUpdates из очереди и запоминает ответы бота.
+
+    python bench/fake_api.py --port 8081
+    TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=0:bench python telegram_crm_bot.py
+
+Понимает sendMessage, editMessageText, editMessageReplyMarkup, answerCallbackQuery,
+getUpdates и getMe; остальные методы отвечают True. Сообщения бота хранятся по
+чатам, правки применяются к ним же — так сценарий видит актуальные кнопки.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'CRM', 'username': 'crm_bench_bot'}
+
+
+class FakeBotAPI:
+    def __init__(self):
+        self.calls = Counter()
+        self.chats = {}  # chat_id -> {message_id: message}
+        self._updates = []
+        self.pushed = 0
+        self._next_message = 1
+        self._arrived = asyncio.Event()
+        self._pending = {}  # update_id -> Future, завершается после обработки ботом
+        self.app = web.Application()
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Поднимает сервер, возвращает базовый URL для TELEGRAM_API_URL."""
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # --- апдейты от «пользователей» ---
+
+    def push(self, update: dict) -> asyncio.Future:
+        """Ставит апдейт в очередь getUpdates; future завершится в done(update_id)."""
+        self.pushed += 1
+        update = dict(update, update_id=self.pushed)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[update['update_id']] = fut
+        self._updates.append(update)
+        self._arrived.set()
+        return fut
+
+    def done(self, update_id: int):
+        fut = self._pending.pop(update_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    def messages(self, chat_id: int) -> list:
+        """Сообщения бота в чате, новые в конце."""
+        return list(self.chats.get(chat_id, {}).values())
+
+    # --- методы Bot API ---
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        fn = getattr(self, 'm_' + method, None)
+        result = await fn(params) if fn else True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def m_getMe(self, params):
+        return BOT_USER
+
+    async def m_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        if offset:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get('limit') or 100)
+        return self._updates[:limit]
+
+    def _markup(self, params):
+        raw = params.get('reply_markup')
+        return json.loads(raw) if isinstance(raw, str) else raw
+
+    async def m_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        msg = {'message_id': self._next_message, 'date': int(time.time()), 'from': BOT_USER,
+               'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        markup = self._markup(params)
+        if markup:
+            msg['reply_markup'] = markup
+        self._next_message += 1
+        self.chats.setdefault(chat_id, {})[msg['message_id']] = msg
+        return msg
+
+    def _edit(self, params, **changes):
+        msg = self.chats.get(int(params.get('chat_id') or 0), {}).get(int(params.get('message_id') or 0))
+        if msg is None:
+            return True  # inline-сообщение или чужой чат: Bot API в этом случае тоже отвечает True
+        msg.update(changes)
+        if not msg.get('reply_markup'):
+            msg.pop('reply_markup', None)
+        return msg
+
+    async def m_editMessageText(self, params):
+        return self._edit(params, text=params.get('text', ''), reply_markup=self._markup(params))
+
+    async def m_editMessageReplyMarkup(self, params):
+        return self._edit(params, reply_markup=self._markup(params))
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8081)
+    args = ap.parse_args()
+    api = FakeBotAPI()
+    print('fake Bot API on', await api.start(args.host, args.port))
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print('calls:', dict(api.calls))
+    finally:
+        await api.stop()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
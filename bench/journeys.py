@@ -0,0 +1,217 @@
+"""Сквозные сценарии пользователей против фейкового Bot API: updates/s и задержка каждого обработчика.
+
+    python bench/journeys.py --users 200 --concurrency 50 --trainers 200 --clients 20000 --sessions 200000
+
+Бот работает как в проде — long polling, но Bot API подменён на bench/fake_api.py
+в том же процессе. БД заранее наполняется bench/datagen.py. Каждый виртуальный
+клиент проходит онбординг (/start → «Я клиент» → поиск города → выбор тренера;
+в городе без тренеров — поиск по имени), после чего выбранный тренер смотрит
+заявки, одобряет клиента, добавляет ему тренировку и платёж, открывает в
+расписании её день, отмечает тренировку и листает дальше. Действия в одном чате тренера идут
+по очереди, разные пользователи — параллельно (не больше --concurrency).
+Задержка меряется middleware от входа в обработчик до выхода из него, для
+callback-кнопок — по настоящему обработчику маршрута, а не route_callback.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import time
+from collections import defaultdict
+
+from _common import load_bot, percentile
+from fake_api import FakeBotAPI
+import datagen
+
+USER_BASE = 900_000_000  # chat_id виртуальных клиентов, не пересекается с datagen
+CITY_QUERIES = ['Моск', 'Санкт', 'Екате', 'Казань', 'Новосиб', 'Ростов']
+
+
+class JourneyFailed(Exception):
+    pass
+
+
+def handler_timer(api: FakeBotAPI, samples):
+    """Middleware: длительность обработчиков в samples[имя], завершение апдейта — в api.done."""
+    from aiogram.dispatcher.handler import current_handler
+    from aiogram.dispatcher.middlewares import BaseMiddleware
+
+    class HandlerTimer(BaseMiddleware):
+        async def _start(self, obj, data):
+            data['_bench_t0'] = time.perf_counter()
+            data['_bench_handler'] = current_handler.get()
+
+        async def _stop(self, obj, results, data):
+            if '_bench_t0' in data:
+                handler = data.get('route') or data['_bench_handler']
+                samples[handler.__name__].append((time.perf_counter() - data['_bench_t0']) * 1000)
+
+        on_process_message = on_process_callback_query = _start
+        on_post_process_message = on_post_process_callback_query = _stop
+
+        async def on_post_process_update(self, update, results, data):
+            api.done(update.update_id)
+
+    return HandlerTimer()
+
+
+class User:
+    """Чат в Telegram: шлёт апдейты и ждёт, пока бот их обработает."""
+
+    def __init__(self, api: FakeBotAPI, chat_id: int, name: str):
+        self.api = api
+        self.chat_id = chat_id
+        self.tg = {'id': chat_id, 'is_bot': False, 'first_name': name, 'username': f"u{chat_id}"}
+        self.chat = {'id': chat_id, 'type': 'private'}
+
+    async def say(self, text: str):
+        await self.api.push({'message': {'message_id': 1, 'date': int(time.time()), 'chat': self.chat,
+                                         'from': self.tg, 'text': text}})
+
+    async def press(self, data: str, message: dict = None):
+        message = message or {'message_id': 1, 'date': 0, 'chat': self.chat, 'text': '.'}
+        await self.api.push({'callback_query': {'id': str(random.getrandbits(40)), 'from': self.tg,
+                                                'chat_instance': str(self.chat_id), 'data': data,
+                                                'message': message}})
+
+    def button(self, prefix: str, skip=()):
+        """Последняя inline-кнопка в чате с callback_data, начинающимся на prefix."""
+        for msg in reversed(self.api.messages(self.chat_id)):
+            for row in reversed(msg.get('reply_markup', {}).get('inline_keyboard', [])):
+                for b in row:
+                    data = b.get('callback_data', '')
+                    if data.startswith(prefix) and data not in skip:
+                        return data, msg
+        raise JourneyFailed(f"no '{prefix}' button in chat {self.chat_id}")
+
+    async def click(self, prefix: str, skip=()) -> str:
+        data, msg = self.button(prefix, skip)
+        await self.press(data, msg)
+        return data
+
+
+async def client_journey(api, rnd, n: int, first_names: list) -> int:
+    """Онбординг нового клиента и выбор тренера; возвращает id тренера."""
+    user = User(api, USER_BASE + n, f"Bench{n}")
+    await user.say('/start')
+    await user.say('Я клиент')
+    await user.say(rnd.choice(CITY_QUERIES))
+    await user.click('pick_city:')
+    try:
+        data = await user.click('pick_trainer:')
+    except JourneyFailed:
+        # в городе нет тренеров — поиск по имени одного из сгенерированных тренеров
+        await user.press('search_trainers')
+        await user.say(rnd.choice(first_names))
+        data = await user.click('pick_trainer:')
+    return int(data.split(':')[1])
+
+
+def sched_button(slot: str, view: str) -> str:
+    """callback_data кнопки расписания (view 'd' — день, 'w' — неделя) с выбранным слотом."""
+    from telegram_crm_bot import SCHED, cb, schedule_start, _dt_decode
+    return cb('sched', view, schedule_start(view, _dt_decode(slot.rsplit(':', 1)[1])), fields=SCHED)
+
+
+async def trainer_journey(api, tid: int, approved: set):
+    """Заявки → одобрение → тренировка → платёж → расписание."""
+    user = User(api, datagen.TRAINER_CHAT_BASE + tid, f"Trainer{tid}")
+    await user.say('📝 Заявки')
+    # заявка приходит тренеру отдельным сообщением с кнопками approve/reject
+    data = await user.click('approve:', skip={f"approve:{c}" for c in approved})
+    cid = int(data.split(':')[1])
+    approved.add(cid)
+    await user.say('📋 Мои клиенты')
+    # нового клиента может не быть на первой странице — карточку открываем напрямую
+    await user.press(f"client:{cid}", user.api.messages(user.chat_id)[-1])
+    await user.click(f"add_session:{cid}")
+    slot = await user.click(f"slot:{cid}:")
+    await user.say('-')
+    await user.press(f"client:{cid}", user.api.messages(user.chat_id)[-1])
+    await user.click(f"add_payment:{cid}")
+    await user.say('1500')
+    await user.say('-')
+    await user.say('📅 Расписание')
+    # день новой тренировки; если он на следующей неделе — сначала ➡️
+    day = sched_button(slot, 'd')
+    try:
+        await user.click(day)
+    except JourneyFailed:
+        await user.click(sched_button(slot, 'w'))
+        await user.click(day)
+    await user.click('done_session:')
+    await user.click('sched:')  # ➡️ следующий день
+
+
+async def run(args):
+    api = FakeBotAPI()
+    os.environ['TELEGRAM_API_URL'] = await api.start()
+    bot = load_bot()
+
+    conn = sqlite3.connect(bot.DB_FILE)
+    t0 = time.perf_counter()
+    datagen.generate(conn, args.trainers, args.clients, args.sessions, args.payments, seed=args.seed)
+    first_names = sorted({name.split()[0] for name, in conn.execute('SELECT name FROM trainers')})
+    conn.close()
+    print(f"datagen: {args.trainers} trainers / {args.clients} clients / {args.sessions} sessions / "
+          f"{args.payments} payments in {time.perf_counter() - t0:.1f}s")
+
+    samples = defaultdict(list)
+    bot.dp.middleware.setup(handler_timer(api, samples))
+    polling = asyncio.create_task(bot.dp.start_polling(timeout=1, relax=0, reset_webhook=False))
+
+    rnd = random.Random(args.seed)
+    sem = asyncio.Semaphore(args.concurrency)
+    trainer_locks = defaultdict(asyncio.Lock)
+    approved, outcome = set(), defaultdict(int)
+
+    async def journey(n):
+        async with sem:
+            try:
+                tid = await client_journey(api, rnd, n, first_names)
+                async with trainer_locks[tid]:
+                    await trainer_journey(api, tid, approved)
+                outcome['ok'] += 1
+            except JourneyFailed as e:
+                outcome['failed'] += 1
+                if outcome['failed'] <= 3:
+                    print('journey failed:', e)
+
+    t0 = time.perf_counter()
+    updates_before = api.pushed
+    await asyncio.gather(*(journey(n) for n in range(args.users)))
+    elapsed = time.perf_counter() - t0
+    updates = api.pushed - updates_before
+
+    bot.dp.stop_polling()
+    await polling
+    await bot.dp.storage.close()
+    await (await bot.bot.get_session()).close()
+    await api.stop()
+    bot.db.close()
+
+    print(f"journeys: {outcome['ok']} ok, {outcome['failed']} failed; {updates} updates in {elapsed:.1f}s "
+          f"= {updates / elapsed:.0f} updates/s")
+    print(f"{'handler':<32} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, s in sorted(samples.items(), key=lambda kv: -percentile(kv[1], 99)):
+        print(f"{name:<32} {len(s):>6} {percentile(s, 50):>8.2f} {percentile(s, 95):>8.2f} "
+              f"{percentile(s, 99):>8.2f} {max(s):>8.2f}")
+    print('Bot API calls:', dict(api.calls))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--users', type=int, default=200, help='виртуальных клиентов (сценариев)')
+    ap.add_argument('--concurrency', type=int, default=50)
+    ap.add_argument('--trainers', type=int, default=200)
+    ap.add_argument('--clients', type=int, default=20_000)
+    ap.add_argument('--sessions', type=int, default=200_000)
+    ap.add_argument('--payments', type=int, default=50_000)
+    ap.add_argument('--seed', type=int, default=1)
+    asyncio.run(run(ap.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
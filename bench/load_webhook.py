@@ -0,0 +1,94 @@
+"""Нагрузка на webhook: N апдейтов в секунду, перцентили времени ответа.
+
+    BOT_MODE=webhook WEBAPP_PORT=8080 python telegram_crm_bot.py
+    python bench/load_webhook.py --url http://127.0.0.1:8080/webhook --rate 200 --duration 30
+
+Открытая модель: запросы уходят по расписанию независимо от ответов, так что
+очередь перед WEBHOOK_MAX_INFLIGHT видна в p99. --updates — JSONL с записанными
+апдейтами (по одному Update на строку, например из getUpdates); без него —
+синтетические /start, тексты меню и нажатия кнопок от разных пользователей.
+update_id переписывается, чтобы апдейты не считались повторами.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+import aiohttp
+
+from _common import percentile
+
+TEXTS = ['/start', '📋 Мои клиенты', '📅 Мои тренировки', 'ℹ️ Мой тренер', '🧑‍🏫 Выбрать тренера', '💸 Мой баланс']
+CALLBACKS = ['trainers_page:n:0', 'myclients_page:n:0', 'search_trainers', 'noop']
+
+
+def synthetic(rnd: random.Random, users: int):
+    uid = 500_000_000 + rnd.randrange(users)
+    user = {'id': uid, 'is_bot': False, 'first_name': f"Load{uid}"}
+    chat = {'id': uid, 'type': 'private'}
+    if rnd.random() < 0.7:
+        return {'message': {'message_id': rnd.randrange(1, 10**6), 'date': int(time.time()),
+                            'chat': chat, 'from': user, 'text': rnd.choice(TEXTS)}}
+    return {'callback_query': {'id': str(rnd.randrange(10**9)), 'from': user, 'chat_instance': str(uid),
+                               'data': rnd.choice(CALLBACKS),
+                               'message': {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': '.'}}}
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    ap.add_argument('--rate', type=float, default=100, help='апдейтов в секунду')
+    ap.add_argument('--duration', type=float, default=10, help='секунд')
+    ap.add_argument('--updates', help='JSONL с записанными Update')
+    ap.add_argument('--users', type=int, default=1000, help='разных пользователей в синтетике')
+    ap.add_argument('--secret', default='', help='WEBHOOK_SECRET')
+    args = ap.parse_args()
+
+    rnd = random.Random(11)
+    recorded = []
+    if args.updates:
+        with open(args.updates, encoding='utf-8') as f:
+            recorded = [json.loads(line) for line in f if line.strip()]
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+
+    latencies, statuses = [], Counter()
+
+    async def fire(session, update_id):
+        body = dict(recorded[update_id % len(recorded)] if recorded else synthetic(rnd, args.users))
+        body['update_id'] = update_id
+        t0 = time.perf_counter()
+        try:
+            async with session.post(args.url, json=body, headers=headers) as resp:
+                await resp.read()
+                statuses[resp.status] += 1
+        except aiohttp.ClientError as e:
+            statuses[type(e).__name__] += 1
+            return
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    total = int(args.rate * args.duration)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = []
+        start = time.perf_counter()
+        for i in range(total):
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(fire(session, i + 1)))
+        sent_in = time.perf_counter() - start
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    print(f"sent {total} updates in {sent_in:.1f}s (target {args.rate:g}/s), all answered in {elapsed:.1f}s")
+    print('statuses:', dict(statuses))
+    if latencies:
+        print(f"latency ms: p50={percentile(latencies, 50):.1f} p95={percentile(latencies, 95):.1f} "
+              f"p99={percentile(latencies, 99):.1f} max={max(latencies):.1f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -4,11 +4,12 @@ Telegram CRM для тренеров — Расширенный MVP (всё в 
 Фичи:
 - Роли: тренер / клиент (выбор при /start), автосохранение Telegram-профиля (id, username, first/last/full name)
 - Клиент: поиск города (локально + Nominatim без ключа) → выбор тренера; альтернатива — привязка по UUID
-- Тренер: заявки (approve/reject), список клиентов, карточка клиента (редактирование), расписание, платежи
+- Тренер: заявки (approve/reject), список клиентов, карточка клиента (редактирование), расписание по неделям и дням (листание, отметка прошедших разом), платежи
 - Тарифы/пакеты: имя, описание, цена (редактирует тренер; клиент видит в «ℹ️ Мой тренер»)
 - UUID-инвайт: тренер генерирует код, клиент вводит — мгновенная привязка
 - Удаление клиента тренером; «уйти от тренера» у клиента (без удаления истории у клиента)
 - Напоминания 24ч/2ч по тренировкам
+- Запись на свободное время: рабочие часы и длительность тренировки в профиле, без двойных броней
 - Полностью на кнопках (Reply/Inline), формы через FSM
 - Ручной ввод даты: явное сообщение и пример формата (ДД.ММ.ГГГГ ЧЧ:ММ, 24ч)
 
@@ -18,42 +19,444 @@ Telegram CRM для тренеров — Расширенный MVP (всё в 
 Запуск:
     export BOT_TOKEN="<твой_токен>"
     python telegram_crm_bot.py
+    python telegram_crm_bot.py check-ledger [--fix]   # сверка балансов с журналом
+    python telegram_crm_bot.py backup [каталог]        # онлайн-бэкап, бот может работать
+    python telegram_crm_bot.py restore <файл|latest>   # восстановление, бот остановлен
+    python telegram_crm_bot.py archive [--vacuum]      # архивация сейчас; --vacuum — при остановленном боте
+    # TELEGRAM_API_URL — свой Bot API сервер (например, фейк из bench/fake_api.py)
+
+Метрики (формат Prometheus): обработчики, SQL по форме запроса, вызовы Bot API,
+RetryAfter, задержка напоминаний:
+    curl localhost:9090/metrics     # METRICS_HOST (127.0.0.1), METRICS_PORT (9090, 0 — выкл.)
+    # в режиме webhook — тот же порт, что и вебхук: curl localhost:8080/metrics
+
+Хранилище: WAL, synchronous=NORMAL, кэш и mmap; фоновые PASSIVE-чекпойнты и
+бэкапы через sqlite3 backup API в BACKUP_DIR с ротацией:
+    # DB_JOURNAL (wal | delete), DB_SYNCHRONOUS (normal), DB_CACHE_MB (64), DB_MMAP_MB (256),
+    # DB_BUSY_TIMEOUT (5 с), DB_CHECKPOINT_INTERVAL (60 с), BACKUP_DIR (backups),
+    # BACKUP_INTERVAL_HOURS (24, 0 — выкл.), BACKUP_KEEP (7)
+Архив: проведённые тренировки и платежи старше года (с начала месяца) фоном
+переезжают в отдельный файл; история, экспорт, баланс и статистика видят обе части:
+    # ARCHIVE_DB (<база>-archive.db), ARCHIVE_AFTER_DAYS (365, 0 — выкл.),
+    # ARCHIVE_BATCH (500), ARCHIVE_INTERVAL_HOURS (24)
+
+Профилирование медленных апдейтов (cProfile + SQL + EXPLAIN QUERY PLAN в PROFILE_DIR):
+    PROFILE_SLOW_MS=200 python telegram_crm_bot.py   # PROFILE_SAMPLE (1.0), PROFILE_DIR (profiles), PROFILE_KEEP (100)
+    python -m pstats profiles/<файл>.prof
+
+Webhook вместо long polling:
+    export BOT_MODE=webhook WEBAPP_PORT=8080 WEBHOOK_URL="https://bot.example.com"
+    python telegram_crm_bot.py
+    # WEBHOOK_PATH (/webhook), WEBAPP_HOST (0.0.0.0), WEBHOOK_SECRET,
+    # WEBHOOK_MAX_INFLIGHT (32), WEBHOOK_DRAIN_TIMEOUT (25 с)
+Без WEBHOOK_URL вебхук в Telegram не регистрируется — удобно слать апдейты руками:
+    curl -XPOST localhost:8080/webhook -H 'Content-Type: application/json' -d @update.json
+    curl localhost:8080/readyz
 """
 
 import os
+import re
+import sys
+import io
+import csv
+import zipfile
+import tempfile
+import json
+import time
 import sqlite3
 import asyncio
 import logging
+import threading
+import copy
 import uuid
+import heapq
+import inspect
+import random
+import pstats
+import cProfile
+import contextvars
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from datetime import datetime, timedelta
 from dateutil import parser as dateparser
+from dateutil.rrule import rrulestr
 
 import aiohttp
+from aiohttp import web
+
+try:
+    import openpyxl  # опционально: экспорт в XLSX
+except ImportError:
+    openpyxl = None
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
     CallbackQuery
 )
 from aiogram.utils import executor
+from aiogram.utils.exceptions import BadRequest, MessageNotModified, RetryAfter, Unauthorized
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.handler import ctx_data, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import WebhookRequestHandler
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 
 # --- Logging ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --- Metrics ---
+# Счётчики и гистограммы в памяти, отдаются в текстовом формате Prometheus на
+# /metrics. Наблюдение — словарь + bisect под одним lock'ом (запросы к БД
+# меряются в потоках executor'а), так что включено всегда.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))  # 0 — не поднимать отдельный сервер
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _metric_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    body = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' '))
+                    for k, v in labels)
+    return '{' + body + '}'
+
+class Metrics:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._help = {}
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [счётчики по бакетам..., +Inf, сумма]
+        self._gauges = []      # (name, fn) — fn() -> {labels: value}, читается при отдаче
+        self._lock = threading.RLock()  # RLock: TimedCursor.__del__ может сработать при GC внутри observe
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            h[i] += 1
+            h[-1] += seconds
+
+    def gauge(self, name: str, text: str, fn):
+        self.describe(name, 'gauge', text)
+        self._gauges.append((name, fn))
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        series = {}
+        for (name, labels), v in counters.items():
+            series.setdefault(name, []).append(f"{name}{_metric_labels(labels)} {v:g}")
+        for (name, labels), h in histograms.items():
+            out = series.setdefault(name, [])
+            total = 0
+            for le, n in zip(self.buckets + ('+Inf',), h):
+                total += n
+                out.append(f"{name}_bucket{_metric_labels(labels + (('le', le),))} {total}")
+            out.append(f"{name}_sum{_metric_labels(labels)} {h[-1]:.6f}")
+            out.append(f"{name}_count{_metric_labels(labels)} {total}")
+        for name, fn in self._gauges:
+            try:
+                values = fn()
+            except Exception:
+                logger.exception('Metric %s failed', name)
+                continue
+            if not isinstance(values, dict):
+                values = {(): values}
+            series[name] = [f"{name}{_metric_labels(labels)} {v:g}" for labels, v in values.items()]
+        lines = []
+        for name in sorted(series):
+            kind, text = self._help.get(name, ('untyped', ''))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"] + series[name]
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('handler_seconds', 'histogram', 'Время обработчика апдейта')
+metrics.describe('db_query_seconds', 'histogram', 'Время SQL-запроса по форме выражения (execute + fetch)')
+metrics.describe('telegram_api_seconds', 'histogram', 'Время вызова Bot API')
+metrics.describe('telegram_api_errors_total', 'counter', 'Ошибки Bot API по методу и типу')
+metrics.describe('telegram_retry_after_total', 'counter', 'Ответы RetryAfter от Bot API')
+metrics.describe('reminder_lag_seconds', 'histogram', 'Задержка отправки напоминания относительно срока')
+metrics.describe('geocoder_search_seconds', 'histogram', 'Шаг выбора города: локальный индекс, кэш или Nominatim')
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+@lru_cache(maxsize=2048)
+def sql_shape(sql: str) -> str:
+    """Форма запроса: литералы → ?, списки (?, ?, …) → (…), пробелы схлопнуты."""
+    shape = ' '.join(_SQL_LITERALS.sub('?', sql).split())
+    return _SQL_LISTS.sub('(…)', shape)
+
+# Запросы текущего апдейта — [sql, params, секунды]; список есть только в режиме профилирования
+sql_trace = contextvars.ContextVar('sql_trace', default=None)
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, который пишет время execute и последующих fetch в db_query_seconds.
+    Одно наблюдение на выражение: время копится и уходит в гистограмму, когда
+    выборка исчерпана, курсор выполняет следующее выражение, закрыт или собран."""
+    _shape = None
+    _traced = None
+    _pending = 0.0
+
+    def _observe(self):
+        if self._shape is not None:
+            metrics.observe('db_query_seconds', self._pending, query=self._shape)
+            self._shape = None
+
+    def _timed(self, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            if self._shape is not None:
+                elapsed = time.perf_counter() - t0
+                self._pending += elapsed
+                if self._traced is not None:
+                    self._traced[2] += elapsed
+
+    def _start(self, sql, params):
+        self._observe()
+        self._shape = sql_shape(sql)
+        self._pending = 0.0
+        trace = sql_trace.get()
+        self._traced = None if trace is None else [sql, params, 0.0]
+        if self._traced is not None:
+            trace.append(self._traced)
+
+    def execute(self, sql, params=()):
+        self._start(sql, params)
+        return self._timed(super().execute, sql, params)
+
+    def executemany(self, sql, seq):
+        self._start(sql, None)
+        return self._timed(super().executemany, sql, seq)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._observe()
+        return row
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._observe()
+        return rows
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        if len(rows) < size:
+            self._observe()
+        return rows
+
+    def close(self):
+        self._observe()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._observe()
+        except Exception:
+            pass  # остановка интерпретатора: метрик уже может не быть
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение с TimedCursor (в том числе для conn.execute/executemany)."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+class InstrumentedBot(Bot):
+    """Bot со счётчиками исходящих вызовов Bot API, ошибок и RetryAfter."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except RetryAfter:
+            metrics.inc('telegram_retry_after_total', method=method)
+            raise
+        except Exception as e:
+            metrics.inc('telegram_api_errors_total', method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('telegram_api_seconds', time.perf_counter() - t0, method=method)
+
+class HandlerMetrics(BaseMiddleware):
+    """Время каждого обработчика сообщений и кнопок: метки handler и prefix
+    (префикс callback_data; у сообщений пустой)."""
+
+    async def _start(self, obj, data):
+        data['_metrics_t0'] = time.perf_counter()
+        data['_metrics_handler'] = current_handler.get()
+
+    async def _stop(self, obj, results, data):
+        t0 = data.get('_metrics_t0')
+        if t0 is None:
+            return  # ни один обработчик не подошёл
+        handler = data.get('route') or data['_metrics_handler']
+        prefix = obj.data.split(':', 1)[0] if isinstance(obj, CallbackQuery) and obj.data else ''
+        metrics.observe('handler_seconds', time.perf_counter() - t0, handler=handler.__name__, prefix=prefix)
+
+    on_process_message = on_process_callback_query = _start
+    on_post_process_message = on_post_process_callback_query = _stop
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+# --- Profiling (по PROFILE_SLOW_MS) ---
+# Для доли PROFILE_SAMPLE апдейтов пишется cProfile и список SQL-запросов; если
+# обработчик дольше порога — в PROFILE_DIR сохраняются .prof и отчёт с планами
+# запросов (EXPLAIN QUERY PLAN), хранятся последние PROFILE_KEEP.
+# cProfile один на поток, поэтому профилируется не больше одного апдейта за раз,
+# и в профиль попадают корутины, которые event loop выполнял параллельно.
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', '0'))  # 0 — выключено
+PROFILE_SAMPLE = float(os.getenv('PROFILE_SAMPLE', '1'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '100'))
+
+def _explain(conn, trace):
+    plans = []
+    for sql, params, _ in trace:
+        if params is None or not sql.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')):
+            plans.append(None)
+            continue
+        try:
+            rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            plans.append('\n'.join(f"    {'  ' * (parent > 0)}{detail}" for _, parent, _, detail in rows))
+        except sqlite3.Error as e:
+            plans.append(f"    ({e})")
+    return plans
+
+def write_profile(path: str, handler: str, elapsed_ms: float, prof, trace, plans):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    lines = [f"handler: {handler}", f"elapsed: {elapsed_ms:.1f} ms", f"queries: {len(trace)}", '']
+    for (sql, params, secs), plan in zip(trace, plans):
+        lines.append(f"[{secs * 1000:.2f} ms] {' '.join(sql.split())}")
+        lines.append(f"    params: {params!r}")
+        if plan:
+            lines.append(plan)
+    if prof is not None:
+        prof.dump_stats(path + '.prof')
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).sort_stats('cumulative').print_stats(40)
+        lines += ['', out.getvalue()]
+    else:
+        lines += ['', '(без cProfile: в это время профилировался другой апдейт)']
+    with open(path + '.txt', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+    dumps = sorted(Path(PROFILE_DIR).glob('*.txt'))
+    for old in dumps[:max(0, len(dumps) - PROFILE_KEEP)]:
+        old.unlink(missing_ok=True)
+        old.with_suffix('.prof').unlink(missing_ok=True)
+
+class SlowUpdateProfiler(BaseMiddleware):
+    """Профиль и SQL медленных апдейтов (см. PROFILE_SLOW_MS)."""
+
+    def __init__(self, threshold_ms: float = PROFILE_SLOW_MS, sample: float = PROFILE_SAMPLE):
+        super().__init__()
+        self.threshold_ms = threshold_ms
+        self.sample = sample
+        self._busy = False
+        self._seq = 0
+
+    async def _start(self, obj, data):
+        if random.random() >= self.sample:
+            return
+        data['_profile_t0'] = time.perf_counter()
+        data['_profile_handler'] = current_handler.get()
+        data['_profile_sql'] = sql_trace.set([])
+        if not self._busy:
+            self._busy = True
+            data['_profile'] = prof = cProfile.Profile()
+            prof.enable()
+
+    async def _stop(self, obj, results, data):
+        t0 = data.get('_profile_t0')
+        if t0 is None:
+            return
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        prof = data.get('_profile')
+        if prof is not None:
+            prof.disable()
+            self._busy = False
+        trace = sql_trace.get()
+        sql_trace.reset(data['_profile_sql'])
+        if elapsed_ms < self.threshold_ms:
+            return
+        handler = (data.get('route') or data['_profile_handler']).__name__
+        self._seq += 1
+        path = os.path.join(PROFILE_DIR, f"{datetime.utcnow():%Y%m%dT%H%M%S}-{self._seq:04d}-{handler}")
+        try:
+            plans = await db.read(_explain, trace)
+            await asyncio.get_running_loop().run_in_executor(
+                None, write_profile, path, handler, elapsed_ms, prof, trace, plans)
+            logger.warning('Slow update: %s %.0f ms, %s queries -> %s.txt', handler, elapsed_ms, len(trace), path)
+        except Exception:
+            logger.exception('Failed to write profile for %s', handler)
+
+    on_process_message = on_process_callback_query = _start
+    on_post_process_message = on_post_process_callback_query = _stop
+
 # --- Bot token ---
 API_TOKEN = os.getenv('BOT_TOKEN')
 if not API_TOKEN:
     logger.warning("BOT_TOKEN не установлен. Установи переменную окружения BOT_TOKEN перед запуском.")
 
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+# Другой Bot API сервер: локальный telegram-bot-api или фейк из bench/
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+bot = InstrumentedBot(token=API_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
 
-DB_FILE = 'crm.db'
+DB_FILE = os.getenv('CRM_DB', 'crm.db')
+# WAL: читатели не ждут писателя и наоборот. synchronous=NORMAL в WAL не делает
+# fsync на каждом коммите — после сбоя питания теряются последние транзакции,
+# но не целостность базы. DB_JOURNAL=delete — прежний журнал отката.
+DB_PRAGMAS = {
+    'journal_mode': os.getenv('DB_JOURNAL', 'wal'),
+    'synchronous': os.getenv('DB_SYNCHRONOUS', 'normal'),
+    'cache_size': -1024 * int(os.getenv('DB_CACHE_MB', '64')),  # отрицательное — в KiB
+    'mmap_size': int(os.getenv('DB_MMAP_MB', '256')) << 20,
+    # страховка, если фоновые чекпойнты не успевают: ~40 МБ WAL на странице 4 КБ
+    'wal_autocheckpoint': 10000,
+    'journal_size_limit': 64 << 20,
+}
+READER_PRAGMAS = ('cache_size', 'mmap_size')
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '5'))  # секунд ожидания чужой блокировки
+DB_CHECKPOINT_INTERVAL = int(os.getenv('DB_CHECKPOINT_INTERVAL', '60'))  # секунд, 0 — только автоматические
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = float(os.getenv('BACKUP_INTERVAL_HOURS', '24'))  # 0 — без расписания
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+# Холодные данные — отдельный файл, подключённый ко всем соединениям как schema archive
+ARCHIVE_DB = os.getenv('ARCHIVE_DB', '')  # по умолчанию <CRM_DB без .db>-archive.db
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '365'))  # 0 — не архивировать
+ARCHIVE_BATCH = int(os.getenv('ARCHIVE_BATCH', '500'))
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL_HOURS', '24'))
 
 # --- Список городов (крупные РФ + Другой) ---
 CITIES = [
@@ -67,89 +470,1005 @@ CITIES = [
     'Другой'
 ]
 
-# --- DB init ---
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-cur = conn.cursor()
-
-cur.execute('''CREATE TABLE IF NOT EXISTS trainers (
-    id INTEGER PRIMARY KEY,
-    chat_id INTEGER UNIQUE,
-    name TEXT,
-    created_at TEXT,
-    city TEXT,
-    pricing TEXT,
-    tg_id INTEGER,
-    username TEXT,
-    first_name TEXT,
-    last_name TEXT,
-    invite_code TEXT
-)''')
-
-cur.execute('''CREATE TABLE IF NOT EXISTS clients (
-    id INTEGER PRIMARY KEY,
-    name TEXT,
-    phone TEXT,
-    notes TEXT,
-    balance REAL DEFAULT 0,
-    chat_id INTEGER,
-    trainer_id INTEGER,
-    status TEXT DEFAULT 'approved',
-    tg_id INTEGER,
-    username TEXT,
-    first_name TEXT,
-    last_name TEXT,
-    FOREIGN KEY(trainer_id) REFERENCES trainers(id)
-)''')
-
-cur.execute('''CREATE TABLE IF NOT EXISTS sessions (
-    id INTEGER PRIMARY KEY,
-    client_id INTEGER,
-    datetime TEXT,
-    status TEXT DEFAULT 'planned',
-    comment TEXT,
-    remind24_sent INTEGER DEFAULT 0,
-    remind2_sent INTEGER DEFAULT 0,
-    FOREIGN KEY(client_id) REFERENCES clients(id)
-)''')
-
-cur.execute('''CREATE TABLE IF NOT EXISTS payments (
-    id INTEGER PRIMARY KEY,
-    client_id INTEGER,
-    amount REAL,
-    date TEXT,
-    note TEXT,
-    FOREIGN KEY(client_id) REFERENCES clients(id)
-)''')
-
-cur.execute('''CREATE TABLE IF NOT EXISTS tariffs (
-    id INTEGER PRIMARY KEY,
-    trainer_id INTEGER,
-    title TEXT,
-    description TEXT,
-    price REAL,
-    FOREIGN KEY(trainer_id) REFERENCES trainers(id)
-)''')
-conn.commit()
-
-# Миграции (мягкие)
-for ddl in [
-    "ALTER TABLE trainers ADD COLUMN city TEXT",
-    "ALTER TABLE trainers ADD COLUMN pricing TEXT",
-    "ALTER TABLE trainers ADD COLUMN tg_id INTEGER",
-    "ALTER TABLE trainers ADD COLUMN username TEXT",
-    "ALTER TABLE trainers ADD COLUMN first_name TEXT",
-    "ALTER TABLE trainers ADD COLUMN last_name TEXT",
-    "ALTER TABLE trainers ADD COLUMN invite_code TEXT",
-    "ALTER TABLE clients ADD COLUMN tg_id INTEGER",
-    "ALTER TABLE clients ADD COLUMN username TEXT",
-    "ALTER TABLE clients ADD COLUMN first_name TEXT",
-    "ALTER TABLE clients ADD COLUMN last_name TEXT"
-]:
+# --- Хранилище: прагмы, чекпойнты, бэкапы ---
+def apply_pragmas(conn: sqlite3.Connection, pragmas: dict) -> sqlite3.Connection:
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}').fetchall()
+    return conn
+
+def checkpoint(conn) -> tuple:
+    """PASSIVE: переносит из WAL в базу всё, что не читается прямо сейчас, никого
+    не дожидаясь. -> (busy, кадров в WAL, перенесено); вне WAL — (0, -1, -1)."""
+    return conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+
+def list_backups(dest_dir, name: str) -> list:
+    """Бэкапы <name>-<время>.db, старые первыми."""
+    return sorted(Path(dest_dir).glob(f"{name}-[0-9]*.db"))
+
+def backup_to(conn, dest_dir, name: str, keep: int = BACKUP_KEEP, schema: str = 'main') -> Path:
+    """Онлайн-копия в dest_dir/<name>-<время>.db. Connection.backup одним шагом:
+    в WAL это один снимок на чтение, писатели не ждут. Копия проверяется,
+    переводится в обычный журнал (один файл) и переименовывается из .tmp;
+    сверх keep последних бэкапов старые удаляются (0 — не удалять).
+    schema='archive' — копия подключённого архива."""
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    final = dest_dir / f"{name}-{datetime.utcnow():%Y%m%d-%H%M%S-%f}.db"
+    tmp = final.with_suffix('.db.tmp')
+    t0 = time.perf_counter()
+    dst = sqlite3.connect(tmp)
     try:
-        cur.execute(ddl)
-    except Exception:
+        conn.backup(dst, name=schema)
+        dst.execute('PRAGMA journal_mode = DELETE')
+        check = dst.execute('PRAGMA quick_check').fetchone()[0]
+    finally:
+        dst.close()
+    if check != 'ok':
+        tmp.unlink()
+        raise sqlite3.DatabaseError(f'backup {final}: quick_check {check}')
+    os.replace(tmp, final)
+    metrics.observe('db_backup_seconds', time.perf_counter() - t0)
+    if keep:
+        for old in list_backups(dest_dir, name)[:-keep]:
+            old.unlink()
+    return final
+
+metrics.describe('db_backup_seconds', 'histogram', 'Длительность онлайн-бэкапа базы')
+metrics.describe('db_maintenance_total', 'counter', 'Чекпойнты и бэкапы по результату')
+
+# --- Архив: холодные тренировки и платежи ---
+# Проведённые тренировки и платежи старше ARCHIVE_AFTER_DAYS (с начала того
+# месяца) переезжают в archive.sessions / archive.payments с теми же id.
+# Горячие запросы (напоминания, брони, ближайшее расписание) читают только main,
+# а в архив заглядывают, лишь когда окно заходит за его границу в archive_edges;
+# история, экспорт, карточка клиента и сверка журнала — обе части.
+# таблица -> (колонка времени, условие холодной строки, индексы архива)
+ARCHIVE_TABLES = {
+    'sessions': ('datetime', "status = 'completed'", {
+        'idx_archive_sessions_client_dt': 'client_id, datetime',
+        'idx_archive_sessions_trainer_dt': 'trainer_id, datetime',
+        'idx_archive_sessions_series_occ': 'series_id, occurrence',
+    }),
+    'payments': ('date', '1', {
+        'idx_archive_payments_client_date': 'client_id, date',
+    }),
+}
+
+# таблица -> самое позднее время строки (у повторения серии — и occurrence):
+# archive_edges.until хранит максимум по архиву, он лежит в main, и горячему
+# запросу не нужно открывать чтение файла архива, чтобы узнать, что там пусто.
+ARCHIVE_EDGE = {
+    'sessions': 'max(datetime, coalesce(occurrence, datetime))',
+    'payments': 'date',
+}
+
+def archive_path(db_path: str) -> str:
+    if db_path in ('', ':memory:'):
+        return ':memory:'
+    if ARCHIVE_DB and db_path == DB_FILE:
+        return ARCHIVE_DB
+    return os.path.splitext(db_path)[0] + '-archive.db'
+
+def attach_archive(conn: sqlite3.Connection, path: str, readonly: bool = False) -> sqlite3.Connection:
+    if any(r[1] == 'archive' for r in conn.execute('PRAGMA database_list')):
+        return conn
+    if readonly and path != ':memory:':
+        path = Path(path).absolute().as_uri() + '?mode=ro'  # соединение открыто с uri=True
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    return conn
+
+def archive_schema(conn):
+    """Таблицы архива по текущим колонкам main (новые колонки доезжают ALTER'ом) и их индексы."""
+    for table, (_, _, indexes) in ARCHIVE_TABLES.items():
+        cols = conn.execute(f'PRAGMA main.table_info({table})').fetchall()
+        have = {r[1] for r in conn.execute(f'PRAGMA archive.table_info({table})')}
+        if not have:
+            decl = ', '.join(f"{name} {ctype}{' PRIMARY KEY' if pk else ''}" for _, name, ctype, _, _, pk in cols)
+            conn.execute(f'CREATE TABLE archive.{table} ({decl})')
+        for _, name, ctype, _, _, _ in cols:
+            if have and name not in have:
+                conn.execute(f'ALTER TABLE archive.{table} ADD COLUMN {name} {ctype}')
+        for index, columns in indexes.items():
+            conn.execute(f'CREATE INDEX IF NOT EXISTS archive.{index} ON {table}({columns})')
+
+def has_archive(conn, table: str) -> bool:
+    return any(r[1] == 'archive' for r in conn.execute('PRAGMA database_list')) and \
+        conn.execute('SELECT 1 FROM archive.sqlite_master WHERE type = ? AND name = ?', ('table', table)).fetchone() is not None
+
+def archive_union(conn, table: str, cols: str) -> str:
+    """Источник для FROM: строки table из main и архива (если он уже подключён)."""
+    if not has_archive(conn, table):
+        return table
+    return f'(SELECT {cols} FROM main.{table} UNION ALL SELECT {cols} FROM archive.{table})'
+
+def archive_until(conn, table: str):
+    """Самое позднее время строк table в архиве (None — архив пуст)."""
+    row = conn.execute('SELECT until FROM archive_edges WHERE tbl = ?', (table,)).fetchone()
+    return row[0] if row else None
+
+def archive_edges_reset(conn):
+    """Границы заново по содержимому архива: миграция и restore (бэкап main старше архива)."""
+    for table, expr in ARCHIVE_EDGE.items():
+        until = conn.execute(f'SELECT max({expr}) FROM archive.{table}').fetchone()[0] if has_archive(conn, table) else None
+        conn.execute('INSERT OR REPLACE INTO archive_edges (tbl, until) VALUES (?, ?)', (table, until))
+
+def archive_cutoff(now: datetime, days: int = ARCHIVE_AFTER_DAYS) -> datetime:
+    """Граница холодных данных — начало месяца: месяц уезжает в архив целиком."""
+    return (now - timedelta(days=days)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+# Пачка переезжает двумя транзакциями: копия в архив, затем удаление из main
+# тех строк, чья копия в архиве совпадает целиком. Коммит двух файлов в WAL не
+# атомарен: после сбоя между ними возможен дубль, но не потеря. Строка с
+# наибольшим id остаётся в main, чтобы новые rowid не совпали с архивными.
+def archive_copy(conn, table: str, cutoff: str, after_id: int, max_id: int, limit: int = ARCHIVE_BATCH):
+    """Следующая пачка холодных строк после after_id -> (id пачки, id, скопированные сейчас)."""
+    col, cold, _ = ARCHIVE_TABLES[table]
+    ids = [r[0] for r in conn.execute(
+        f'SELECT id FROM main.{table} WHERE id > ? AND id < ? AND {col} < ? AND {cold} ORDER BY id LIMIT ?',
+        (after_id, max_id, cutoff, limit))]
+    if not ids:
+        return [], []
+    marks = ','.join('?' * len(ids))
+    have = {r[0] for r in conn.execute(f'SELECT id FROM archive.{table} WHERE id IN ({marks})', ids)}
+    copied = [i for i in ids if i not in have]
+    if copied:
+        cols = ', '.join(r[1] for r in conn.execute(f'PRAGMA main.table_info({table})'))
+        marks = ','.join('?' * len(copied))
+        conn.execute(f'INSERT INTO archive.{table} ({cols}) SELECT {cols} FROM main.{table} WHERE id IN ({marks})', copied)
+        # граница сдвигается в той же транзакции, что и копия: читатель не пропустит её строки
+        edge = conn.execute(f'SELECT max({ARCHIVE_EDGE[table]}) FROM main.{table} WHERE id IN ({marks})', copied).fetchone()[0]
+        conn.execute('UPDATE archive_edges SET until = ? WHERE tbl = ? AND (until IS NULL OR until < ?)', (edge, table, edge))
+    return ids, copied
+
+def archive_drop(conn, table: str, ids=None, copied=()) -> int:
+    """Удаляет из main строки ids (None — все), совпадающие с архивной копией.
+    Копии из copied, чья строка в main за это время изменилась, убираются из архива."""
+    same = ' AND '.join(f'a.{r[1]} IS {table}.{r[1]}' for r in conn.execute(f'PRAGMA main.table_info({table})'))
+    where, params = '', []
+    if ids is not None:
+        where, params = f"id IN ({','.join('?' * len(ids))}) AND ", list(ids)
+    conn.execute('UPDATE archive_guard SET moving = 1')
+    moved = conn.execute(f'DELETE FROM main.{table} WHERE {where}'
+                         f'EXISTS (SELECT 1 FROM archive.{table} a WHERE a.id = {table}.id AND {same})', params).rowcount
+    conn.execute('UPDATE archive_guard SET moving = 0')
+    if copied:
+        marks = ','.join('?' * len(copied))
+        conn.execute(f'DELETE FROM archive.{table} WHERE id IN ({marks}) '
+                     f'AND id IN (SELECT id FROM main.{table} WHERE id IN ({marks}))', list(copied) * 2)
+    return moved
+
+def archive_forget(conn, client_id: int):
+    """Удаление клиента: архивные строки вычитаются из trainer_stats, как это
+    сделали бы триггеры удаления в main, и удаляются. Журнал и stats_client_month
+    клиента чистят триггеры удаления самого клиента."""
+    for period in (STATS_WEEK, STATS_MONTH):
+        conn.execute(f'''INSERT INTO trainer_stats (trainer_id, period, planned, completed)
+            SELECT c.trainer_id, {period.format(dt='s.datetime')}, -count(*), -sum(s.status = 'completed')
+            FROM archive.sessions s JOIN clients c ON c.id = s.client_id
+            WHERE s.client_id = ? AND c.trainer_id IS NOT NULL GROUP BY 1, 2
+            ON CONFLICT (trainer_id, period) DO UPDATE SET planned = planned + excluded.planned,
+                completed = completed + excluded.completed''', (client_id,))
+    conn.execute(f'''INSERT INTO trainer_stats (trainer_id, period, revenue)
+        SELECT c.trainer_id, {STATS_MONTH.format(dt='p.date')}, -total(p.amount)
+        FROM archive.payments p JOIN clients c ON c.id = p.client_id
+        WHERE p.client_id = ? AND c.trainer_id IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT (trainer_id, period) DO UPDATE SET revenue = revenue + excluded.revenue''', (client_id,))
+    for table in ARCHIVE_TABLES:
+        conn.execute(f'DELETE FROM archive.{table} WHERE client_id = ?', (client_id,))
+
+# --- DB access ---
+class Database:
+    """SQLite вне event loop: все записи идут через один поток-писатель
+    (очередь single-thread executor'а), чтения — через пул read-only соединений,
+    чекпойнты и бэкапы — через свой поток и соединение.
+
+    Каждый запрос получает свой курсор, так что корутины не перетирают
+    результаты друг друга."""
+
+    def __init__(self, path: str, readers: int = 4, pragmas: dict = DB_PRAGMAS):
+        self.path = path
+        self.pragmas = pragmas
+        self.writer_conn = apply_pragmas(
+            sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, factory=TimedConnection), pragmas)
+        attach_archive(self.writer_conn, archive_path(path))
+        apply_pragmas(self.writer_conn, {f'archive.{k}': v for k, v in pragmas.items() if k in ('journal_mode', 'synchronous')})
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        # долгие выгрузки — отдельно, чтобы не занимать читателей обработчиков
+        self._bulk = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-bulk')
+        self._maint = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-maint')
+        self._maint_conn = None
+        self._local = threading.local()
+        self._reader_conns = []
+        self._lock = threading.Lock()
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        rc = getattr(self._local, 'conn', None)
+        if rc is None:
+            uri = Path(self.path).absolute().as_uri() + '?mode=ro'
+            rc = sqlite3.connect(uri, uri=True, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, factory=TimedConnection)
+            apply_pragmas(rc, {k: v for k, v in self.pragmas.items() if k in READER_PRAGMAS})
+            attach_archive(rc, archive_path(self.path), readonly=True)
+            self._local.conn = rc
+            with self._lock:
+                self._reader_conns.append(rc)
+        return rc
+
+    async def _run(self, pool, fn, *args):
+        # контекст копируется, чтобы запросы попали в sql_trace своего апдейта
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(pool, ctx.run, fn, *args)
+
+    def _fetch(self, sql, params, one):
+        c = self._reader_conn().execute(sql, params)
+        try:
+            return c.fetchone() if one else c.fetchall()
+        finally:
+            c.close()
+
+    def _read(self, fn, args):
+        return fn(self._reader_conn(), *args)
+
+    def _maintain(self, fn, args):
+        if self._maint_conn is None:
+            self._maint_conn = attach_archive(
+                sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False), archive_path(self.path))
+        return fn(self._maint_conn, *args)
+
+    def _write(self, fn, args):
+        try:
+            result = fn(self.writer_conn, *args)
+            self.writer_conn.commit()
+            return result
+        except Exception:
+            self.writer_conn.rollback()
+            raise
+
+    async def fetchone(self, sql: str, params=()):
+        return await self._run(self._readers, self._fetch, sql, params, True)
+
+    async def fetchall(self, sql: str, params=()):
+        return await self._run(self._readers, self._fetch, sql, params, False)
+
+    async def read(self, fn, *args):
+        """fn(conn, *args) в потоке-читателе."""
+        return await self._run(self._readers, self._read, fn, args)
+
+    async def read_bulk(self, fn, *args):
+        """fn(conn, *args) в потоке для долгих чтений (экспорт), по одному за раз."""
+        return await self._run(self._bulk, self._read, fn, args)
+
+    async def maintenance(self, fn, *args):
+        """fn(conn, *args) в потоке обслуживания (чекпойнт, бэкап), не занимая писателя."""
+        return await self._run(self._maint, self._maintain, fn, args)
+
+    async def transaction(self, fn, *args):
+        """fn(conn, *args) в потоке-писателе, одной транзакцией (commit/rollback)."""
+        return await self._run(self._writer, self._write, fn, args)
+
+    async def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        return await self.transaction(lambda c: c.execute(sql, params))
+
+    async def executemany(self, sql: str, seq) -> sqlite3.Cursor:
+        return await self.transaction(lambda c: c.executemany(sql, seq))
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self._bulk.shutdown(wait=True)
+        self._maint.shutdown(wait=True)
+        for rc in self._reader_conns:
+            rc.close()
+        if self._maint_conn is not None:
+            self._maint_conn.close()
+        self.writer_conn.close()
+
+# --- Schema migrations (PRAGMA user_version) ---
+# Каждый шаг — callable(conn) или кортеж SQL-выражений; применяется в своей
+# транзакции, после чего user_version = номер шага. Новые шаги — только в конец.
+
+def _add_missing_columns(conn, table: str, columns):
+    have = {r[1] for r in conn.execute(f'PRAGMA table_info({table})')}
+    for name, decl in columns:
+        if name not in have:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {decl}')
+
+def _migration_base_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS trainers (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER UNIQUE,
+        name TEXT,
+        created_at TEXT,
+        city TEXT,
+        pricing TEXT,
+        tg_id INTEGER,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        invite_code TEXT
+    )''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS clients (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        phone TEXT,
+        notes TEXT,
+        balance REAL DEFAULT 0,
+        chat_id INTEGER,
+        trainer_id INTEGER,
+        status TEXT DEFAULT 'approved',
+        tg_id INTEGER,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        FOREIGN KEY(trainer_id) REFERENCES trainers(id)
+    )''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+        id INTEGER PRIMARY KEY,
+        client_id INTEGER,
+        datetime TEXT,
+        status TEXT DEFAULT 'planned',
+        comment TEXT,
+        remind24_sent INTEGER DEFAULT 0,
+        remind2_sent INTEGER DEFAULT 0,
+        FOREIGN KEY(client_id) REFERENCES clients(id)
+    )''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY,
+        client_id INTEGER,
+        amount REAL,
+        date TEXT,
+        note TEXT,
+        FOREIGN KEY(client_id) REFERENCES clients(id)
+    )''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS tariffs (
+        id INTEGER PRIMARY KEY,
+        trainer_id INTEGER,
+        title TEXT,
+        description TEXT,
+        price REAL,
+        FOREIGN KEY(trainer_id) REFERENCES trainers(id)
+    )''')
+    # Колонки, которые раньше добавлялись «мягкими» ALTER'ами
+    _add_missing_columns(conn, 'trainers', [
+        ('city', 'TEXT'), ('pricing', 'TEXT'), ('tg_id', 'INTEGER'), ('username', 'TEXT'),
+        ('first_name', 'TEXT'), ('last_name', 'TEXT'), ('invite_code', 'TEXT'),
+    ])
+    _add_missing_columns(conn, 'clients', [
+        ('tg_id', 'INTEGER'), ('username', 'TEXT'), ('first_name', 'TEXT'), ('last_name', 'TEXT'),
+    ])
+
+# Полнотекстовый поиск: contentless FTS5 (хранится только индекс), в который
+# триггеры пишут нормализованные значения (ё→е, телефон — только цифры).
+# unicode61 сам приводит регистр, в том числе кириллицу.
+def _fts_norm(col: str) -> str:
+    return f"replace(replace(coalesce({col}, ''), 'ё', 'е'), 'Ё', 'Е')"
+
+def _fts_digits(col: str) -> str:
+    expr = f"coalesce({col}, '')"
+    for ch in (' ', '-', '(', ')', '+'):
+        expr = f"replace({expr}, '{ch}', '')"
+    # 8XXXXXXXXXX и +7XXXXXXXXXX — один и тот же номер
+    return f"(CASE WHEN length({expr}) = 11 AND substr({expr}, 1, 1) = '8' THEN '7' || substr({expr}, 2) ELSE {expr} END)"
+
+def _fts_sync(conn, table: str, fts: str, exprs: dict, watch: str):
+    """Триггеры синхронизации table -> fts и первичное наполнение. exprs: колонка fts -> выражение от {r}."""
+    cols = ', '.join(exprs)
+    def vals(r): return ', '.join(e.format(r=r) for e in exprs.values())
+    conn.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({cols}, content='', tokenize='unicode61')")
+    conn.execute(f"""CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN
+        INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {vals('new')}); END""")
+    conn.execute(f"""CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN
+        INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {vals('old')}); END""")
+    conn.execute(f"""CREATE TRIGGER {fts}_au AFTER UPDATE OF {watch} ON {table} BEGIN
+        INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {vals('old')});
+        INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {vals('new')}); END""")
+    conn.execute(f"INSERT INTO {fts}(rowid, {cols}) SELECT id, {vals(table)} FROM {table}")
+
+def _migration_fts(conn):
+    _fts_sync(conn, 'trainers', 'trainers_fts', {
+        'name': _fts_norm('{r}.name'),
+        'city': _fts_norm('{r}.city'),
+        'username': "coalesce({r}.username, '')",
+    }, watch='name, city, username')
+    # owner = 't<trainer_id>': поиск клиентов ограничивается тренером внутри самого индекса
+    _fts_sync(conn, 'clients', 'clients_fts', {
+        'name': _fts_norm('{r}.name'),
+        'phone': _fts_digits('{r}.phone'),
+        'username': "coalesce({r}.username, '')",
+        'notes': _fts_norm('{r}.notes'),
+        'owner': "'t' || coalesce({r}.trainer_id, 0)",
+    }, watch='name, phone, username, notes, trainer_id')
+
+# Статистика тренера: агрегаты по неделям ('W' + понедельник) и месяцам
+# ('M' + YYYY-MM) и месячная активность клиентов. Поддерживаются триггерами
+# на sessions/payments, кнопка читает только их.
+STATS_WEEK = "'W' || date({dt}, '-6 days', 'weekday 1')"
+STATS_MONTH = "'M' || substr({dt}, 1, 7)"
+
+def _stats_upsert(period: str, client: str, **deltas) -> str:
+    cols = ', '.join(deltas)
+    sets = ', '.join(f'{c} = {c} + excluded.{c}' for c in deltas)
+    return (f"INSERT INTO trainer_stats (trainer_id, period, {cols}) "
+            f"SELECT trainer_id, {period}, {', '.join(deltas.values())} FROM clients "
+            f"WHERE id = {client} AND trainer_id IS NOT NULL "
+            f"ON CONFLICT (trainer_id, period) DO UPDATE SET {sets};")
+
+def _stats_sessions(r: str, sign: str = '') -> str:
+    done = f"{sign}({r}.status = 'completed')"
+    return ''.join(_stats_upsert(p.format(dt=f'{r}.datetime'), f'{r}.client_id', planned=f'{sign}1', completed=done)
+                   for p in (STATS_WEEK, STATS_MONTH))
+
+def _stats_active(r: str) -> str:
+    return (f"INSERT OR IGNORE INTO stats_client_month (trainer_id, month, client_id) "
+            f"SELECT trainer_id, substr({r}.datetime, 1, 7), {r}.client_id FROM clients "
+            f"WHERE id = {r}.client_id AND trainer_id IS NOT NULL AND {r}.status = 'completed';")
+
+def _stats_inactive(r: str) -> str:
+    # месяц, в котором у клиента не осталось проведённых тренировок
+    month = f"substr({r}.datetime, 1, 7)"
+    return (f"DELETE FROM stats_client_month WHERE client_id = {r}.client_id AND month = {month} "
+            f"AND {r}.status = 'completed' AND NOT EXISTS (SELECT 1 FROM sessions WHERE client_id = {r}.client_id "
+            f"AND status = 'completed' AND datetime BETWEEN {month} AND {month} || '~');")
+
+def rebuild_stats(conn):
+    """Пересчёт агрегатов статистики по всей истории (миграция, ручная починка),
+    включая архив, если он уже есть."""
+    sessions = archive_union(conn, 'sessions', 'client_id, datetime, status')
+    payments = archive_union(conn, 'payments', 'client_id, date, amount')
+    conn.execute('DELETE FROM trainer_stats')
+    conn.execute('DELETE FROM stats_client_month')
+    for period in (STATS_WEEK, STATS_MONTH):
+        conn.execute(f'''INSERT INTO trainer_stats (trainer_id, period, planned, completed)
+            SELECT c.trainer_id, {period.format(dt='s.datetime')}, count(*), sum(s.status = 'completed')
+            FROM {sessions} s JOIN clients c ON c.id = s.client_id
+            WHERE c.trainer_id IS NOT NULL GROUP BY 1, 2''')
+    conn.execute(f'''INSERT INTO trainer_stats (trainer_id, period, revenue)
+        SELECT c.trainer_id, {STATS_MONTH.format(dt='p.date')}, sum(p.amount)
+        FROM {payments} p JOIN clients c ON c.id = p.client_id
+        WHERE c.trainer_id IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT (trainer_id, period) DO UPDATE SET revenue = excluded.revenue''')
+    conn.execute(f'''INSERT OR IGNORE INTO stats_client_month (trainer_id, month, client_id)
+        SELECT c.trainer_id, substr(s.datetime, 1, 7), s.client_id
+        FROM {sessions} s JOIN clients c ON c.id = s.client_id
+        WHERE c.trainer_id IS NOT NULL AND s.status = 'completed' ''')
+
+def _migration_stats(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS trainer_stats (
+        trainer_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        planned INTEGER NOT NULL DEFAULT 0,
+        completed INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (trainer_id, period)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS stats_client_month (
+        trainer_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        client_id INTEGER NOT NULL,
+        PRIMARY KEY (trainer_id, month, client_id)
+    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stats_client_month_client ON stats_client_month(client_id)')
+    conn.execute(f"CREATE TRIGGER sessions_stats_ai AFTER INSERT ON sessions BEGIN "
+                 f"{_stats_sessions('new')} {_stats_active('new')} END")
+    conn.execute(f"CREATE TRIGGER sessions_stats_au AFTER UPDATE OF status, datetime ON sessions "
+                 f"WHEN old.status IS NOT new.status OR old.datetime IS NOT new.datetime BEGIN "
+                 f"{_stats_sessions('old', '-')} {_stats_inactive('old')} {_stats_sessions('new')} {_stats_active('new')} END")
+    conn.execute(f"CREATE TRIGGER sessions_stats_ad AFTER DELETE ON sessions BEGIN "
+                 f"{_stats_sessions('old', '-')} {_stats_inactive('old')} END")
+    conn.execute(f"CREATE TRIGGER payments_stats_ai AFTER INSERT ON payments BEGIN "
+                 f"{_stats_upsert(STATS_MONTH.format(dt='new.date'), 'new.client_id', revenue='new.amount')} END")
+    conn.execute(f"CREATE TRIGGER payments_stats_ad AFTER DELETE ON payments BEGIN "
+                 f"{_stats_upsert(STATS_MONTH.format(dt='old.date'), 'old.client_id', revenue='-old.amount')} END")
+    conn.execute('CREATE TRIGGER clients_stats_ad AFTER DELETE ON clients BEGIN '
+                 'DELETE FROM stats_client_month WHERE client_id = old.id; END')
+    rebuild_stats(conn)
+
+# Журнал движения средств: платёж — кредит, проведённая тренировка — дебет по
+# цене тарифа клиента. clients.balance — материализованная сумма журнала,
+# её меняют только триггеры ниже.
+def _ledger_post(kind: str, ref: str, client: str, amount_sql: str, at: str) -> str:
+    return (f"INSERT INTO ledger (client_id, kind, ref_id, amount, created_at) "
+            f"SELECT {client}, '{kind}', {ref}, amount, {at} FROM ({amount_sql}) WHERE amount IS NOT NULL; "
+            f"UPDATE clients SET balance = round(coalesce(balance, 0) + coalesce((SELECT amount FROM ledger "
+            f"WHERE kind = '{kind}' AND ref_id = {ref}), 0), 2) WHERE id = {client};")
+
+def _ledger_revert(kind: str, ref: str, client: str) -> str:
+    return (f"UPDATE clients SET balance = round(coalesce(balance, 0) - coalesce((SELECT amount FROM ledger "
+            f"WHERE kind = '{kind}' AND ref_id = {ref}), 0), 2) WHERE id = {client}; "
+            f"DELETE FROM ledger WHERE kind = '{kind}' AND ref_id = {ref};")
+
+def _session_price(r: str) -> str:
+    return (f"SELECT -t.price AS amount FROM clients c JOIN tariffs t ON t.id = c.tariff_id "
+            f"AND t.trainer_id = c.trainer_id WHERE c.id = {r}.client_id")
+
+def _migration_ledger(conn):
+    _add_missing_columns(conn, 'clients', [('tariff_id', 'INTEGER')])
+    conn.execute('''CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY,
+        client_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        ref_id INTEGER,
+        amount REAL NOT NULL,
+        created_at TEXT
+    )''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_ledger_ref ON ledger(kind, ref_id) WHERE ref_id IS NOT NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ledger_client ON ledger(client_id, amount)')
+    # должники тренера, по убыванию долга: в индексе только отрицательные балансы
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_clients_debtors ON clients(trainer_id, balance) WHERE balance < 0')
+    done = "new.status = 'completed'"
+    conn.execute(f"CREATE TRIGGER payments_ledger_ai AFTER INSERT ON payments BEGIN "
+                 f"{_ledger_post('payment', 'new.id', 'new.client_id', 'SELECT new.amount AS amount', 'new.date')} END")
+    conn.execute(f"CREATE TRIGGER payments_ledger_ad AFTER DELETE ON payments BEGIN "
+                 f"{_ledger_revert('payment', 'old.id', 'old.client_id')} END")
+    conn.execute(f"CREATE TRIGGER sessions_ledger_ai AFTER INSERT ON sessions WHEN {done} BEGIN "
+                 f"{_ledger_post('session', 'new.id', 'new.client_id', _session_price('new'), 'new.datetime')} END")
+    conn.execute(f"CREATE TRIGGER sessions_ledger_done AFTER UPDATE OF status ON sessions "
+                 f"WHEN {done} AND old.status IS NOT 'completed' BEGIN "
+                 f"{_ledger_post('session', 'new.id', 'new.client_id', _session_price('new'), 'new.datetime')} END")
+    conn.execute(f"CREATE TRIGGER sessions_ledger_undone AFTER UPDATE OF status ON sessions "
+                 f"WHEN old.status = 'completed' AND new.status IS NOT 'completed' BEGIN "
+                 f"{_ledger_revert('session', 'old.id', 'old.client_id')} END")
+    conn.execute(f"CREATE TRIGGER sessions_ledger_ad AFTER DELETE ON sessions WHEN old.status = 'completed' BEGIN "
+                 f"{_ledger_revert('session', 'old.id', 'old.client_id')} END")
+    conn.execute('CREATE TRIGGER clients_ledger_ad AFTER DELETE ON clients BEGIN '
+                 'DELETE FROM ledger WHERE client_id = old.id; END')
+    # история: платежи — в журнал; остаток старого баланса — одной корректировкой
+    conn.execute("INSERT INTO ledger (client_id, kind, ref_id, amount, created_at) "
+                 "SELECT client_id, 'payment', id, amount, date FROM payments WHERE amount IS NOT NULL")
+    conn.execute('''INSERT INTO ledger (client_id, kind, amount, created_at)
+        SELECT c.id, 'adjust', round(coalesce(c.balance, 0) - coalesce(sum(l.amount), 0), 2), strftime('%Y-%m-%dT%H:%M:%S', 'now')
+        FROM clients c LEFT JOIN ledger l ON l.client_id = c.id
+        GROUP BY c.id HAVING abs(coalesce(c.balance, 0) - coalesce(sum(l.amount), 0)) >= 0.005''')
+
+# Бронирование: у тренера рабочие часы (минуты от полуночи) и длительность
+# тренировки по умолчанию, у тренировки — своя длительность и тренер, с которым
+# она назначена (проставляет триггер). Пересечения ищутся диапазоном по индексу
+# (trainer_id, datetime): начало в (start - MAX_SESSION_MINUTES, end).
+def _migration_booking(conn):
+    _add_missing_columns(conn, 'trainers', [
+        ('work_start', 'INTEGER DEFAULT 540'), ('work_end', 'INTEGER DEFAULT 1260'),
+        ('session_minutes', 'INTEGER DEFAULT 60'),
+    ])
+    _add_missing_columns(conn, 'sessions', [('duration', 'INTEGER DEFAULT 60'), ('trainer_id', 'INTEGER')])
+    conn.execute('UPDATE sessions SET trainer_id = (SELECT trainer_id FROM clients WHERE id = sessions.client_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_trainer_dt ON sessions(trainer_id, datetime, duration, status)')
+    conn.execute('CREATE TRIGGER sessions_trainer_ai AFTER INSERT ON sessions WHEN new.trainer_id IS NULL BEGIN '
+                 'UPDATE sessions SET trainer_id = (SELECT trainer_id FROM clients WHERE id = new.client_id) '
+                 'WHERE id = new.id; END')
+
+# Серии: правило повторения (RRULE без DTSTART/UNTIL) + начало и конец серии.
+# Повторения не хранятся, а разворачиваются на нужное окно. Строка в sessions
+# появляется у повторения, только когда оно нужно само по себе: проведено или
+# подходит срок напоминания (series_id + occurrence — исходное время); отмена
+# повторения — строка в series_skips.
+def _migration_series(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS series (
+        id INTEGER PRIMARY KEY,
+        client_id INTEGER NOT NULL,
+        trainer_id INTEGER NOT NULL,
+        rule TEXT NOT NULL,
+        dtstart TEXT NOT NULL,
+        until TEXT,
+        duration INTEGER NOT NULL DEFAULT 60,
+        comment TEXT
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_series_trainer ON series(trainer_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_series_client ON series(client_id)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS series_skips (
+        series_id INTEGER NOT NULL,
+        occurrence TEXT NOT NULL,
+        PRIMARY KEY (series_id, occurrence)
+    ) WITHOUT ROWID''')
+    _add_missing_columns(conn, 'sessions', [('series_id', 'INTEGER'), ('occurrence', 'TEXT')])
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_series_occ ON sessions(series_id, occurrence) '
+                 'WHERE series_id IS NOT NULL')
+    conn.execute('CREATE TRIGGER series_ad AFTER DELETE ON series BEGIN '
+                 'DELETE FROM series_skips WHERE series_id = old.id; END')
+    conn.execute('CREATE TRIGGER clients_series_ad AFTER DELETE ON clients BEGIN '
+                 'DELETE FROM series WHERE client_id = old.id; END')
+
+# Архивация удаляет строки из main под флагом archive_guard.moving: триггеры
+# удаления баланса, журнала и статистики его проверяют — переезд в архив не
+# отменяет платёж и не вычитает тренировку из агрегатов.
+ARCHIVE_GUARD = '(SELECT moving FROM archive_guard) = 0'
+GUARDED_TRIGGERS = ('sessions_stats_ad', 'sessions_ledger_ad', 'payments_stats_ad', 'payments_ledger_ad')
+
+def _migration_archive(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS archive_guard (moving INTEGER NOT NULL)')
+    conn.execute('INSERT INTO archive_guard (moving) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM archive_guard)')
+    for name in GUARDED_TRIGGERS:
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).fetchone()[0]
+        head, body = sql.split(' BEGIN ', 1)
+        head += f" AND {ARCHIVE_GUARD}" if ' WHEN ' in head else f" WHEN {ARCHIVE_GUARD}"
+        conn.execute(f'DROP TRIGGER {name}')
+        conn.execute(f'{head} BEGIN {body}')
+
+def _migration_archive_edges(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS archive_edges (tbl TEXT PRIMARY KEY, until TEXT) WITHOUT ROWID')
+    archive_edges_reset(conn)
+
+# Единый вид телефона клиента (+7XXXXXXXXXX): так пишет импорт и по нему ищет
+# дубли; всё, что сохраняет введённый телефон, пропускает его через normalize_phone.
+def normalize_phone(raw: str) -> str:
+    """'+7 (916) 123-45-67', '89161234567', '9161234567' -> '+79161234567'; '' для пустого; ValueError — не номер."""
+    raw = raw.strip()
+    if not raw:
+        return ''
+    if re.search(r'[^\d\s()+.-]', raw):
+        raise ValueError(raw)
+    digits = re.sub(r'\D', '', raw)
+    if len(digits) == 11 and digits[0] in '78' and not (raw.startswith('+') and digits[0] == '8'):
+        return '+7' + digits[1:]
+    if len(digits) == 10 and digits[0] == '9' and not raw.startswith('+'):
+        return '+7' + digits
+    if raw.startswith('+') and 10 <= len(digits) <= 15:
+        return '+' + digits
+    raise ValueError(raw)
+
+def _migration_phones(conn):
+    """Телефоны, сохранённые как введены ('8 916 …', '+7 (916) …'), — к виду
+    normalize_phone, иначе импорт не находит по ним дублей. Нераспознанные не трогаем."""
+    fixed = []
+    for cid, phone in conn.execute("SELECT id, phone FROM clients WHERE phone <> ''").fetchall():
+        try:
+            norm = normalize_phone(phone)
+        except ValueError:
+            continue
+        if norm != phone:
+            fixed.append((norm, cid))
+    conn.executemany('UPDATE clients SET phone = ? WHERE id = ?', fixed)
+
+MIGRATIONS = [
+    # 1
+    _migration_base_schema,
+    # 2: индексы под горячие выборки
+    (
+        # get_client_by_chat / get_role: покрывающий для id, trainer_id, status
+        'CREATE INDEX IF NOT EXISTS idx_clients_chat ON clients(chat_id, trainer_id, status)',
+        # списки клиентов/заявок тренера (ORDER BY id идёт по rowid внутри ключа)
+        'CREATE INDEX IF NOT EXISTS idx_clients_trainer_status ON clients(trainer_id, status)',
+        'CREATE INDEX IF NOT EXISTS idx_trainers_city ON trainers(city)',
+        'CREATE INDEX IF NOT EXISTS idx_trainers_invite ON trainers(invite_code) WHERE invite_code IS NOT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_client_dt ON sessions(client_id, datetime)',
+        # напоминания: в индексе только ещё не отправленные
+        "CREATE INDEX IF NOT EXISTS idx_sessions_remind24 ON sessions(datetime) WHERE status = 'planned' AND remind24_sent = 0",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_remind2 ON sessions(datetime) WHERE status = 'planned' AND remind2_sent = 0",
+        'CREATE INDEX IF NOT EXISTS idx_payments_client_date ON payments(client_id, date)',
+        'CREATE INDEX IF NOT EXISTS idx_tariffs_trainer ON tariffs(trainer_id)',
+    ),
+    # 3
+    _migration_fts,
+    # 4: кэш геокодера (query -> JSON-список городов)
+    (
+        'CREATE TABLE IF NOT EXISTS geocode_cache (query TEXT PRIMARY KEY, cities TEXT, fetched_at REAL)',
+    ),
+    # 5: FSM-состояния
+    (
+        '''CREATE TABLE IF NOT EXISTS fsm_state (
+            chat TEXT, user TEXT, state TEXT, data TEXT, bucket TEXT, updated_at REAL,
+            PRIMARY KEY (chat, user)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at)',
+    ),
+    # 6
+    _migration_stats,
+    # 7
+    _migration_ledger,
+    # 8: дедупликация импорта по телефону внутри тренера
+    (
+        "CREATE INDEX IF NOT EXISTS idx_clients_trainer_phone ON clients(trainer_id, phone) WHERE phone <> ''",
+    ),
+    # 9
+    _migration_booking,
+    # 10
+    _migration_series,
+    # 11
+    _migration_archive,
+    # 12
+    _migration_phones,
+    # 13
+    _migration_archive_edges,
+]
+
+def migrate(conn: sqlite3.Connection, target: int = None) -> int:
+    """Шаги MIGRATIONS до target; архив подключается рядом с базой, его таблицы
+    догоняют колонки main, только когда схема дошла до последней версии."""
+    target = len(MIGRATIONS) if target is None else target
+    attach_archive(conn, archive_path(conn.execute('PRAGMA database_list').fetchone()[2]))
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    while version < target:
+        step = MIGRATIONS[version]
+        conn.execute('BEGIN')
+        try:
+            if callable(step):
+                step(conn)
+            else:
+                for sql in step:
+                    conn.execute(sql)
+            version += 1
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info('DB migrated to version %s', version)
+    if version == len(MIGRATIONS):
+        archive_schema(conn)
+    return version
+
+# --- DB init ---
+db = Database(DB_FILE)
+migrate(db.writer_conn)
+
+# --- FSM storage ---
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_TTL = int(os.getenv('FSM_TTL', str(24 * 3600)))
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '1'))
+
+def _fsm_default(o):
+    if isinstance(o, datetime):
+        return {'$dt': o.isoformat()}
+    raise TypeError(f'{type(o).__name__} is not serializable in FSM data')
+
+def _fsm_hook(d):
+    return datetime.fromisoformat(d['$dt']) if len(d) == 1 and '$dt' in d else d
+
+def fsm_dumps(value: dict):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_fsm_default) if value else None
+
+def fsm_loads(text):
+    return json.loads(text, object_hook=_fsm_hook) if text else {}
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в таблице fsm_state.
+
+    flush_interval > 0 — write-behind: изменения копятся в памяти и
+    сбрасываются одной транзакцией раз в flush_interval секунд (и при close).
+    Так можно, пока апдейты одного чата обрабатывает один процесс.
+    flush_interval = 0 — запись сразу и без кэша: можно запускать несколько
+    воркеров на одной БД (кэш ролей IdentityCache тогда живёт IDENTITY_CACHE_TTL секунд).
+    Незавершённые формы старше ttl секунд считаются брошенными и удаляются.
+    datetime в данных (AddSession.when) сохраняется как {"$dt": iso}."""
+
+    CACHE_IDLE = 300
+
+    def __init__(self, database: Database, ttl: int = FSM_TTL, flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.db = database
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._cache = {}
+        self._dirty = set()
+        self._flusher = None
+        self._last_purge = 0.0
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    async def _get(self, key) -> dict:
+        rec = self._cache.get(key)
+        if rec is None:
+            row = await self.db.fetchone(
+                'SELECT state, data, bucket, updated_at FROM fsm_state WHERE chat = ? AND user = ?', key)
+            rec = {'state': None, 'data': {}, 'bucket': {}, 'updated': time.time()}
+            if row and time.time() - row[3] < self.ttl:
+                rec = {'state': row[0], 'data': fsm_loads(row[1]), 'bucket': fsm_loads(row[2]), 'updated': row[3]}
+            if self.flush_interval > 0:
+                self._cache[key] = rec
+        elif time.time() - rec['updated'] >= self.ttl:
+            rec.update(state=None, data={}, bucket={})
+        return rec
+
+    async def _put(self, key, rec: dict):
+        rec['updated'] = time.time()
+        if self.flush_interval > 0:
+            self._cache[key] = rec
+            self._dirty.add(key)
+            if self._flusher is None:
+                self._flusher = asyncio.create_task(self._flush_loop())
+        else:
+            await self.db.transaction(self._write, [(key, rec)])
+
+    @staticmethod
+    def _write(conn, items):
+        upserts, deletes = [], []
+        for key, rec in items:
+            if rec['state'] is None and not rec['data'] and not rec['bucket']:
+                deletes.append(key)
+            else:
+                upserts.append(key + (rec['state'], fsm_dumps(rec['data']), fsm_dumps(rec['bucket']), rec['updated']))
+        if deletes:
+            conn.executemany('DELETE FROM fsm_state WHERE chat = ? AND user = ?', deletes)
+        if upserts:
+            conn.executemany('INSERT OR REPLACE INTO fsm_state (chat, user, state, data, bucket, updated_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', upserts)
+
+    async def flush(self):
+        now = time.time()
+        if self._dirty:
+            # снимок: данные сериализуются в потоке-писателе
+            items = [(key, copy.deepcopy(self._cache[key])) for key in self._dirty]
+            self._dirty.clear()
+            await self.db.transaction(self._write, items)
+        if now - self._last_purge > 60:
+            self._last_purge = now
+            await self.db.execute('DELETE FROM fsm_state WHERE updated_at < ?', (now - self.ttl,))
+            self._cache = {k: r for k, r in self._cache.items()
+                           if k in self._dirty or now - r['updated'] < min(self.ttl, self.CACHE_IDLE)}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('FSM storage flush failed')
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        if self._dirty:
+            await self.flush()
+
+    async def wait_closed(self):
         pass
-conn.commit()
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        rec = await self._get(self._key(chat, user))
+        return rec['state'] if rec['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> dict:
+        return copy.deepcopy((await self._get(self._key(chat, user)))['data'])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key = self._key(chat, user)
+        rec = await self._get(key)
+        rec['state'] = self.resolve_state(state)
+        await self._put(key, rec)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key = self._key(chat, user)
+        rec = await self._get(key)
+        rec['data'] = copy.deepcopy(data or {})
+        await self._put(key, rec)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key = self._key(chat, user)
+        rec = await self._get(key)
+        rec['data'].update(data or {}, **kwargs)
+        await self._put(key, rec)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> dict:
+        return copy.deepcopy((await self._get(self._key(chat, user)))['bucket'])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key = self._key(chat, user)
+        rec = await self._get(key)
+        rec['bucket'] = copy.deepcopy(bucket or {})
+        await self._put(key, rec)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key = self._key(chat, user)
+        rec = await self._get(key)
+        rec['bucket'].update(bucket or {}, **kwargs)
+        await self._put(key, rec)
+
+dp = Dispatcher(bot, storage=SQLiteStorage(db) if FSM_STORAGE == 'sqlite' else MemoryStorage())
+dp.middleware.setup(HandlerMetrics())
+if PROFILE_SLOW_MS:
+    dp.middleware.setup(SlowUpdateProfiler())
+
+# --- Callback router ---
+# callback_data = "<prefix>[:<поле>...]". Префикс — стабильная часть
+# (несовместимое изменение полей = новый префикс); поля кодируются и
+# разбираются кодеками маршрута один раз. datetime, формат v1: "~" + минуты
+# от эпохи в base36 (8 символов вместо 19); старые ISO-кнопки тоже читаются.
+CALLBACK_LIMIT = 64
+_B36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def _dt_encode(dt: datetime) -> str:
+    n = int((dt - datetime(1970, 1, 1)).total_seconds() // 60)
+    out = ''
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36[r] + out
+        if not n:
+            return '~' + out
+
+def _dt_decode(s: str) -> datetime:
+    if s.startswith('~'):
+        return datetime(1970, 1, 1) + timedelta(minutes=int(s[1:], 36))
+    return datetime.fromisoformat(s)
+
+# (encode, decode)
+CB_INT = (str, int)
+CB_STR = (str, str)
+CB_FLOAT = (repr, float)
+CB_DT = (_dt_encode, _dt_decode)
+
+def cb(prefix: str, *values, fields=None) -> str:
+    """Собирает callback_data; ValueError, если не влезает в 64 байта."""
+    codecs = fields or [CB_DT if isinstance(v, datetime) else CB_STR for v in values]
+    data = ':'.join([prefix] + [enc(v) for (enc, _), v in zip(codecs, values)])
+    if len(data.encode()) > CALLBACK_LIMIT:
+        raise ValueError(f'callback_data too long: {data!r}')
+    return data
+
+class CallbackRouter:
+    """Один обработчик callback_query на весь бот: префикс -> маршрут по dict
+    вместо перебора lambda-фильтров. Маршрут без полей ищется по точному
+    совпадению всей строки ("tariff:add").
+
+    state как у aiogram: None — только без состояния, '*' — в любом,
+    State/StatesGroup — в указанных."""
+
+    def __init__(self):
+        self._exact = {}
+        self._prefix = {}
+
+    @staticmethod
+    def _states(state):
+        if state == '*':
+            return None
+        if state is None:
+            return {None}
+        if inspect.isclass(state) and issubclass(state, StatesGroup):
+            return set(state.all_states_names)
+        return {state.state if isinstance(state, State) else state}
+
+    def route(self, prefix: str, *fields, state=None):
+        def decorator(handler):
+            wants_state = 'state' in inspect.signature(handler).parameters
+            table = self._prefix if fields else self._exact
+            table.setdefault(prefix, []).append((self._states(state), handler, fields, wants_state))
+            return handler
+        return decorator
+
+    def match(self, data: str):
+        routes = self._exact.get(data)
+        if routes is None:
+            routes = self._prefix.get(data.split(':', 1)[0])
+        return routes
+
+    @staticmethod
+    def decode(data: str, fields) -> list:
+        parts = data.split(':', len(fields))[1:]
+        return [dec(p) for (_, dec), p in zip(fields, parts)] + [None] * (len(fields) - len(parts))
+
+    async def dispatch(self, call: CallbackQuery, state: FSMContext):
+        routes = self.match(call.data or '')
+        if routes:
+            current = None
+            if any(states is not None for states, _, _, _ in routes):
+                current = await state.get_state()
+            for states, handler, fields, wants_state in routes:
+                if states is not None and current not in states:
+                    continue
+                try:
+                    args = self.decode(call.data, fields)
+                except ValueError:
+                    logger.warning('Bad callback_data %r', call.data)
+                    break
+                # middleware увидит настоящий обработчик вместо route_callback
+                ctx_data.get({})['route'] = handler
+                if wants_state:
+                    return await handler(call, *args, state=state)
+                return await handler(call, *args)
+        await call.answer()
+
+router = CallbackRouter()
+
+@dp.callback_query_handler(state='*')
+async def route_callback(call: CallbackQuery, state: FSMContext):
+    await router.dispatch(call, state)
 
 # --- Keyboards ---
 PER_PAGE = 10
@@ -158,7 +1477,7 @@ TRAINER_KB = ReplyKeyboardMarkup(resize_keyboard=True)
 TRAINER_KB.row(KeyboardButton('📋 Мои клиенты'), KeyboardButton('📝 Заявки'))
 TRAINER_KB.row(KeyboardButton('🔑 Пригласить клиента'), KeyboardButton('📅 Расписание'))
 TRAINER_KB.row(KeyboardButton('💸 Должники'), KeyboardButton('📈 Статистика'))
-TRAINER_KB.row(KeyboardButton('⚙️ Профиль'))
+TRAINER_KB.row(KeyboardButton('⚙️ Профиль'), KeyboardButton('📤 Экспорт'))
 
 CLIENT_KB = ReplyKeyboardMarkup(resize_keyboard=True)
 CLIENT_KB.row(KeyboardButton('🧑‍🏫 Выбрать тренера'), KeyboardButton('🔎 Найти тренера по UUID'))
@@ -189,85 +1508,191 @@ def parse_dt(text: str) -> datetime:
             pass
     raise ValueError("Не удалось распознать дату. Формат: ДД.ММ.ГГГГ ЧЧ:ММ, пример: 12.08.2025 18:00")
 
-def ensure_trainer(chat_id: int, user: types.User):
-    cur.execute("SELECT id FROM trainers WHERE chat_id = ?", (chat_id,))
-    if cur.fetchone() is None:
-        cur.execute(
-            "INSERT INTO trainers (chat_id, name, created_at, tg_id, username, first_name, last_name) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (chat_id, user.full_name or 'trainer', datetime.utcnow().isoformat(), user.id, user.username, user.first_name, user.last_name)
-        )
-        conn.commit()
+# --- Identity cache ---
+class IdentityCache:
+    """LRU chat_id -> (role, trainer_id/client_id, status).
 
-def get_trainer_id_by_chat(chat_id: int):
-    cur.execute("SELECT id FROM trainers WHERE chat_id = ?", (chat_id,))
-    row = cur.fetchone()
-    return row[0] if row else None
+    Инвалидируется явно теми обработчиками, которые меняют роль/статус.
+    Поколение защищает от гонки: значение, прочитанное из БД до
+    инвалидации, не попадёт в кэш после неё.
+    Кэш свой у каждого процесса, а инвалидация видна только в том, где
+    прошло изменение. Поэтому при нескольких воркерах на одной БД
+    (FSM_FLUSH_INTERVAL=0) запись живёт ttl секунд (IDENTITY_CACHE_TTL, по
+    умолчанию 5); в одном процессе ttl = 0 — без срока. maxsize = 0 — кэш выключен."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._data = OrderedDict()
+
+    def get(self, chat_id: int):
+        entry = self._data.get(chat_id)
+        if entry is None or (self.ttl and entry[1] < time.monotonic()):
+            self.misses += 1
+            return None
+        self._data.move_to_end(chat_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, chat_id: int, ident: tuple, generation: int):
+        if generation != self.generation or not self.maxsize:
+            return
+        self._data[chat_id] = (ident, time.monotonic() + self.ttl)
+        self._data.move_to_end(chat_id)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *chat_ids):
+        self.generation += 1
+        for chat_id in chat_ids:
+            self._data.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+identity_cache = IdentityCache(int(os.getenv('IDENTITY_CACHE_SIZE', '10000')),
+                               float(os.getenv('IDENTITY_CACHE_TTL', '0' if FSM_FLUSH_INTERVAL else '5')))
+metrics.gauge('identity_cache', 'Кэш ролей чатов: размер, попадания, промахи',
+              lambda: {(('stat', k),): v for k, v in identity_cache.stats().items()})
+
+async def get_identity(chat_id: int) -> tuple:
+    ident = identity_cache.get(chat_id)
+    if ident is not None:
+        return ident
+    generation = identity_cache.generation
+    row = await db.fetchone("SELECT id FROM trainers WHERE chat_id = ?", (chat_id,))
+    if row:
+        ident = ('trainer', row[0], None)
+    else:
+        row = await db.fetchone("SELECT id, status FROM clients WHERE chat_id = ?", (chat_id,))
+        ident = ('client', row[0], row[1]) if row else ('none', None, None)
+    identity_cache.put(chat_id, ident, generation)
+    return ident
 
-def get_client_by_chat(chat_id: int):
-    cur.execute("SELECT id, name, phone, trainer_id, status, balance, tg_id, username FROM clients WHERE chat_id = ?", (chat_id,))
-    return cur.fetchone()
+async def ensure_trainer(chat_id: int, user: types.User):
+    await db.execute(
+        "INSERT OR IGNORE INTO trainers (chat_id, name, created_at, tg_id, username, first_name, last_name) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (chat_id, user.full_name or 'trainer', datetime.utcnow().isoformat(), user.id, user.username, user.first_name, user.last_name)
+    )
+    identity_cache.invalidate(chat_id)
+
+async def get_trainer_id_by_chat(chat_id: int):
+    role, ident_id, _ = await get_identity(chat_id)
+    return ident_id if role == 'trainer' else None
+
+async def get_client_by_chat(chat_id: int):
+    return await db.fetchone("SELECT id, name, phone, trainer_id, status, balance, tg_id, username FROM clients WHERE chat_id = ?", (chat_id,))
+
+async def get_role(chat_id: int) -> str:
+    return (await get_identity(chat_id))[0]
 
-def get_role(chat_id: int) -> str:
-    if get_trainer_id_by_chat(chat_id):
-        return 'trainer'
-    if get_client_by_chat(chat_id):
-        return 'client'
-    return 'none'
+# Keyset-пагинация: курсор в callback_data — "<prefix>:n:<id последней строки>"
+# (вперёд) или "<prefix>:p:<id первой строки>" (назад). Страница = один
+# индексный range-скан на PER_PAGE+1 строк, независимо от номера страницы.
+FIRST_PAGE = ('n', 0)
+
+def page_cursor(direction: str, key) -> tuple:
+    """Поля курсора из callback_data; кнопки со старыми номерами страниц ведут на первую."""
+    return (direction, key) if direction in ('n', 'p') and key is not None else FIRST_PAGE
+
+async def fetch_page(select: str, where: str, params: tuple, cursor: tuple = FIRST_PAGE):
+    """-> (rows, has_prev, has_next); первая колонка select — id."""
+    direction, key = cursor
+    prefix = f"{select} WHERE {where} AND" if where else f"{select} WHERE"
+    if direction == 'p':
+        rows = await db.fetchall(f"{prefix} id < ? ORDER BY id DESC LIMIT ?", params + (key, PER_PAGE + 1))
+        if not rows:
+            return await fetch_page(select, where, params)
+        return rows[:PER_PAGE][::-1], len(rows) > PER_PAGE, True
+    rows = await db.fetchall(f"{prefix} id > ? ORDER BY id LIMIT ?", params + (key, PER_PAGE + 1))
+    return rows[:PER_PAGE], key > 0, len(rows) > PER_PAGE
+
+def page_nav(prefix: str, rows, has_prev: bool, has_next: bool, *extra) -> list:
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton('⬅️ Назад', callback_data=cb(prefix, 'p', rows[0][0], *extra)))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton('Вперёд ➡️', callback_data=cb(prefix, 'n', rows[-1][0], *extra)))
+    return nav
 
-def build_trainers_kb(page: int = 0, city: str = None) -> InlineKeyboardMarkup:
+async def build_trainers_kb(cursor: tuple = FIRST_PAGE, city: str = None) -> InlineKeyboardMarkup:
     if city and city != 'Другой':
-        cur.execute('SELECT id, name FROM trainers WHERE city = ? ORDER BY id', (city,))
+        rows, has_prev, has_next = await fetch_page('SELECT id, name FROM trainers', 'city = ?', (city,), cursor)
+        # город едет в курсоре, если укладывается в лимит callback_data (64 байта)
+        extra = (city,) if len(f"trainers_page:n:{2**63}:{city}".encode()) <= CALLBACK_LIMIT else ()
     else:
-        cur.execute('SELECT id, name FROM trainers ORDER BY id')
-    all_rows = cur.fetchall()
-    start = page * PER_PAGE
-    end = start + PER_PAGE
-    rows = all_rows[start:end]
+        rows, has_prev, has_next = await fetch_page('SELECT id, name FROM trainers', '', (), cursor)
+        extra = ()
     kb = InlineKeyboardMarkup(row_width=1)
     for tid, name in rows:
         title = name or f"Тренер {tid}"
-        kb.add(InlineKeyboardButton(f"{tid}. {title}", callback_data=f"pick_trainer:{tid}"))
-    nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton('⬅️ Назад', callback_data=f"trainers_page:{page-1}"))
-    if end < len(all_rows):
-        nav.append(InlineKeyboardButton('Вперёд ➡️', callback_data=f"trainers_page:{page+1}"))
+        kb.add(InlineKeyboardButton(f"{tid}. {title}", callback_data=cb('pick_trainer', tid)))
+    nav = page_nav('trainers_page', rows, has_prev, has_next, *extra)
     if nav:
         kb.row(*nav)
     kb.add(InlineKeyboardButton('🔎 Поиск тренера', callback_data='search_trainers'))
     return kb
 
-def build_clients_kb_for_trainer(trainer_id: int, page: int = 0) -> InlineKeyboardMarkup:
-    cur.execute('SELECT id, name FROM clients WHERE trainer_id = ? AND status = ? ORDER BY id', (trainer_id, 'approved'))
-    all_rows = cur.fetchall()
-    start = page * PER_PAGE
-    end = start + PER_PAGE
-    rows = all_rows[start:end]
+async def build_clients_kb_for_trainer(trainer_id: int, cursor: tuple = FIRST_PAGE) -> InlineKeyboardMarkup:
+    rows, has_prev, has_next = await fetch_page(
+        'SELECT id, name FROM clients', 'trainer_id = ? AND status = ?', (trainer_id, 'approved'), cursor)
     kb = InlineKeyboardMarkup(row_width=1)
     for cid, name in rows:
-        kb.add(InlineKeyboardButton(f"{cid}. {name}", callback_data=f"client:{cid}"))
-    nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton('⬅️ Назад', callback_data=f"myclients_page:{page-1}"))
-    if end < len(all_rows):
-        nav.append(InlineKeyboardButton('Вперёд ➡️', callback_data=f"myclients_page:{page+1}"))
+        kb.add(InlineKeyboardButton(f"{cid}. {name}", callback_data=cb('client', cid)))
+    nav = page_nav('myclients_page', rows, has_prev, has_next)
     if nav:
         kb.row(*nav)
     kb.add(InlineKeyboardButton('🔎 Поиск клиента', callback_data='search_clients'))
+    kb.add(InlineKeyboardButton('📥 Импорт из CSV', callback_data='import_clients'))
     return kb
 
+def fts_query(text: str) -> str:
+    """Пользовательский ввод -> FTS5-запрос: каждое слово как префикс, все слова обязательны."""
+    text = text.strip().replace('ё', 'е').replace('Ё', 'Е')
+    if re.fullmatch(r'[\d\s()+-]{4,}', text):
+        digits = re.sub(r'\D', '', text)
+        text = '7' + digits[1:] if digits.startswith('8') else digits
+    return ' '.join(f'"{t}"*' for t in re.findall(r'\w+', text))
+
+async def search_trainers(text: str, limit: int = 30):
+    q = fts_query(text)
+    if not q:
+        return []
+    return await db.fetchall(
+        """SELECT t.id, t.name FROM trainers_fts f JOIN trainers t ON t.id = f.rowid
+           WHERE trainers_fts MATCH ? ORDER BY bm25(trainers_fts, 10.0, 3.0, 5.0) LIMIT ?""",
+        (q, limit))
+
+async def search_clients(trainer_id: int, text: str, limit: int = 30):
+    q = fts_query(text)
+    if not q:
+        return []
+    return await db.fetchall(
+        """SELECT c.id, c.name FROM clients_fts f JOIN clients c ON c.id = f.rowid
+           WHERE clients_fts MATCH ? ORDER BY bm25(clients_fts, 10.0, 5.0, 5.0, 1.0, 0.0) LIMIT ?""",
+        (f'owner:"t{trainer_id}" AND {{name phone username notes}}: ({q})', limit))
+
 def build_client_card_kb(cid: int) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup(row_width=2)
     kb.row(
-        InlineKeyboardButton('➕ Тренировка', callback_data=f"add_session:{cid}"),
-        InlineKeyboardButton('💸 Платёж', callback_data=f"add_payment:{cid}")
+        InlineKeyboardButton('➕ Тренировка', callback_data=cb('add_session', cid)),
+        InlineKeyboardButton('💸 Платёж', callback_data=cb('add_payment', cid))
+    )
+    kb.row(
+        InlineKeyboardButton('📜 История', callback_data=cb('hist', cid)),
+        InlineKeyboardButton('✏️ Редактировать', callback_data=cb('edit_client', cid))
+    )
+    kb.row(
+        InlineKeyboardButton('💳 Тариф', callback_data=cb('client_tariff', cid)),
+        InlineKeyboardButton('🗑 Удалить клиента', callback_data=cb('delete_client', cid))
     )
     kb.row(
-        InlineKeyboardButton('📜 История', callback_data=f"history:{cid}"),
-        InlineKeyboardButton('✏️ Редактировать', callback_data=f"edit_client:{cid}")
+        InlineKeyboardButton('🔁 Серии', callback_data=cb('series', cid)),
+        InlineKeyboardButton('🔗 Привязать чат', callback_data=cb('link_client', cid))
     )
-    kb.row(InlineKeyboardButton('🗑 Удалить клиента', callback_data=f"delete_client:{cid}"))
-    kb.add(InlineKeyboardButton('🔗 Привязать чат', callback_data=f"link_client:{cid}"))
     return kb
 
 def _unique_preserve(seq):
@@ -280,36 +1705,224 @@ def _unique_preserve(seq):
             seen.add(k.lower())
     return out
 
+# --- Local city index ---
+# Большой справочник можно положить рядом в cities.txt (UTF-8, по городу на
+# строку, в порядке приоритета — обычно по населению); иначе — CITIES.
+CITIES_FILE = os.getenv('CITIES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cities.txt'))
+
+def normalize_city(text: str) -> str:
+    text = text.strip().lower().replace('ё', 'е')
+    return ' '.join(re.split(r'[\s\-‐–—]+', text)).strip()
+
+class CityIndex:
+    """Префиксный индекс по нормализованным названиям: отсортированный массив
+    ключей (название целиком и с каждого следующего слова) + bisect.
+    Для коротких префиксов (1–2 буквы) диапазон огромен, поэтому верхушка по
+    приоритету посчитана заранее. Если префикс ничего не дал — варианты запроса
+    на расстоянии правки 1."""
+
+    SHORT_PREFIX = 2
+    POSTING_CAP = 50  # сколько лучших id хранить на короткий префикс
+
+    def __init__(self, names):
+        self.names = list(names)
+        pairs = []
+        for i, name in enumerate(self.names):
+            words = normalize_city(name).split(' ')
+            for j in range(len(words)):
+                pairs.append((' '.join(words[j:]), i))
+        pairs.sort()
+        self._keys = [k for k, _ in pairs]
+        self._ids = [i for _, i in pairs]
+        self._alphabet = sorted({ch for k in self._keys for ch in k})
+        short = {}
+        for key, i in pairs:
+            for n in range(1, min(len(key), self.SHORT_PREFIX) + 1):
+                short.setdefault(key[:n], set()).add(i)
+        self._short = {p: heapq.nsmallest(self.POSTING_CAP, ids) for p, ids in short.items()}
+
+    @classmethod
+    def load(cls, path: str = CITIES_FILE):
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                names = [line.strip() for line in f if line.strip()]
+            logger.info('City index: %s names from %s', len(names), path)
+        else:
+            names = [c for c in CITIES if c != 'Другой']
+        return cls(names)
+
+    def _prefix_ids(self, q: str, limit: int) -> list:
+        """limit лучших (меньших) id среди ключей с префиксом q."""
+        if len(q) <= self.SHORT_PREFIX and limit <= self.POSTING_CAP:
+            return self._short.get(q, [])[:limit]
+        lo = bisect_left(self._keys, q)
+        hi = bisect_right(self._keys, q + '\U0010ffff', lo)
+        return heapq.nsmallest(limit, set(self._ids[lo:hi]))
+
+    def _variants(self, q: str):
+        for i in range(len(q)):
+            yield q[:i] + q[i + 1:]
+            if i + 1 < len(q):
+                yield q[:i] + q[i + 1] + q[i] + q[i + 2:]
+            for ch in self._alphabet:
+                yield q[:i] + ch + q[i + 1:]
+        for i in range(len(q) + 1):
+            for ch in self._alphabet:
+                yield q[:i] + ch + q[i:]
+
+    def search(self, query: str, limit: int = 10) -> list:
+        q = normalize_city(query)
+        if not q:
+            return []
+        ids = self._prefix_ids(q, limit)
+        if not ids and len(q) >= 3:
+            found = set()
+            for v in self._variants(q):
+                if v and v not in found:
+                    found.add(v)
+                    ids.extend(self._prefix_ids(v, limit))
+        # меньший индекс = выше в справочнике (CITIES отсортирован по величине)
+        return [self.names[i] for i in sorted(set(ids))[:limit]]
+
+_city_index = None
+
 def search_cities_local(query: str, limit: int = 10):
-    q = query.strip().lower()
-    if not q:
-        return []
-    matches = [c for c in CITIES if q in c.lower() and c != 'Другой']
-    return matches[:limit]
-
-async def search_cities_nominatim(query: str, limit: int = 10):
-    url = 'https://nominatim.openstreetmap.org/search'
-    params = {
-        'q': query,
-        'format': 'json',
-        'addressdetails': 1,
-        'limit': str(limit),
-        'countrycodes': 'ru'
-    }
-    headers = {'User-Agent': 'TrainerLinkBot/1.0 (contact: you@example.com)'}
-    async with aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=6)) as s:
-        async with s.get(url, params=params) as r:
+    global _city_index
+    if _city_index is None:
+        _city_index = CityIndex.load()
+    return _city_index.search(query, limit)
+
+# --- Geocoding ---
+NOMINATIM_URL = os.getenv('NOMINATIM_URL', 'https://nominatim.openstreetmap.org/search')
+GEOCODE_TTL = int(os.getenv('GEOCODE_TTL', str(7 * 24 * 3600)))
+
+class LatencyStats:
+    """Скользящее окно последних длительностей (мс) для p50/p99."""
+
+    def __init__(self, size: int = 1000):
+        self.count = 0
+        self._samples = deque(maxlen=size)
+
+    def add(self, ms: float):
+        self.count += 1
+        self._samples.append(ms)
+
+    def percentile(self, p: float) -> float:
+        if not self._samples:
+            return 0.0
+        s = sorted(self._samples)
+        return s[min(len(s) - 1, int(p / 100.0 * len(s)))]
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+class RateLimiter:
+    """Не чаще одного запроса в interval секунд (политика Nominatim — 1 req/s)."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+            self._next = max(now, self._next) + self.interval
+
+class Geocoder:
+    """Поиск города: сначала локальный список, Nominatim — только при промахе.
+
+    Ответы Nominatim кэшируются в geocode_cache на GEOCODE_TTL секунд;
+    одинаковые одновременные запросы сливаются в один; HTTP-сессия с пулом
+    соединений живёт всё время работы бота."""
+
+    def __init__(self, url: str = NOMINATIM_URL, ttl: int = GEOCODE_TTL, rate: float = 1.0):
+        self.url = url
+        self.ttl = ttl
+        self.limiter = RateLimiter(rate)
+        self.stats = LatencyStats()
+        self.counters = {'local': 0, 'cache': 0, 'remote': 0, 'coalesced': 0, 'errors': 0}
+        self._session = None
+        self._inflight = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={'User-Agent': 'TrainerLinkBot/1.0 (contact: you@example.com)'},
+                timeout=aiohttp.ClientTimeout(total=6),
+                connector=aiohttp.TCPConnector(limit=4, ttl_dns_cache=300),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def search(self, query: str, limit: int = 10) -> list:
+        t0 = time.perf_counter()
+        try:
+            local = search_cities_local(query, limit)
+            if local:
+                self.counters['local'] += 1
+                return local
+            key = query.strip().lower()
+            if not key:
+                return []
+            task = self._inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._resolve(query, key))
+                self._inflight[key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            else:
+                self.counters['coalesced'] += 1
+            return (await asyncio.shield(task))[:limit]
+        finally:
+            spent = time.perf_counter() - t0
+            self.stats.add(spent * 1000)
+            metrics.observe('geocoder_search_seconds', spent)
+
+    async def _resolve(self, query: str, key: str) -> list:
+        row = await db.fetchone('SELECT cities, fetched_at FROM geocode_cache WHERE query = ?', (key,))
+        if row and time.time() - row[1] < self.ttl:
+            self.counters['cache'] += 1
+            return json.loads(row[0])
+        try:
+            await self.limiter.wait()
+            self.counters['remote'] += 1
+            cities = await self._fetch(query)
+        except Exception:
+            self.counters['errors'] += 1
+            raise
+        await db.execute('INSERT OR REPLACE INTO geocode_cache (query, cities, fetched_at) VALUES (?, ?, ?)',
+                         (key, json.dumps(cities, ensure_ascii=False), time.time()))
+        return cities
+
+    async def _fetch(self, query: str, limit: int = 10) -> list:
+        params = {
+            'q': query,
+            'format': 'json',
+            'addressdetails': 1,
+            'limit': str(limit),
+            'countrycodes': 'ru'
+        }
+        async with self._get_session().get(self.url, params=params) as r:
             data = await r.json(content_type=None)
-    names = []
-    for it in data:
-        addr = it.get('address', {})
-        city = addr.get('city') or addr.get('town') or addr.get('village') or ''
-        if not city:
-            dn = (it.get('display_name') or '').split(',')[0]
-            city = dn.strip()
-        if city:
-            names.append(city)
-    return _unique_preserve(names)[:limit]
+        names = []
+        for it in data:
+            addr = it.get('address', {})
+            city = addr.get('city') or addr.get('town') or addr.get('village') or ''
+            if not city:
+                dn = (it.get('display_name') or '').split(',')[0]
+                city = dn.strip()
+            if city:
+                names.append(city)
+        return _unique_preserve(names)[:limit]
+
+geocoder = Geocoder()
+metrics.gauge('geocoder_requests', 'Поиски города по источнику ответа',
+              lambda: {(('source', k),): v for k, v in geocoder.counters.items()})
 
 # --- FSM States ---
 class AddClient(StatesGroup):
@@ -346,6 +1959,13 @@ class EditTrainerProfile(StatesGroup):
     field = State()
     value = State()
 
+class AddSeries(StatesGroup):
+    rule = State()
+
+class EditBooking(StatesGroup):
+    hours = State()
+    minutes = State()
+
 class LinkByUUID(StatesGroup):
     code = State()
 
@@ -360,10 +1980,13 @@ class DeleteTariff(StatesGroup):
 class SearchCity(StatesGroup):
     query = State()
 
+class ImportClients(StatesGroup):
+    file = State()
+
 # --- Commands & Role entry ---
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
-    role = get_role(message.chat.id)
+    role = await get_role(message.chat.id)
     if role == 'trainer':
         await message.answer("Вы зарегистрированы как тренер. Добро пожаловать!", reply_markup=TRAINER_KB)
         return
@@ -374,7 +1997,7 @@ async def cmd_start(message: types.Message):
 
 @dp.message_handler(commands=['help'])
 async def cmd_help(message: types.Message):
-    role = get_role(message.chat.id)
+    role = await get_role(message.chat.id)
     if role == 'trainer':
         await message.answer("Доступно: 📋 Мои клиенты, 📝 Заявки, 🔑 Пригласить клиента, 📅 Расписание, 💸 Должники, 📈 Статистика, ⚙️ Профиль", reply_markup=TRAINER_KB)
     elif role == 'client':
@@ -385,20 +2008,20 @@ async def cmd_help(message: types.Message):
 # --- Role choose ---
 @dp.message_handler(lambda m: m.text == 'Я тренер')
 async def i_am_trainer(message: types.Message):
-    ensure_trainer(message.chat.id, message.from_user)
+    await ensure_trainer(message.chat.id, message.from_user)
     await message.answer('Чат зарегистрирован как тренер ✅', reply_markup=TRAINER_KB)
 
 @dp.message_handler(lambda m: m.text == 'Я клиент')
 async def i_am_client(message: types.Message, state: FSMContext):
-    client = get_client_by_chat(message.chat.id)
+    client = await get_client_by_chat(message.chat.id)
     if client:
         await message.answer('Вы уже зарегистрированы как клиент.', reply_markup=CLIENT_KB)
         return
-    cur.execute(
+    await db.execute(
         'INSERT INTO clients (name, phone, chat_id, status, tg_id, username, first_name, last_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
         (message.from_user.full_name, '', message.chat.id, 'pending', message.from_user.id, message.from_user.username, message.from_user.first_name, message.from_user.last_name)
     )
-    conn.commit()
+    identity_cache.invalidate(message.chat.id)
     await state.finish()
     await SearchCity.query.set()
     await message.answer('Введите город (например: "Екате" или "Ростов"):')
@@ -410,18 +2033,19 @@ async def client_pick_trainer(message: types.Message, state: FSMContext):
 @dp.message_handler(state=SearchCity.query)
 async def st_city_query(message: types.Message, state: FSMContext):
     q = message.text.strip()
-    local = search_cities_local(q, limit=8)
     try:
-        ext = await search_cities_nominatim(q, limit=8)
+        cities = await geocoder.search(q, limit=10)
     except Exception:
-        ext = []
-    cities = _unique_preserve(local + ext)[:10]
+        logger.warning('Geocoder failed for %r', q, exc_info=True)
+        cities = []
     kb = InlineKeyboardMarkup(row_width=2)
-    if cities:
-        for c in cities:
-            kb.add(InlineKeyboardButton(c, callback_data=f"pick_city:{c}"))
-    else:
-        kb.add(InlineKeyboardButton('Другой', callback_data="pick_city:Другой"))
+    for c in cities:
+        try:
+            kb.add(InlineKeyboardButton(c, callback_data=cb('pick_city', c)))
+        except ValueError:
+            pass  # название длиннее лимита callback_data
+    if not kb.inline_keyboard:
+        kb.add(InlineKeyboardButton('Другой', callback_data=cb('pick_city', 'Другой')))
     # Если поиск вызвали из профиля тренера — восстановим состояние
     data = await state.get_data()
     return_to = data.get('return_to')
@@ -431,63 +2055,54 @@ async def st_city_query(message: types.Message, state: FSMContext):
     else:
         await state.finish()
     await message.answer('Выберите город из найденных вариантов:', reply_markup=kb)
-@dp.callback_query_handler(lambda c: c.data.startswith('pick_city:'), state=EditTrainerProfile.field)
-async def cb_set_city(call: CallbackQuery, state: FSMContext):
-    city = call.data.split(':', 1)[1]
-    tid = get_trainer_id_by_chat(call.message.chat.id)
+@router.route('pick_city', CB_STR, state=EditTrainerProfile.field)
+async def cb_set_city(call: CallbackQuery, city: str, state: FSMContext):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
     if not tid:
         await call.answer('Не тренер', show_alert=True); return
-    cur.execute('UPDATE trainers SET city = ? WHERE id = ?', (city, tid))
-    conn.commit()
+    await db.execute('UPDATE trainers SET city = ? WHERE id = ?', (city, tid))
     await state.finish()
     await call.message.answer(f'Город обновлён: {city}', reply_markup=TRAINER_KB)
     await call.answer()
-@dp.callback_query_handler(lambda c: c.data.startswith('pick_city:'))
-async def cb_pick_city_client(call: CallbackQuery):
-    city = call.data.split(':',1)[1]
+@router.route('pick_city', CB_STR)
+async def cb_pick_city_client(call: CallbackQuery, city: str):
     await call.message.edit_text(f'Город: {city}. Выберите тренера:')
-    await call.message.edit_reply_markup(build_trainers_kb(0, city=city))
+    await call.message.edit_reply_markup(await build_trainers_kb(city=city))
     await call.answer()
-@dp.callback_query_handler(lambda c: c.data.startswith('trainers_page:'))
-async def cb_trainers_page(call: CallbackQuery):
-    page = int(call.data.split(':')[1])
-    await call.message.edit_text('Выберите тренера:')
-    await call.message.edit_reply_markup(build_trainers_kb(page))
+@router.route('trainers_page', CB_STR, CB_INT, CB_STR)
+async def cb_trainers_page(call: CallbackQuery, direction: str, key: int, city: str):
+    await call.message.edit_text(f'Город: {city}. Выберите тренера:' if city else 'Выберите тренера:')
+    await call.message.edit_reply_markup(await build_trainers_kb(page_cursor(direction, key), city=city))
     await call.answer()
 
 # --- Client actions ---
-@dp.callback_query_handler(lambda c: c.data == 'search_trainers')
+@router.route('search_trainers')
 async def cb_search_trainers(call: CallbackQuery, state: FSMContext):
     await SearchTrainer.query.set()
     await call.message.answer('Введите часть имени тренера для поиска:')
     await call.answer()
 @dp.message_handler(state=SearchTrainer.query)
 async def st_search_trainers_query(message: types.Message, state: FSMContext):
-    q = f"%{message.text.strip()}%"
-    cur.execute('SELECT id, name FROM trainers WHERE name LIKE ? ORDER BY id LIMIT 30', (q,))
-    rows = cur.fetchall()
+    rows = await search_trainers(message.text)
     if not rows:
         await message.answer('Ничего не найдено. Попробуйте ещё раз или откройте список тренеров кнопкой.')
         await state.finish()
         return
     kb = InlineKeyboardMarkup(row_width=1)
     for tid, name in rows:
-        kb.add(InlineKeyboardButton(f"{tid}. {name}", callback_data=f"pick_trainer:{tid}"))
+        kb.add(InlineKeyboardButton(f"{tid}. {name}", callback_data=cb('pick_trainer', tid)))
     await message.answer('Результаты поиска:', reply_markup=kb)
     await state.finish()
-@dp.callback_query_handler(lambda c: c.data.startswith('pick_trainer:'))
-async def cb_pick_trainer(call: CallbackQuery):
-    tid = int(call.data.split(':')[1])
-    cur.execute('UPDATE clients SET trainer_id = ?, status = ? WHERE chat_id = ?', (tid, 'pending', call.message.chat.id))
-    conn.commit()
-    cur.execute('SELECT name, phone, id, tg_id, username FROM clients WHERE chat_id = ?', (call.message.chat.id,))
-    cname, cphone, cid, ctg, cuser = cur.fetchone()
-    cur.execute('SELECT chat_id, name FROM trainers WHERE id = ?', (tid,))
-    trow = cur.fetchone()
+@router.route('pick_trainer', CB_INT)
+async def cb_pick_trainer(call: CallbackQuery, tid: int):
+    await db.execute('UPDATE clients SET trainer_id = ?, status = ? WHERE chat_id = ?', (tid, 'pending', call.message.chat.id))
+    identity_cache.invalidate(call.message.chat.id)
+    cname, cphone, cid, ctg, cuser = await db.fetchone('SELECT name, phone, id, tg_id, username FROM clients WHERE chat_id = ?', (call.message.chat.id,))
+    trow = await db.fetchone('SELECT chat_id, name FROM trainers WHERE id = ?', (tid,))
     tchat, tname = (trow[0], trow[1]) if trow else (None, 'тренер')
     kb = InlineKeyboardMarkup().row(
-        InlineKeyboardButton('✅ Одобрить', callback_data=f"approve:{cid}"),
-        InlineKeyboardButton('❌ Отклонить', callback_data=f"reject:{cid}")
+        InlineKeyboardButton('✅ Одобрить', callback_data=cb('approve', cid)),
+        InlineKeyboardButton('❌ Отклонить', callback_data=cb('reject', cid))
     )
     if tchat:
         try:
@@ -510,19 +2125,17 @@ async def link_by_uuid_submit(message: types.Message, state: FSMContext):
     if len(code) != 8:
         await message.answer('Неверный формат. Введите точно 8 символов, например: `A1B2C3D4`', parse_mode='Markdown')
         return
-    cur.execute('SELECT id, chat_id, name FROM trainers WHERE invite_code = ?', (code,))
-    t = cur.fetchone()
+    t = await db.fetchone('SELECT id, chat_id, name FROM trainers WHERE invite_code = ?', (code,))
     if not t:
         await message.answer('Код не найден. Проверьте и попробуйте снова.')
         return
     trainer_id, trainer_chat, trainer_name = t
-    cur.execute('UPDATE clients SET trainer_id = ?, status = ? WHERE chat_id = ?', (trainer_id, 'approved', message.chat.id))
-    conn.commit()
+    await db.execute('UPDATE clients SET trainer_id = ?, status = ? WHERE chat_id = ?', (trainer_id, 'approved', message.chat.id))
+    identity_cache.invalidate(message.chat.id)
     await state.finish()
     await message.answer(f'Вы привязаны к тренеру: {trainer_name} ✅', reply_markup=CLIENT_KB)
     try:
-        cur.execute('SELECT id, name, phone, tg_id, username FROM clients WHERE chat_id = ?', (message.chat.id,))
-        cid, cname, cphone, ctg, cuser = cur.fetchone()
+        cid, cname, cphone, ctg, cuser = await db.fetchone('SELECT id, name, phone, tg_id, username FROM clients WHERE chat_id = ?', (message.chat.id,))
         msg = f"Клиент подключился по UUID:\n{cid}. {cname} — {cphone or 'телефон не указан'}\nTG: @{cuser or '-'} (id={ctg})"
         if trainer_chat:
             await bot.send_message(trainer_chat, msg)
@@ -530,14 +2143,12 @@ async def link_by_uuid_submit(message: types.Message, state: FSMContext):
         pass
 @dp.message_handler(lambda m: m.text == 'ℹ️ Мой тренер')
 async def my_trainer_info(message: types.Message):
-    cur.execute('SELECT trainer_id FROM clients WHERE chat_id = ? AND status = "approved"', (message.chat.id,))
-    row = cur.fetchone()
+    row = await db.fetchone('SELECT trainer_id FROM clients WHERE chat_id = ? AND status = "approved"', (message.chat.id,))
     if not row or not row[0]:
         await message.answer('Тренер не выбран или заявка ещё не одобрена.')
         return
     tid = row[0]
-    cur.execute('SELECT name, city, pricing, tg_id, username FROM trainers WHERE id = ?', (tid,))
-    t = cur.fetchone()
+    t = await db.fetchone('SELECT name, city, pricing, tg_id, username FROM trainers WHERE id = ?', (tid,))
     if not t:
         await message.answer('Информация о тренере недоступна.')
         return
@@ -548,8 +2159,7 @@ async def my_trainer_info(message: types.Message):
         f"Тарифы (общее описание): {pricing or '-'}\n"
         f"Telegram: @{username or '-'} (id={tg_id})"
     )
-    cur.execute('SELECT title, description, price FROM tariffs WHERE trainer_id = ? ORDER BY id', (tid,))
-    rows = cur.fetchall()
+    rows = await db.fetchall('SELECT title, description, price FROM tariffs WHERE trainer_id = ? ORDER BY id', (tid,))
     if rows:
         text += "\n\nТарифы/пакеты:"
         for title, desc, price in rows:
@@ -557,48 +2167,63 @@ async def my_trainer_info(message: types.Message):
     await message.answer(text, reply_markup=CLIENT_KB)
 @dp.message_handler(lambda m: m.text == '📅 Мои тренировки')
 async def my_sessions(message: types.Message):
-    cur.execute('SELECT id FROM clients WHERE chat_id = ?', (message.chat.id,))
-    row = cur.fetchone()
+    row = await db.fetchone('SELECT id FROM clients WHERE chat_id = ?', (message.chat.id,))
     if not row:
         await message.answer('Вы ещё не зарегистрированы как клиент. Нажмите /start.')
         return
     cid = row[0]
     now = datetime.utcnow()
     end = now + timedelta(days=60)
-    cur.execute(
+    rows = await db.fetchall(
         'SELECT id, datetime, status, comment FROM sessions WHERE client_id = ? AND datetime BETWEEN ? AND ? ORDER BY datetime',
         (cid, now.isoformat(), end.isoformat())
     )
-    rows = cur.fetchall()
+    rows = [(str(r[0]), datetime.fromisoformat(r[1]), r[2], r[3]) for r in rows]
+    rows += [('🔁', when, 'planned', comment)
+             for _, _, _, _, when, _, comment in await db.read(series_occurrences, now, end, None, cid)]
     if not rows:
         await message.answer('Пока нет запланированных тренировок.', reply_markup=CLIENT_KB)
         return
+    rows.sort(key=lambda r: r[1])
     text = "\n".join([
-        f"{r[0]}. {datetime.fromisoformat(r[1]).strftime('%d.%m.%Y %H:%M')} — {r[2]} — {r[3] or ''}"
+        f"{r[0]}. {r[1].strftime('%d.%m.%Y %H:%M')} — {r[2]} — {r[3] or ''}"
         for r in rows
     ])
     await message.answer(text, reply_markup=CLIENT_KB)
+
+def last_payments(conn, cid: int, limit: int = 5) -> list:
+    """Последние платежи клиента [(сумма, дата, примечание)]. Архив читается,
+    только если в main их меньше limit или последний не новее архива."""
+    pays = conn.execute('SELECT amount, date, note FROM main.payments WHERE client_id = ? ORDER BY date DESC LIMIT ?',
+                        (cid, limit)).fetchall()
+    if len(pays) == limit:
+        until = archive_until(conn, 'payments')
+        if until is None or pays[-1][1] > until:
+            return pays
+    pays += conn.execute('SELECT amount, date, note FROM archive.payments WHERE client_id = ? ORDER BY date DESC LIMIT ?',
+                         (cid, limit)).fetchall()
+    pays.sort(key=lambda p: p[1], reverse=True)
+    return pays[:limit]
+
 @dp.message_handler(lambda m: m.text == '💸 Мой баланс')
 async def my_balance(message: types.Message):
-    cur.execute('SELECT id, balance FROM clients WHERE chat_id = ?', (message.chat.id,))
-    row = cur.fetchone()
+    row = await db.fetchone('SELECT id, balance FROM clients WHERE chat_id = ?', (message.chat.id,))
     if not row:
         await message.answer('Вы ещё не зарегистрированы как клиент. Нажмите /start.')
         return
     cid, bal = row
-    cur.execute('SELECT amount, date, note FROM payments WHERE client_id = ? ORDER BY date DESC LIMIT 5', (cid,))
-    pays = cur.fetchall()
+    pays = await db.read(last_payments, cid)
     text = f"Ваш баланс: {bal:.2f}\nПоследние платежи:"
     if pays:
         for p in pays:
             text += f"\n{p[0]:.2f} — {p[1]} — {p[2] or ''}"
     else:
         text += "\n—"
-    await message.answer(text, reply_markup=CLIENT_KB)
+    kb = InlineKeyboardMarkup().add(InlineKeyboardButton('📜 Вся история', callback_data=cb('hist', cid)))
+    await message.answer(text, reply_markup=kb)
 @dp.message_handler(lambda m: m.text == '🚪 Уйти от тренера')
 async def client_leave_trainer_start(message: types.Message):
-    cur.execute('SELECT trainer_id FROM clients WHERE chat_id = ? AND status = "approved"', (message.chat.id,))
-    row = cur.fetchone()
+    row = await db.fetchone('SELECT trainer_id FROM clients WHERE chat_id = ? AND status = "approved"', (message.chat.id,))
     if not row or not row[0]:
         await message.answer('Вы не привязаны к тренеру.')
         return
@@ -608,25 +2233,24 @@ async def client_leave_trainer_start(message: types.Message):
         InlineKeyboardButton('❌ Отмена', callback_data='leave_trainer:no')
     )
     await message.answer('Вы уверены, что хотите разорвать связь с тренером? Тренер будет уведомлён.', reply_markup=kb)
-@dp.callback_query_handler(lambda c: c.data.startswith('leave_trainer:'))
-async def cb_client_leave_trainer(call: CallbackQuery):
-    action = call.data.split(':')[1]
+@router.route('leave_trainer', CB_STR)
+async def cb_client_leave_trainer(call: CallbackQuery, action: str):
     if action == 'no':
         await call.answer('Отменено')
         await call.message.edit_reply_markup(None)
         return
-    cur.execute('SELECT id, name, trainer_id FROM clients WHERE chat_id = ? AND status = "approved"', (call.message.chat.id,))
-    row = cur.fetchone()
+    row = await db.fetchone('SELECT id, name, trainer_id FROM clients WHERE chat_id = ? AND status = "approved"', (call.message.chat.id,))
     if not row:
         await call.answer('Связь уже отсутствует.')
         await call.message.edit_reply_markup(None)
         return
     cid, cname, tid = row
-    cur.execute('SELECT chat_id, name FROM trainers WHERE id = ?', (tid,))
-    t = cur.fetchone()
+    t = await db.fetchone('SELECT chat_id, name FROM trainers WHERE id = ?', (tid,))
     tchat, _ = (t[0], t[1]) if t else (None, 'тренер')
-    cur.execute("UPDATE clients SET trainer_id = NULL, status = 'pending' WHERE id = ?", (cid,))
-    conn.commit()
+    await db.execute("UPDATE clients SET trainer_id = NULL, status = 'pending' WHERE id = ?", (cid,))
+    identity_cache.invalidate(call.message.chat.id)
+    for (ser,) in await db.fetchall('SELECT id FROM series WHERE client_id = ? AND until IS NULL', (cid,)):
+        await stop_series(ser)
     await call.message.edit_reply_markup(None)
     await call.message.answer('Вы вышли от тренера. Можете выбрать нового.', reply_markup=CLIENT_KB)
     await call.answer('Готово ✅')
@@ -639,78 +2263,93 @@ async def cb_client_leave_trainer(call: CallbackQuery):
 # --- Trainer actions ---
 @dp.message_handler(lambda m: m.text == '📋 Мои клиенты')
 async def my_clients(message: types.Message):
-    tid = get_trainer_id_by_chat(message.chat.id)
+    tid = await get_trainer_id_by_chat(message.chat.id)
     if not tid:
         await message.answer('Вы не тренер. Нажмите /start.')
         return
-    await message.answer('Ваши клиенты:', reply_markup=build_clients_kb_for_trainer(tid, 0))
+    await message.answer('Ваши клиенты:', reply_markup=await build_clients_kb_for_trainer(tid))
+@router.route('myclients_page', CB_STR, CB_INT)
+async def cb_myclients_page(call: CallbackQuery, direction: str, key: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    if not tid:
+        await call.answer('Не тренер', show_alert=True); return
+    await call.message.edit_reply_markup(await build_clients_kb_for_trainer(tid, page_cursor(direction, key)))
+    await call.answer()
+@router.route('search_clients')
+async def cb_search_clients(call: CallbackQuery):
+    await SearchClient.query.set()
+    await call.message.answer('Введите имя, телефон, @username или часть заметки клиента:')
+    await call.answer()
+@dp.message_handler(state=SearchClient.query)
+async def st_search_clients_query(message: types.Message, state: FSMContext):
+    await state.finish()
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    if not tid:
+        await message.answer('Вы не тренер.')
+        return
+    rows = await search_clients(tid, message.text)
+    if not rows:
+        await message.answer('Ничего не найдено. Попробуйте ещё раз или откройте список клиентов кнопкой.')
+        return
+    kb = InlineKeyboardMarkup(row_width=1)
+    for cid, name in rows:
+        kb.add(InlineKeyboardButton(f"{cid}. {name}", callback_data=cb('client', cid)))
+    await message.answer('Результаты поиска:', reply_markup=kb)
 @dp.message_handler(lambda m: m.text == '📝 Заявки')
 async def my_requests(message: types.Message):
-    tid = get_trainer_id_by_chat(message.chat.id)
+    tid = await get_trainer_id_by_chat(message.chat.id)
     if not tid:
         await message.answer('Вы не тренер.')
         return
-    await message.answer('Заявки от клиентов:', reply_markup=build_requests_kb(tid, 0))
-def build_requests_kb(trainer_id: int, page: int = 0) -> InlineKeyboardMarkup:
-    cur.execute('SELECT id, name, phone FROM clients WHERE trainer_id = ? AND status = ? ORDER BY id', (trainer_id, 'pending'))
-    all_rows = cur.fetchall()
-    start = page * PER_PAGE
-    end = start + PER_PAGE
-    rows = all_rows[start:end]
+    await message.answer('Заявки от клиентов:', reply_markup=await build_requests_kb(tid))
+async def build_requests_kb(trainer_id: int, cursor: tuple = FIRST_PAGE) -> InlineKeyboardMarkup:
+    rows, has_prev, has_next = await fetch_page(
+        'SELECT id, name, phone FROM clients', 'trainer_id = ? AND status = ?', (trainer_id, 'pending'), cursor)
     kb = InlineKeyboardMarkup(row_width=2)
     for cid, name, phone in rows:
         kb.row(
-            InlineKeyboardButton(f"{cid}. {name}", callback_data=f"client:{cid}"),
-            InlineKeyboardButton('✅ Одобрить', callback_data=f"approve:{cid}")
+            InlineKeyboardButton(f"{cid}. {name}", callback_data=cb('client', cid)),
+            InlineKeyboardButton('✅ Одобрить', callback_data=cb('approve', cid))
         )
-        kb.row(InlineKeyboardButton('❌ Отклонить', callback_data=f"reject:{cid}"))
-    nav = []
-    if page > 0:
-        nav.append(InlineKeyboardButton('⬅️ Назад', callback_data=f"req_page:{page-1}"))
-    if end < len(all_rows):
-        nav.append(InlineKeyboardButton('Вперёд ➡️', callback_data=f"req_page:{page+1}"))
+        kb.row(InlineKeyboardButton('❌ Отклонить', callback_data=cb('reject', cid)))
+    nav = page_nav('req_page', rows, has_prev, has_next)
     if nav:
         kb.row(*nav)
     return kb
-@dp.callback_query_handler(lambda c: c.data.startswith('req_page:'))
-async def cb_requests_page(call: CallbackQuery):
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    page = int(call.data.split(':')[1])
+@router.route('req_page', CB_STR, CB_INT)
+async def cb_requests_page(call: CallbackQuery, direction: str, key: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
     await call.message.edit_text('Заявки от клиентов:')
-    await call.message.edit_reply_markup(build_requests_kb(tid, page))
+    await call.message.edit_reply_markup(await build_requests_kb(tid, page_cursor(direction, key)))
     await call.answer()
-@dp.callback_query_handler(lambda c: c.data.startswith('approve:'))
-async def cb_approve(call: CallbackQuery):
-    cid = int(call.data.split(':')[1])
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('SELECT trainer_id, chat_id FROM clients WHERE id = ?', (cid,))
-    row = cur.fetchone()
+@router.route('approve', CB_INT)
+async def cb_approve(call: CallbackQuery, cid: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT trainer_id, chat_id FROM clients WHERE id = ?', (cid,))
     if not row or row[0] != tid:
         await call.answer('Эта заявка не для вас.', show_alert=True)
         return
-    cur.execute("UPDATE clients SET status = 'approved' WHERE id = ?", (cid,))
-    conn.commit()
+    await db.execute("UPDATE clients SET status = 'approved' WHERE id = ?", (cid,))
+    identity_cache.invalidate(row[1])
     await call.answer('Клиент одобрен ✅', show_alert=False)
-    await call.message.edit_reply_markup(build_requests_kb(tid, 0))
+    await call.message.edit_reply_markup(await build_requests_kb(tid))
     client_chat = row[1]
     if client_chat:
         try:
             await bot.send_message(client_chat, 'Ваша заявка подтверждена ✅', reply_markup=CLIENT_KB)
         except Exception:
             logger.exception('Не удалось уведомить клиента об одобрении')
-@dp.callback_query_handler(lambda c: c.data.startswith('reject:'))
-async def cb_reject(call: CallbackQuery):
-    cid = int(call.data.split(':')[1])
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('SELECT trainer_id, chat_id FROM clients WHERE id = ?', (cid,))
-    row = cur.fetchone()
+@router.route('reject', CB_INT)
+async def cb_reject(call: CallbackQuery, cid: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT trainer_id, chat_id FROM clients WHERE id = ?', (cid,))
     if not row or row[0] != tid:
         await call.answer('Эта заявка не для вас.', show_alert=True)
         return
-    cur.execute("UPDATE clients SET status = 'rejected', trainer_id = NULL WHERE id = ?", (cid,))
-    conn.commit()
+    await db.execute("UPDATE clients SET status = 'rejected', trainer_id = NULL WHERE id = ?", (cid,))
+    identity_cache.invalidate(row[1])
     await call.answer('Заявка отклонена ❌', show_alert=False)
-    await call.message.edit_reply_markup(build_requests_kb(tid, 0))
+    await call.message.edit_reply_markup(await build_requests_kb(tid))
     client_chat = row[1]
     if client_chat:
         try:
@@ -720,12 +2359,11 @@ async def cb_reject(call: CallbackQuery):
 
 @dp.message_handler(lambda m: m.text == '🔑 Пригласить клиента')
 async def trainer_invite_client(message: types.Message):
-    tid = get_trainer_id_by_chat(message.chat.id)
+    tid = await get_trainer_id_by_chat(message.chat.id)
     if not tid:
         await message.answer('Только для тренера.'); return
     code = uuid.uuid4().hex[:8].upper()
-    cur.execute('UPDATE trainers SET invite_code = ? WHERE id = ?', (code, tid))
-    conn.commit()
+    await db.execute('UPDATE trainers SET invite_code = ? WHERE id = ?', (code, tid))
     text = (
         "Приглашение для клиента:\n"
         f"UUID: `{code}`\n\n"
@@ -735,40 +2373,75 @@ async def trainer_invite_client(message: types.Message):
 
 @dp.message_handler(lambda m: m.text == '⚙️ Профиль')
 async def trainer_profile(message: types.Message):
-    tid = get_trainer_id_by_chat(message.chat.id)
+    tid = await get_trainer_id_by_chat(message.chat.id)
     if not tid:
         await message.answer('Вы не тренер.')
         return
-    cur.execute('SELECT name, city, pricing, tg_id, username, invite_code FROM trainers WHERE id = ?', (tid,))
-    name, city, pricing, tg_id, username, inv = cur.fetchone()
+    name, city, pricing, tg_id, username, inv = await db.fetchone('SELECT name, city, pricing, tg_id, username, invite_code FROM trainers WHERE id = ?', (tid,))
+    work_start, work_end, minutes = await db.read(trainer_booking, tid)
     kb = InlineKeyboardMarkup(row_width=2)
     kb.row(
         InlineKeyboardButton('🏙️ Изменить город', callback_data='tprof_city'),
         InlineKeyboardButton('💰 Тарифы/пакеты', callback_data='tprof_pricing')
     )
+    kb.add(InlineKeyboardButton('🕘 Часы работы', callback_data='tprof_hours'))
     txt = (
         f"Профиль тренера: {name}\n"
         f"Город: {city or '-'}\n"
+        f"Часы работы: {work_start // 60:02d}:{work_start % 60:02d}–{work_end // 60:02d}:{work_end % 60:02d}, "
+        f"тренировка {minutes} мин\n"
         f"Тарифы (общее описание): {pricing or '-'}\n"
         f"Telegram: @{username or '-'} (id={tg_id})\n"
         f"UUID-приглашение: {inv or '—'}"
     )
     await message.answer(txt, reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data == 'tprof_city')
+@router.route('tprof_city')
 async def tprof_city_start(call: CallbackQuery, state: FSMContext):
     await state.update_data(return_to='trainer_city')
     await SearchCity.query.set()
     await call.message.answer('Введите город для профиля тренера:')
     await call.answer()
 
-@dp.callback_query_handler(lambda c: c.data == 'tprof_pricing')
+@router.route('tprof_hours')
+async def tprof_hours_start(call: CallbackQuery):
+    await EditBooking.hours.set()
+    await call.message.answer('Рабочие часы в формате ЧЧ:ММ-ЧЧ:ММ, например: 09:00-21:00')
+    await call.answer()
+
+@dp.message_handler(state=EditBooking.hours)
+async def tprof_hours_set(message: types.Message, state: FSMContext):
+    m = re.fullmatch(r'\s*(\d{1,2}):(\d{2})\s*[-–—]\s*(\d{1,2}):(\d{2})\s*', message.text or '')
+    start, end = (int(m[1]) * 60 + int(m[2]), int(m[3]) * 60 + int(m[4])) if m else (0, 0)
+    if not m or not 0 <= start < end <= 24 * 60:
+        await message.answer('Не понял. Пример: 09:00-21:00')
+        return
+    await state.update_data(work_start=start, work_end=end)
+    await EditBooking.minutes.set()
+    await message.answer(f'Длительность тренировки в минутах (до {MAX_SESSION_MINUTES}), например: 60')
+
+@dp.message_handler(state=EditBooking.minutes)
+async def tprof_minutes_set(message: types.Message, state: FSMContext):
+    try:
+        minutes = int(message.text.strip())
+    except ValueError:
+        minutes = 0
+    if not 0 < minutes <= MAX_SESSION_MINUTES:
+        await message.answer(f'Введите число минут от 1 до {MAX_SESSION_MINUTES}. Например: 60')
+        return
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    data = await state.get_data()
+    await db.execute('UPDATE trainers SET work_start = ?, work_end = ?, session_minutes = ? WHERE id = ?',
+                     (data['work_start'], data['work_end'], minutes, tid))
+    await state.finish()
+    await message.answer('Часы работы и длительность тренировки сохранены ✅', reply_markup=TRAINER_KB)
+
+@router.route('tprof_pricing')
 async def tprof_pricing_menu(call: CallbackQuery):
-    tid = get_trainer_id_by_chat(call.message.chat.id)
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
     if not tid:
         await call.answer('Не тренер', show_alert=True); return
-    cur.execute('SELECT id, title, price FROM tariffs WHERE trainer_id = ? ORDER BY id DESC', (tid,))
-    tariffs = cur.fetchall()
+    tariffs = await db.fetchall('SELECT id, title, price FROM tariffs WHERE trainer_id = ? ORDER BY id DESC', (tid,))
     text = "Ваши тарифы/пакеты:\n"
     if tariffs:
         for t_id, title, price in tariffs:
@@ -787,7 +2460,7 @@ class AddTariff(StatesGroup):
     description = State()
     price = State()
 
-@dp.callback_query_handler(lambda c: c.data == 'tariff:add')
+@router.route('tariff:add')
 async def tariff_add_start(call: CallbackQuery, state: FSMContext):
     await AddTariff.title.set()
     await call.message.answer('Введите *название* тарифа/пакета:', parse_mode='Markdown')
@@ -813,23 +2486,21 @@ async def tariff_add_price(message: types.Message, state: FSMContext):
         await message.answer('Цена должна быть числом. Пример: 1500 или 1500.00')
         return
     data = await state.get_data()
-    tid = get_trainer_id_by_chat(message.chat.id)
-    cur.execute(
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    await db.execute(
         'INSERT INTO tariffs (trainer_id, title, description, price) VALUES (?, ?, ?, ?)',
         (tid, data['title'], data['description'], price)
     )
-    conn.commit()
     await state.finish()
     await message.answer('Тариф добавлен ✅', reply_markup=TRAINER_KB)
 
 class DeleteTariff(StatesGroup):
     tariff_id = State()
 
-@dp.callback_query_handler(lambda c: c.data == 'tariff:delete')
+@router.route('tariff:delete')
 async def tariff_delete_start(call: CallbackQuery, state: FSMContext):
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('SELECT id, title FROM tariffs WHERE trainer_id = ? ORDER BY id DESC', (tid,))
-    rows = cur.fetchall()
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    rows = await db.fetchall('SELECT id, title FROM tariffs WHERE trainer_id = ? ORDER BY id DESC', (tid,))
     if not rows:
         await call.message.answer('Удалять нечего — список пуст.')
         await call.answer(); return
@@ -845,18 +2516,50 @@ async def tariff_delete_confirm(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer('Нужно число — ID тарифа.')
         return
-    tid = get_trainer_id_by_chat(message.chat.id)
-    cur.execute('DELETE FROM tariffs WHERE id = ? AND trainer_id = ?', (t_id, tid))
-    conn.commit()
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    await db.execute('DELETE FROM tariffs WHERE id = ? AND trainer_id = ?', (t_id, tid))
     await state.finish()
     await message.answer('Тариф удалён ✅', reply_markup=TRAINER_KB)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('client:'))
-async def cb_client_card(call: CallbackQuery):
-    cid = int(call.data.split(':')[1])
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('SELECT id, name, phone, notes, balance, chat_id, trainer_id, status, tg_id, username FROM clients WHERE id = ?', (cid,))
-    r = cur.fetchone()
+# Тариф клиента: по его цене списывается каждая проведённая тренировка
+@router.route('client_tariff', CB_INT)
+async def cb_client_tariff(call: CallbackQuery, cid: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT trainer_id FROM clients WHERE id = ?', (cid,))
+    if not row or row[0] != tid:
+        await call.answer('Этот клиент не ваш.', show_alert=True)
+        return
+    tariffs = await db.fetchall('SELECT id, title, price FROM tariffs WHERE trainer_id = ? ORDER BY id', (tid,))
+    if not tariffs:
+        await call.answer('Сначала добавьте тариф в профиле.', show_alert=True)
+        return
+    kb = InlineKeyboardMarkup(row_width=1)
+    for t_id, title, price in tariffs:
+        kb.add(InlineKeyboardButton(f"{title} — {price:.2f}", callback_data=cb('set_tariff', cid, t_id)))
+    kb.add(InlineKeyboardButton('Без тарифа', callback_data=cb('set_tariff', cid, 0)))
+    await call.message.answer('Тариф клиента (цена списывается за каждую проведённую тренировку):', reply_markup=kb)
+    await call.answer()
+
+@router.route('set_tariff', CB_INT, CB_INT)
+async def cb_set_tariff(call: CallbackQuery, cid: int, t_id: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    def _set(c):
+        if t_id and not c.execute('SELECT 1 FROM tariffs WHERE id = ? AND trainer_id = ?', (t_id, tid)).fetchone():
+            return 0
+        return c.execute('UPDATE clients SET tariff_id = ? WHERE id = ? AND trainer_id = ?', (t_id or None, cid, tid)).rowcount
+    if not await db.transaction(_set):
+        await call.answer('Не получилось: клиент или тариф не ваш.', show_alert=True)
+        return
+    await call.message.edit_reply_markup(None)
+    await call.answer('Тариф назначен ✅' if t_id else 'Тариф снят')
+
+@router.route('client', CB_INT)
+async def cb_client_card(call: CallbackQuery, cid: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    r = await db.fetchone('''SELECT c.id, c.name, c.phone, c.notes, c.balance, c.chat_id, c.trainer_id, c.status, c.tg_id, c.username,
+                                    t.title, t.price
+                             FROM clients c LEFT JOIN tariffs t ON t.id = c.tariff_id AND t.trainer_id = c.trainer_id
+                             WHERE c.id = ?''', (cid,))
     if not r:
         await call.answer('Клиент не найден', show_alert=True)
         return
@@ -869,6 +2572,7 @@ async def cb_client_card(call: CallbackQuery):
         f"Телефон: {r[2]}\n"
         f"Примечание: {r[3]}\n"
         f"Баланс: {r[4]:.2f}\n"
+        f"Тариф: {f'{r[10]} — {r[11]:.2f} за тренировку' if r[10] else 'не назначен'}\n"
         f"Chat_id: {r[5]}\n"
         f"TG: @{r[9] or '-'} (id={r[8]})\n"
         f"Статус: {r[7]}"
@@ -881,12 +2585,10 @@ async def cb_client_card(call: CallbackQuery):
     await call.answer()
 
 # Удаление клиента тренером (с подтверждением)
-@dp.callback_query_handler(lambda c: c.data.startswith('delete_client:'))
-async def cb_delete_client(call: CallbackQuery):
-    cid = int(call.data.split(':')[1])
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('SELECT name, trainer_id FROM clients WHERE id = ?', (cid,))
-    row = cur.fetchone()
+@router.route('delete_client', CB_INT)
+async def cb_delete_client(call: CallbackQuery, cid: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT name, trainer_id FROM clients WHERE id = ?', (cid,))
     if not row:
         await call.answer('Клиент не найден', show_alert=True); return
     if row[1] != tid:
@@ -894,30 +2596,31 @@ async def cb_delete_client(call: CallbackQuery):
     name = row[0]
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
-        InlineKeyboardButton('✅ Да, удалить', callback_data=f"confirm_del_client:{cid}"),
+        InlineKeyboardButton('✅ Да, удалить', callback_data=cb('confirm_del_client', cid)),
         InlineKeyboardButton('❌ Отмена', callback_data="cancel_del_client")
     )
     await call.message.answer(f'Удалить клиента {name}? Это удалит его тренировки и платежи безвозвратно.', reply_markup=kb)
     await call.answer()
 
-@dp.callback_query_handler(lambda c: c.data == 'cancel_del_client')
+@router.route('cancel_del_client')
 async def cb_cancel_del_client(call: CallbackQuery):
     await call.answer('Отменено')
     await call.message.edit_reply_markup(None)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('confirm_del_client:'))
-async def cb_confirm_del_client(call: CallbackQuery):
-    cid = int(call.data.split(':')[1])
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('SELECT trainer_id, chat_id FROM clients WHERE id = ?', (cid,))
-    row = cur.fetchone()
+@router.route('confirm_del_client', CB_INT)
+async def cb_confirm_del_client(call: CallbackQuery, cid: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT trainer_id, chat_id FROM clients WHERE id = ?', (cid,))
     if not row or row[0] != tid:
         await call.answer('Этот клиент не относится к вам.', show_alert=True); return
     client_chat = row[1]
-    cur.execute('DELETE FROM sessions WHERE client_id = ?', (cid,))
-    cur.execute('DELETE FROM payments WHERE client_id = ?', (cid,))
-    cur.execute('DELETE FROM clients WHERE id = ?', (cid,))
-    conn.commit()
+    def _delete(c):
+        archive_forget(c, cid)
+        c.execute('DELETE FROM sessions WHERE client_id = ?', (cid,))
+        c.execute('DELETE FROM payments WHERE client_id = ?', (cid,))
+        c.execute('DELETE FROM clients WHERE id = ?', (cid,))
+    await db.transaction(_delete)
+    identity_cache.invalidate(client_chat)
     await call.answer('Клиент удалён ✅')
     await call.message.edit_reply_markup(None)
     await call.message.answer('Клиент и связанные записи удалены.', reply_markup=TRAINER_KB)
@@ -927,46 +2630,249 @@ async def cb_confirm_del_client(call: CallbackQuery):
         except Exception:
             pass
 
-# Добавление тренировки (тренер) + авто-слоты
-@dp.callback_query_handler(lambda c: c.data.startswith('add_session:'))
-async def cb_add_session(call: CallbackQuery, state: FSMContext):
-    cid = int(call.data.split(':')[1])
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('SELECT trainer_id FROM clients WHERE id = ?', (cid,))
-    row = cur.fetchone()
+# --- Серии тренировок ---
+SERIES_DAYS = {'пн': 'MO', 'вт': 'TU', 'ср': 'WE', 'чт': 'TH', 'пт': 'FR', 'сб': 'SA', 'вс': 'SU'}
+_SERIES_PERIODS = {'DAILY': timedelta(days=1), 'WEEKLY': timedelta(days=7)}
+_SERIES_PERIODIC_KEYS = {'FREQ', 'INTERVAL', 'BYDAY', 'BYHOUR', 'BYMINUTE', 'BYSECOND', 'WKST'}
+
+def series_period(rule: str):
+    """Период, через который правило повторяется целиком (None — не периодично)."""
+    parts = dict(p.split('=', 1) for p in rule.upper().split(';') if '=' in p)
+    base = _SERIES_PERIODS.get(parts.get('FREQ'))
+    if base is None or not parts.keys() <= _SERIES_PERIODIC_KEYS:
+        return None
+    return base * int(parts.get('INTERVAL', '1'))
+
+@lru_cache(maxsize=4096)
+def _series_pattern(rule: str, dtstart: datetime):
+    """(период, смещения повторений от начала периода) — правило разворачивается
+    dateutil один раз на первом периоде, дальше — сложением."""
+    period = series_period(rule)
+    if period is None:
+        return None, ()
+    first = rrulestr(rule, dtstart=dtstart).between(dtstart, dtstart + period, inc=True)
+    return period, tuple(o - dtstart for o in first if o < dtstart + period)
+
+def expand_series(rule: str, dtstart: datetime, start: datetime, end: datetime, until: datetime = None) -> list:
+    """Повторения в [start, end). Стоимость зависит от окна, а не от возраста серии:
+    периодичное правило начинается с ближайшего к start периода."""
+    if until is not None:
+        end = min(end, until)
+    if end <= start:
+        return []
+    period, offsets = _series_pattern(rule, dtstart)
+    if period is None:
+        return [o for o in rrulestr(rule, dtstart=dtstart).between(start, end, inc=True) if o < end]
+    base, out = dtstart + period * max(0, (start - dtstart) // period), []
+    while base < end:
+        out += [base + off for off in offsets if start <= base + off < end]
+        base += period
+    return out
+
+def series_occurrences(conn, start: datetime, end: datetime, trainer_id: int = None, client_id: int = None,
+                       series_id: int = None) -> list:
+    """Виртуальные тренировки серий в [start, end) по возрастанию времени:
+    (series_id, client_id, имя клиента, trainer_id, время, длительность, комментарий).
+    Уже появившиеся в sessions и отменённые повторения пропускаются."""
+    where, params = ['s.dtstart < ?', '(s.until IS NULL OR s.until > ?)'], [end.isoformat(), start.isoformat()]
+    for col, val in (('s.trainer_id', trainer_id), ('s.client_id', client_id), ('s.id', series_id)):
+        if val is not None:
+            where.append(f'{col} = ?')
+            params.append(val)
+    found = []
+    for sid, cid, cname, tid, rule, dtstart, until, dur, comment in conn.execute(
+            f"SELECT s.id, s.client_id, c.name, s.trainer_id, s.rule, s.dtstart, s.until, s.duration, s.comment "
+            f"FROM series s LEFT JOIN clients c ON c.id = s.client_id WHERE {' AND '.join(where)}", params).fetchall():
+        occ = expand_series(rule, datetime.fromisoformat(dtstart), start, end,
+                            datetime.fromisoformat(until) if until else None)
+        found += [(sid, cid, cname, tid, o, dur, comment) for o in occ]
+    if not found:
+        return []
+    # исключения всех серий окна — по (series_id, occurrence) двумя запросами на пачку
+    ids, taken = list({r[0] for r in found}), set()
+    until = archive_until(conn, 'sessions')
+    sources = ('main.sessions', 'series_skips') + (('archive.sessions',) if until is not None and start.isoformat() <= until else ())
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        marks = ','.join('?' * len(chunk))
+        taken.update(conn.execute(' UNION ALL '.join(
+            f'SELECT series_id, occurrence FROM {src} WHERE series_id IN ({marks}) AND occurrence >= ? AND occurrence < ?'
+            for src in sources), (*chunk, start.isoformat(), end.isoformat()) * len(sources)))
+    out = [r for r in found if (r[0], r[4].isoformat()) not in taken]
+    out.sort(key=lambda r: r[4])
+    return out
+
+def materialize_occurrence(conn, series_id: int, when: datetime, status: str = 'planned'):
+    """Строка sessions для повторения серии (если её ещё нет); возвращает id строки."""
+    conn.execute(
+        'INSERT OR IGNORE INTO sessions (client_id, trainer_id, datetime, duration, comment, status, series_id, occurrence) '
+        'SELECT client_id, trainer_id, ?, duration, comment, ?, id, ? FROM series WHERE id = ?',
+        (when.isoformat(), status, when.isoformat(), series_id))
+    row = conn.execute('SELECT id FROM sessions WHERE series_id = ? AND occurrence = ?',
+                       (series_id, when.isoformat())).fetchone()
+    return row[0] if row else None
+
+def materialize_window(conn, start: datetime, end: datetime, series_id: int = None) -> list:
+    """Все повторения серий в [start, end) — в sessions (нужно напоминаниям). [(id, время)]."""
+    return [(materialize_occurrence(conn, sid, when), when)
+            for sid, _, _, _, when, _, _ in series_occurrences(conn, start, end, series_id=series_id)]
+
+def parse_series(text: str, now: datetime):
+    """«Пн,Ср 18:00» → (rule, первое повторение не раньше now) или None."""
+    days = [SERIES_DAYS[d] for d in re.findall(r'пн|вт|ср|чт|пт|сб|вс', text.lower())]
+    tm = re.search(r'(\d{1,2}):(\d{2})', text)
+    if not days or not tm or int(tm[1]) > 23 or int(tm[2]) > 59:
+        return None
+    rule = f"FREQ=WEEKLY;BYDAY={','.join(dict.fromkeys(days))}"
+    at = now.replace(hour=int(tm[1]), minute=int(tm[2]), second=0, microsecond=0)
+    return rule, rrulestr(rule, dtstart=at).after(now, inc=True)
+
+def series_label(rule: str, dtstart: str) -> str:
+    names = {v: k.capitalize() for k, v in SERIES_DAYS.items()}
+    parts = dict(p.split('=', 1) for p in rule.split(';') if '=' in p)
+    days = ','.join(names.get(d, d) for d in parts.get('BYDAY', '').split(',') if d)
+    return f"{days} {datetime.fromisoformat(dtstart):%H:%M}"
+
+# --- Свободные слоты и пересечения ---
+MAX_SESSION_MINUTES = 240
+SLOT_STEP = 30           # шаг сетки слотов, минут
+SLOT_COUNT = 6
+SLOT_HORIZON = timedelta(days=60)
+SLOT_WINDOW = timedelta(days=7)  # сколько календаря читается за один запрос
+
+def _bookings(conn, tid: int, start: datetime, end: datetime) -> list:
+    """Тренировки тренера (строки и повторения серий), начинающиеся в
+    (start - MAX_SESSION_MINUTES, end): [(начало, конец, id, series_id)] по времени."""
+    lo = start - timedelta(minutes=MAX_SESSION_MINUTES)
+    out = [(datetime.fromisoformat(dt_iso), datetime.fromisoformat(dt_iso) + timedelta(minutes=dur or 0), sid, None)
+           for sid, dt_iso, dur in conn.execute(
+               "SELECT id, datetime, duration FROM sessions WHERE trainer_id = ? AND datetime > ? AND datetime < ? "
+               "AND status <> 'cancelled' ORDER BY datetime", (tid, lo.isoformat(), end.isoformat()))]
+    series = series_occurrences(conn, lo + timedelta(microseconds=1), end, trainer_id=tid)
+    if series:
+        out += [(when, when + timedelta(minutes=dur), None, ser) for ser, _, _, _, when, dur, _ in series]
+        out.sort(key=lambda b: b[0])
+    return out
+
+def booked_intervals(conn, tid: int, start: datetime, end: datetime) -> tuple:
+    """Занятые интервалы тренера, пересекающие [start, end), слитые и
+    отсортированные: (начала, концы). Читается только диапазон индекса."""
+    starts, ends = [], []
+    for s, e, _, _ in _bookings(conn, tid, start, end):
+        if e <= start:
+            continue
+        if ends and s <= ends[-1]:
+            ends[-1] = max(ends[-1], e)
+        else:
+            starts.append(s)
+            ends.append(e)
+    return starts, ends
+
+def find_conflict(conn, tid: int, start: datetime, minutes: int):
+    """Первая тренировка тренера, пересекающаяся с [start, start + minutes):
+    (начало, конец, id, series_id) — у повторения серии id нет — или None."""
+    for b in _bookings(conn, tid, start, start + timedelta(minutes=minutes)):
+        if b[1] > start:
+            return b
+    return None
+
+def trainer_booking(conn, tid: int) -> tuple:
+    """(work_start, work_end, session_minutes) тренера."""
+    row = conn.execute('SELECT work_start, work_end, session_minutes FROM trainers WHERE id = ?', (tid,)).fetchone()
+    return row if row and None not in row else (540, 1260, 60)
+
+WEEKDAYS = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+
+def _ceil_step(dt: datetime, step: int) -> datetime:
+    """Округление вверх до сетки step минут от полуночи."""
+    if dt.second or dt.microsecond:
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    return dt + timedelta(minutes=-(dt.hour * 60 + dt.minute) % step)
+
+def free_slots(conn, tid: int, after: datetime, count: int = SLOT_COUNT, step: int = SLOT_STEP,
+               horizon: timedelta = SLOT_HORIZON) -> list:
+    """Ближайшие count начал тренировок в рабочие часы тренера, не пересекающихся
+    с занятыми интервалами. Календарь читается окнами по SLOT_WINDOW, занятый
+    интервал перепрыгивается целиком через bisect, так что время зависит от
+    числа тренировок в просмотренных днях, а не от всей истории тренера."""
+    work_start, work_end, minutes = trainer_booking(conn, tid)
+    length = timedelta(minutes=minutes)
+    t, limit, out = _ceil_step(after, step), after + horizon, []
+    while len(out) < count and t < limit:
+        window_end = min(t + SLOT_WINDOW, limit)
+        starts, ends = booked_intervals(conn, tid, t, window_end + length)
+        while len(out) < count and t < window_end:
+            day = t.replace(hour=0, minute=0)
+            open_at, close_at = day + timedelta(minutes=work_start), day + timedelta(minutes=work_end)
+            if t < open_at:
+                t = _ceil_step(open_at, step)
+                continue
+            if t + length > close_at:
+                t = _ceil_step(day + timedelta(days=1, minutes=work_start), step)
+                continue
+            i = bisect_right(ends, t)
+            if i < len(starts) and starts[i] < t + length:
+                t = _ceil_step(ends[i], step)
+                continue
+            out.append(t)
+            t = _ceil_step(t + length, step)
+    return out
+
+def slot_conflict(conn, tid: int, when: datetime):
+    """Пересечение тренировки длительностью по умолчанию тренера, начинающейся в when."""
+    return find_conflict(conn, tid, when, trainer_booking(conn, tid)[2])
+
+def book_session(conn, tid: int, cid: int, when: datetime, comment: str):
+    """Вставка тренировки, если время свободно (в потоке-писателе — без гонок
+    между проверкой и вставкой). Возвращает (id, None) или (None, конфликт)."""
+    minutes = trainer_booking(conn, tid)[2]
+    conflict = find_conflict(conn, tid, when, minutes)
+    if conflict:
+        return None, conflict
+    c = conn.execute('INSERT INTO sessions (client_id, datetime, comment, duration, trainer_id) VALUES (?, ?, ?, ?, ?)',
+                     (cid, when.isoformat(), comment, minutes, tid))
+    return c.lastrowid, None
+
+def slots_kb(cid: int, slots) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup(row_width=3)
+    kb.add(*[InlineKeyboardButton(f"{WEEKDAYS[s.weekday()]} {s:%d.%m %H:%M}",
+                                  callback_data=cb('slot', cid, s, fields=(CB_INT, CB_DT))) for s in slots])
+    kb.add(InlineKeyboardButton('📝 Ввести вручную', callback_data='slot_manual'))
+    return kb
+
+def conflict_text(conflict) -> str:
+    start, end, sid, series_id = conflict
+    what = f"тренировка id={sid}" if sid else f"серия #{series_id}"
+    return f"Время занято: {what} {start:%d.%m %H:%M}–{end:%H:%M}."
+
+# Добавление тренировки (тренер) + свободные слоты
+@router.route('add_session', CB_INT)
+async def cb_add_session(call: CallbackQuery, cid: int, state: FSMContext):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT trainer_id FROM clients WHERE id = ?', (cid,))
     if not row or row[0] != tid:
         await call.answer('Этот клиент не ваш.', show_alert=True)
         return
     await state.update_data(client_id=cid)
-    now = datetime.utcnow()
-    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    tomorrow = today + timedelta(days=1)
-    def iso(day, h): return (day + timedelta(hours=h)).isoformat()
-    kb = InlineKeyboardMarkup(row_width=3)
-    kb.row(
-        InlineKeyboardButton('Сегодня 09:00', callback_data=f"slot:{cid}:{iso(today,9)}"),
-        InlineKeyboardButton('Сегодня 12:00', callback_data=f"slot:{cid}:{iso(today,12)}"),
-        InlineKeyboardButton('Сегодня 18:00', callback_data=f"slot:{cid}:{iso(today,18)}")
-    )
-    kb.row(
-        InlineKeyboardButton('Завтра 09:00', callback_data=f"slot:{cid}:{iso(tomorrow,9)}"),
-        InlineKeyboardButton('Завтра 12:00', callback_data=f"slot:{cid}:{iso(tomorrow,12)}"),
-        InlineKeyboardButton('Завтра 18:00', callback_data=f"slot:{cid}:{iso(tomorrow,18)}")
-    )
-    kb.add(InlineKeyboardButton('📝 Ввести вручную', callback_data='slot_manual'))
-    await call.message.answer('Выберите слот или введите вручную:', reply_markup=kb)
+    slots = await db.read(free_slots, tid, datetime.utcnow())
+    text = 'Ближайшее свободное время:' if slots else f'Свободного времени в ближайшие {SLOT_HORIZON.days} дней нет.'
+    await call.message.answer(text + ' Выберите слот или введите вручную:', reply_markup=slots_kb(cid, slots))
     await AddSession.when.set()
     await call.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith('slot:'))
-async def cb_pick_slot(call: CallbackQuery, state: FSMContext):
-    _, cid, dt_iso = call.data.split(':', 2)
-    await state.update_data(client_id=int(cid), when=datetime.fromisoformat(dt_iso))
+@router.route('slot', CB_INT, CB_DT, state='*')
+async def cb_pick_slot(call: CallbackQuery, cid: int, when: datetime, state: FSMContext):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    conflict = await db.read(slot_conflict, tid, when)
+    if conflict:
+        await call.answer(conflict_text(conflict), show_alert=True)
+        return
+    await state.update_data(client_id=cid, when=when)
     await AddSession.comment.set()
     await call.message.answer('Комментарий (или "-" чтобы пропустить):')
     await call.answer()
 
-@dp.callback_query_handler(lambda c: c.data == 'slot_manual')
+@router.route('slot_manual', state='*')
 async def cb_slot_manual(call: CallbackQuery):
     await call.message.answer('Ожидаю ввод даты и времени в формате: ДД.ММ.ГГГГ ЧЧ:ММ (24ч).\nНапример: 12.08.2025 18:00')
     await call.answer()
@@ -978,6 +2884,13 @@ async def st_add_session_when(message: types.Message, state: FSMContext):
     except Exception:
         await message.answer('Не удалось распознать дату. Формат: ДД.ММ.ГГГГ ЧЧ:ММ. Пример: 12.08.2025 18:00')
         return
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    conflict = await db.read(slot_conflict, tid, dt)
+    if conflict:
+        data = await state.get_data()
+        slots = await db.read(free_slots, tid, max(dt, datetime.utcnow()))
+        await message.answer(conflict_text(conflict) + ' Свободное время рядом:', reply_markup=slots_kb(data['client_id'], slots))
+        return
     await state.update_data(when=dt)
     await AddSession.comment.set()
     await message.answer('Комментарий (или "-" чтобы пропустить):')
@@ -986,20 +2899,122 @@ async def st_add_session_when(message: types.Message, state: FSMContext):
 async def st_add_session_comment(message: types.Message, state: FSMContext):
     data = await state.get_data()
     comment = '' if message.text.strip() == '-' else message.text.strip()
-    dt_iso = data['when'].isoformat()
-    cur.execute('INSERT INTO sessions (client_id, datetime, comment) VALUES (?, ?, ?)', (data['client_id'], dt_iso, comment))
-    conn.commit()
-    sid = cur.lastrowid
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    # время могли занять, пока вводили комментарий — проверка и вставка одной транзакцией
+    sid, conflict = await db.transaction(book_session, tid, data['client_id'], data['when'], comment)
+    if conflict:
+        slots = await db.read(free_slots, tid, max(data['when'], datetime.utcnow()))
+        await AddSession.when.set()
+        await message.answer(conflict_text(conflict) + ' Выберите другое время:', reply_markup=slots_kb(data['client_id'], slots))
+        return
+    reminder_scheduler.schedule_session(sid, data['when'])
     await state.finish()
     await message.answer(f"Сессия добавлена (id={sid}) на {data['when'].strftime('%d.%m.%Y %H:%М')}", reply_markup=TRAINER_KB)
 
+# Серии (тренер): «каждый Пн и Ср в 18:00» одной записью
+async def build_series_list(cid: int):
+    rows = await db.fetchall('SELECT id, rule, dtstart, until FROM series WHERE client_id = ? ORDER BY id', (cid,))
+    now = datetime.utcnow().isoformat()
+    active = [(ser, rule, dtstart) for ser, rule, dtstart, until in rows if until is None or until > now]
+    kb = InlineKeyboardMarkup(row_width=1)
+    for ser, rule, dtstart in active:
+        kb.add(InlineKeyboardButton(f"⏹ Остановить #{ser}: {series_label(rule, dtstart)}", callback_data=cb('series_stop', ser)))
+    kb.add(InlineKeyboardButton('➕ Новая серия', callback_data=cb('series_add', cid)))
+    text = (f"Серии клиента ({len(active)}):\n" + "\n".join(
+        f"#{ser}: {series_label(rule, dtstart)} с {datetime.fromisoformat(dtstart):%d.%m.%Y}" for ser, rule, dtstart in active)
+        if active else 'У клиента нет активных серий.')
+    return text, kb
+
+@router.route('series', CB_INT)
+async def cb_series(call: CallbackQuery, cid: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT trainer_id FROM clients WHERE id = ?', (cid,))
+    if not row or row[0] != tid:
+        await call.answer('Этот клиент не ваш.', show_alert=True)
+        return
+    text, kb = await build_series_list(cid)
+    await call.message.answer(text, reply_markup=kb)
+    await call.answer()
+
+@router.route('series_add', CB_INT)
+async def cb_series_add(call: CallbackQuery, cid: int, state: FSMContext):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT trainer_id FROM clients WHERE id = ?', (cid,))
+    if tid is None or not row or row[0] != tid:
+        await call.answer('Этот клиент не относится к вам.', show_alert=True)
+        return
+    await state.update_data(client_id=cid)
+    await AddSeries.rule.set()
+    await call.message.answer('Дни недели и время, например: Пн,Ср 18:00 — каждую неделю, пока серию не остановят.')
+    await call.answer()
+
+@dp.message_handler(state=AddSeries.rule)
+async def st_series_rule(message: types.Message, state: FSMContext):
+    parsed = parse_series(message.text or '', datetime.utcnow())
+    if not parsed:
+        await message.answer('Не понял. Пример: Пн,Ср 18:00')
+        return
+    rule, first = parsed
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    cid = (await state.get_data())['client_id']
+    if tid is None:
+        await state.finish()
+        await message.answer('Этот клиент не относится к вам.')
+        return
+
+    def _create(c):
+        # клиента могли передать другому тренеру, пока вводили правило
+        owner = c.execute('SELECT trainer_id FROM clients WHERE id = ?', (cid,)).fetchone()
+        if not owner or owner[0] != tid:
+            return None, None
+        minutes = trainer_booking(c, tid)[2]
+        for when in expand_series(rule, first, first, first + SLOT_HORIZON):
+            conflict = find_conflict(c, tid, when, minutes)
+            if conflict:
+                return None, conflict
+        cur = c.execute('INSERT INTO series (client_id, trainer_id, rule, dtstart, duration, comment) VALUES (?, ?, ?, ?, ?, ?)',
+                        (cid, tid, rule, first.isoformat(), minutes, ''))
+        return cur.lastrowid, None
+    ser, conflict = await db.transaction(_create)
+    if ser is None and conflict is None:
+        await state.finish()
+        await message.answer('Этот клиент не относится к вам.', reply_markup=TRAINER_KB)
+        return
+    if conflict:
+        await message.answer(conflict_text(conflict) + ' Выберите другие дни или время.')
+        return
+    await reminder_scheduler.add_series(ser)
+    await state.finish()
+    await message.answer(f"Серия #{ser} создана: {series_label(rule, first.isoformat())}, первая — {first:%d.%m.%Y %H:%M}",
+                         reply_markup=TRAINER_KB)
+
+async def stop_series(ser: int):
+    """Серия заканчивается сейчас; будущие непроведённые строки повторений удаляются."""
+    now = datetime.utcnow().isoformat()
+    def _stop(c):
+        c.execute('UPDATE series SET until = ? WHERE id = ?', (now, ser))
+        sids = [r[0] for r in c.execute("SELECT id FROM sessions WHERE series_id = ? AND status = 'planned' AND datetime > ?",
+                                        (ser, now))]
+        c.executemany('DELETE FROM sessions WHERE id = ?', [(sid,) for sid in sids])
+        return sids
+    for sid in await db.transaction(_stop):
+        reminder_scheduler.cancel_session(sid)
+
+@router.route('series_stop', CB_INT)
+async def cb_series_stop(call: CallbackQuery, ser: int):
+    if not await _own_series(call, ser):
+        return
+    await stop_series(ser)
+    cid = (await db.fetchone('SELECT client_id FROM series WHERE id = ?', (ser,)))[0]
+    text, kb = await build_series_list(cid)
+    await call.message.edit_text(text, reply_markup=kb)
+    await call.answer('Серия остановлена')
+
 # Платёж (тренер)
-@dp.callback_query_handler(lambda c: c.data.startswith('add_payment:'))
-async def cb_add_payment(call: CallbackQuery, state: FSMContext):
-    cid = int(call.data.split(':')[1])
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('SELECT trainer_id FROM clients WHERE id = ?', (cid,))
-    row = cur.fetchone()
+@router.route('add_payment', CB_INT)
+async def cb_add_payment(call: CallbackQuery, cid: int, state: FSMContext):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('SELECT trainer_id FROM clients WHERE id = ?', (cid,))
     if not row or row[0] != tid:
         await call.answer('Этот клиент не ваш.', show_alert=True)
         return
@@ -1024,131 +3039,1323 @@ async def st_payment_note(message: types.Message, state: FSMContext):
     data = await state.get_data()
     note = '' if message.text.strip() == '-' else message.text.strip()
     now = datetime.utcnow().isoformat()
-    cur.execute('INSERT INTO payments (client_id, amount, date, note) VALUES (?, ?, ?, ?)', (data['client_id'], data['amount'], now, note))
-    cur.execute('UPDATE clients SET balance = balance + ? WHERE id = ?', (data['amount'], data['client_id']))
-    conn.commit()
+    # баланс клиента обновляет триггер журнала
+    await db.execute('INSERT INTO payments (client_id, amount, date, note) VALUES (?, ?, ?, ?)', (data['client_id'], data['amount'], now, note))
     await state.finish()
     await message.answer(f"Платёж записан: client={data['client_id']}, amount={data['amount']:.2f}", reply_markup=TRAINER_KB)
 
-# Расписание (тренер) с завершением сессий
+# --- Расписание тренера ---
+# Неделя или день — окно [start, start + длина): строки sessions по
+# idx_sessions_trainer_dt и повторения серий того же окна, ничего сверх видимого.
+# Курсор — начало окна в callback_data; листание и отметки правят то же сообщение.
+# Неделя — сводка текстом и кнопки дней, кнопки тренировок — только в виде дня.
+SCHEDULE_VIEWS = {'w': timedelta(days=7), 'd': timedelta(days=1)}
+SCHEDULE_BUTTONS = 90  # Telegram принимает до 100 кнопок; остаток — под навигацию
+SCHED = (CB_STR, CB_DT)  # вид, начало окна
+
+def schedule_start(view: str, when: datetime) -> datetime:
+    day = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday()) if view == 'w' else day
+
+def schedule_window(conn, tid: int, start: datetime, end: datetime) -> list:
+    """[(время, id строки | None, статус, клиент, серия | None)] в [start, end) по времени."""
+    params = (tid, start.isoformat(), end.isoformat())
+    sql = ("SELECT s.id, s.datetime, s.status, c.name FROM main.sessions s LEFT JOIN clients c ON c.id = s.client_id "
+           "WHERE s.trainer_id = ? AND s.datetime >= ? AND s.datetime < ? AND s.status <> 'cancelled'")
+    until = archive_until(conn, 'sessions')
+    if until is not None and params[1] <= until:  # архив — только при листании в прошлое
+        sql += (" UNION ALL SELECT s.id, s.datetime, s.status, c.name FROM archive.sessions s "
+                "LEFT JOIN clients c ON c.id = s.client_id WHERE s.trainer_id = ? AND s.datetime >= ? AND s.datetime < ?")
+        params *= 2
+    rows = [(datetime.fromisoformat(dt_iso), sid, status, cname, None)
+            for sid, dt_iso, status, cname in conn.execute(sql, params)]
+    rows += [(when, None, 'planned', cname, ser)
+             for ser, _, cname, _, when, _, _ in series_occurrences(conn, start, end, tid)]
+    rows.sort(key=lambda r: r[0])
+    return rows
+
+def complete_overdue(conn, tid: int, start: datetime, end: datetime) -> list:
+    """Все планы тренера в [start, end) — проведены; повторения серий получают строки. -> id строк."""
+    done = [materialize_occurrence(conn, ser, when, 'completed')
+            for ser, _, _, _, when, _, _ in series_occurrences(conn, start, end, tid)]
+    sids = [r[0] for r in conn.execute(
+        "SELECT id FROM sessions WHERE trainer_id = ? AND datetime >= ? AND datetime < ? AND status = 'planned'",
+        (tid, start.isoformat(), end.isoformat()))]
+    conn.executemany("UPDATE sessions SET status = 'completed' WHERE id = ?", [(sid,) for sid in sids])
+    return done + sids
+
+def _schedule_line(row, now: datetime) -> str:
+    when, _, status, cname, ser = row
+    icon = '✅' if status == 'completed' else ('❗' if when < now else '▫️')
+    return f"{when:%H:%M} {icon} {cname or '—'}{' 🔁' if ser else ''}"
+
+async def build_schedule(tid: int, view: str, start: datetime):
+    now = datetime.utcnow()
+    end = start + SCHEDULE_VIEWS[view]
+    rows = await db.read(schedule_window, tid, start, end)
+    if view == 'w':
+        header = f"📅 Неделя {start:%d.%m}–{end - timedelta(days=1):%d.%m}"
+    else:
+        header = f"📅 {WEEKDAYS[start.weekday()]} {start:%d.%m.%Y}"
+    lines, size, day, shown = [header], len(header), None, 0
+    for row in rows:
+        add = []
+        if view == 'w' and row[0].date() != day:
+            day = row[0].date()
+            add.append(f"\n{WEEKDAYS[day.weekday()]} {day:%d.%m}")
+        add.append(_schedule_line(row, now))
+        # место под строку-пояснение в конце
+        if size + sum(len(x) + 1 for x in add) + 80 > MESSAGE_LIMIT:
+            break
+        lines += add
+        size += sum(len(x) + 1 for x in add)
+        shown += 1
+    if not rows:
+        lines.append('Тренировок нет.')
+    elif shown < len(rows):
+        lines.append(f"… и ещё {len(rows) - shown} — откройте день кнопкой ниже.")
+
+    kb = InlineKeyboardMarkup(row_width=4)
+    if view == 'w':
+        counts = {}
+        for row in rows:
+            d = row[0].replace(hour=0, minute=0, second=0, microsecond=0)
+            counts[d] = counts.get(d, 0) + 1
+        kb.add(*[InlineKeyboardButton(f"{WEEKDAYS[d.weekday()]} {d:%d} ({n})", callback_data=cb('sched', 'd', d, fields=SCHED))
+                 for d, n in counts.items()])
+    else:
+        buttons = 0
+        for when, sid, status, cname, ser in rows:
+            if status != 'planned':
+                continue
+            if buttons + 2 > SCHEDULE_BUTTONS:
+                lines.append(f"Кнопок хватило на {buttons} тренировок, остальные — «Отметить прошедшие».")
+                break
+            label = f"✅ {when:%H:%M} {cname or '—'}"[:40]
+            if ser is None:
+                kb.row(InlineKeyboardButton(label, callback_data=cb('done_session', sid)))
+                buttons += 1
+            else:
+                # повторение серии: строки в sessions ещё нет, адресуется (серия, время)
+                kb.row(InlineKeyboardButton(label + ' 🔁', callback_data=cb('occ_done', ser, when, fields=(CB_INT, CB_DT))),
+                       InlineKeyboardButton('✖️', callback_data=cb('occ_skip', ser, when, fields=(CB_INT, CB_DT))))
+                buttons += 2
+    overdue = sum(1 for r in rows if r[2] == 'planned' and r[0] < now)
+    if overdue:
+        kb.row(InlineKeyboardButton(f"✅ Отметить прошедшие ({overdue})",
+                                    callback_data=cb('sched_bulk', view, start, fields=SCHED)))
+    step = SCHEDULE_VIEWS[view]
+    kb.row(InlineKeyboardButton('⬅️', callback_data=cb('sched', view, start - step, fields=SCHED)),
+           InlineKeyboardButton('Сегодня' if view == 'w' else '🗓 Неделя',
+                                callback_data=cb('sched', 'w', schedule_start('w', now if view == 'w' else start), fields=SCHED)),
+           InlineKeyboardButton('➡️', callback_data=cb('sched', view, start + step, fields=SCHED)))
+    return '\n'.join(lines), kb
+
+async def edit_view(message: types.Message, text: str, kb: InlineKeyboardMarkup):
+    """Перерисовка сообщения-представления: без запроса, если ничего не изменилось,
+    и одной клавиатурой, если текст тот же."""
+    try:
+        if message.text != text:
+            await message.edit_text(text, reply_markup=kb)
+        elif message.reply_markup is None or message.reply_markup.to_python() != kb.to_python():
+            await message.edit_reply_markup(kb)
+    except MessageNotModified:
+        pass
+
+async def show_schedule(call: CallbackQuery, view: str, start: datetime):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    text, kb = await build_schedule(tid, view, schedule_start(view, start))
+    await edit_view(call.message, text, kb)
+
 @dp.message_handler(lambda m: m.text == '📅 Расписание')
 async def trainer_schedule(message: types.Message):
-    tid = get_trainer_id_by_chat(message.chat.id)
+    tid = await get_trainer_id_by_chat(message.chat.id)
     if not tid:
         await message.answer('Только для тренера.', reply_markup=CLIENT_KB)
         return
-    now = datetime.utcnow()
-    end = now + timedelta(days=30)
-    cur.execute('''SELECT s.id, s.client_id, s.datetime, s.status, c.name
-                   FROM sessions s LEFT JOIN clients c ON s.client_id=c.id
-                   WHERE c.trainer_id = ? AND s.datetime BETWEEN ? AND ?
-                   ORDER BY s.datetime''', (tid, now.isoformat(), end.isoformat()))
-    rows = cur.fetchall()
-    if not rows:
-        await message.answer('Нет тренировок в ближайшие 30 дней.', reply_markup=TRAINER_KB)
+    text, kb = await build_schedule(tid, 'w', schedule_start('w', datetime.utcnow()))
+    await message.answer(text, reply_markup=kb)
+
+@router.route('sched', *SCHED)
+async def cb_schedule(call: CallbackQuery, view: str, start: datetime):
+    if not await get_trainer_id_by_chat(call.message.chat.id):
+        await call.answer('Только для тренера.', show_alert=True)
         return
-    kb = InlineKeyboardMarkup(row_width=1)
-    for sid, _, dt_iso, status, cname in rows[:50]:
-        dt = datetime.fromisoformat(dt_iso).strftime('%d.%m %H:%M')
-        label = f"{sid}: {dt} — {cname} — {status}"
-        if status != 'completed':
-            kb.add(InlineKeyboardButton(f"✅ Завершить {label}", callback_data=f"done_session:{sid}"))
-        else:
-            kb.add(InlineKeyboardButton(f"✅ Завершено — {label}", callback_data="noop"))
-    await message.answer('Ваше расписание (30 дней):', reply_markup=kb)
-
-# Завершение сессии кнопкой
-@dp.callback_query_handler(lambda c: c.data.startswith('done_session:'))
-async def cb_done_session(call: CallbackQuery):
-    sid = int(call.data.split(':')[1])
-    tid = get_trainer_id_by_chat(call.message.chat.id)
-    cur.execute('''SELECT s.id FROM sessions s
+    if view not in SCHEDULE_VIEWS or start is None:
+        view, start = 'w', datetime.utcnow()
+    await show_schedule(call, view, start)
+    await call.answer()
+
+# Все прошедшие непроведённые тренировки окна — одной транзакцией
+@router.route('sched_bulk', *SCHED)
+async def cb_schedule_bulk(call: CallbackQuery, view: str, start: datetime):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    if not tid or view not in SCHEDULE_VIEWS or start is None:
+        await call.answer('Только для тренера.', show_alert=True)
+        return
+    end = min(start + SCHEDULE_VIEWS[view], datetime.utcnow())
+    sids = await db.transaction(complete_overdue, tid, start, end) if start < end else []
+    for sid in sids:
+        reminder_scheduler.cancel_session(sid)
+    await show_schedule(call, view, start)
+    await call.answer(f"Отмечено проведёнными: {len(sids)}")
+
+# Завершение сессии кнопкой; сообщение становится видом её дня
+@router.route('done_session', CB_INT)
+async def cb_done_session(call: CallbackQuery, sid: int):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    row = await db.fetchone('''SELECT s.datetime FROM sessions s
                    JOIN clients c ON s.client_id = c.id
                    WHERE s.id = ? AND c.trainer_id = ?''', (sid, tid))
-    if not cur.fetchone():
+    if not row:
         await call.answer('Сессия не относится к вам.', show_alert=True)
         return
-    cur.execute("UPDATE sessions SET status = 'completed' WHERE id = ?", (sid,))
-    conn.commit()
+    await db.execute("UPDATE sessions SET status = 'completed' WHERE id = ?", (sid,))
+    reminder_scheduler.cancel_session(sid)
+    await show_schedule(call, 'd', datetime.fromisoformat(row[0]))
     await call.answer('Готово ✅')
 
-# --- Заглушки для будущих разделов ---
+async def _own_series(call: CallbackQuery, ser: int) -> bool:
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    if not await db.fetchone('SELECT 1 FROM series WHERE id = ? AND trainer_id = ?', (ser, tid)):
+        await call.answer('Серия не относится к вам.', show_alert=True)
+        return False
+    return True
+
+# Повторение серии: проведено — строка sessions со статусом completed, отменено — series_skips
+@router.route('occ_done', CB_INT, CB_DT)
+async def cb_occurrence_done(call: CallbackQuery, ser: int, when: datetime):
+    if not await _own_series(call, ser):
+        return
+    def _done(c):
+        sid = materialize_occurrence(c, ser, when, 'completed')
+        c.execute("UPDATE sessions SET status = 'completed' WHERE id = ?", (sid,))
+        return sid
+    reminder_scheduler.cancel_session(await db.transaction(_done))
+    await show_schedule(call, 'd', when)
+    await call.answer('Готово ✅')
+
+@router.route('occ_skip', CB_INT, CB_DT)
+async def cb_occurrence_skip(call: CallbackQuery, ser: int, when: datetime):
+    if not await _own_series(call, ser):
+        return
+    def _skip(c):
+        c.execute('INSERT OR IGNORE INTO series_skips (series_id, occurrence) VALUES (?, ?)', (ser, when.isoformat()))
+        # уже появившуюся строку (до напоминания) убираем, если она не проведена
+        row = c.execute("SELECT id FROM sessions WHERE series_id = ? AND occurrence = ? AND status = 'planned'",
+                        (ser, when.isoformat())).fetchone()
+        if row:
+            c.execute('DELETE FROM sessions WHERE id = ?', row)
+        return row[0] if row else None
+    sid = await db.transaction(_skip)
+    if sid:
+        reminder_scheduler.cancel_session(sid)
+    await show_schedule(call, 'd', when)
+    await call.answer(f"Отменено: {when:%d.%m %H:%M}")
+
+# --- История клиента ---
+# Тренировки и платежи одной лентой, новые сверху. Каждый источник — курсор по
+# своему индексу (client_id, время) — в main и в архиве, ленту собирает
+# heapq.merge; читается не больше страницы из каждого, сколько бы записей ни было у клиента.
+# Позиция в ленте — (время, вид, id), вид 'p' < 's' разводит совпадения по времени.
+HISTORY_PAGE = 15
+HISTORY_SOURCES = {
+    'p': ('SELECT date, id, amount, note FROM {}.payments', 'date'),
+    's': ('SELECT datetime, id, status, comment FROM {}.sessions', 'datetime'),
+}
+HIST = (CB_INT, CB_STR, CB_STR, CB_INT, CB_STR)  # cid, направление, вид, id, время
+
+def _history_source(conn, cid: int, kind: str, older: bool, pos, limit: int, schema: str = 'main'):
+    select, col = HISTORY_SOURCES[kind]
+    select = select.format(schema)
+    where, params = 'client_id = ?', [cid]
+    if pos:
+        ts, pkind, pid = pos
+        op = '<' if older else '>'
+        if kind == pkind:
+            where += f" AND ({col}, id) {op} (?, ?)"
+            params += [ts, pid]
+        else:
+            # при равном времени запись этого вида лежит по нужную сторону позиции?
+            where += f" AND {col} {op}{'=' if (kind < pkind) == older else ''} ?"
+            params.append(ts)
+    order = 'DESC' if older else 'ASC'
+    cur = conn.execute(f"{select} WHERE {where} ORDER BY {col} {order}, id {order} LIMIT ?", params + [limit])
+    return ((ts, kind, rid, a, b) for ts, rid, a, b in cur)
+
+def history_entries(conn, cid: int, older: bool = True, pos=None) -> list:
+    """До HISTORY_PAGE + 1 записей после pos: older — к прошлому, иначе к настоящему."""
+    limit = HISTORY_PAGE + 1
+    sources = [_history_source(conn, cid, kind, older, pos, limit, schema)
+               for kind in HISTORY_SOURCES for schema in ('main', 'archive')]
+    return list(islice(heapq.merge(*sources, key=lambda e: e[:3], reverse=older), limit))
+
+def _history_line(entry) -> str:
+    ts, kind, _, a, b = entry
+    when = datetime.fromisoformat(ts)
+    note = f" — {b[:200]}" if b else ''
+    if kind == 'p':
+        return f"💸 {when.strftime('%d.%m.%Y')} платёж {a:+.2f}{note}"
+    return f"🏋️ {when.strftime('%d.%m.%Y %H:%M')} тренировка ({'проведена' if a == 'completed' else 'запланирована'}){note}"
+
+async def build_history(cid: int, name: str, direction: str = 'n', pos=None):
+    older = direction != 'p'
+    entries = await db.read(history_entries, cid, older, pos)
+    if not entries and pos:
+        return await build_history(cid, name)
+    header = f"📜 История: {name}"
+    lines, size = [], len(header)
+    for e in entries[:HISTORY_PAGE]:
+        line = _history_line(e)
+        if size + len(line) + 1 > MESSAGE_LIMIT:
+            break
+        lines.append((e, line))
+        size += len(line) + 1
+    more = len(entries) > len(lines)
+    if not older:
+        lines.reverse()
+    has_newer, has_older = (pos is not None, more) if older else (more, True)
+    kb = InlineKeyboardMarkup()
+    nav = []
+    if lines and has_newer:
+        ts, kind, rid = lines[0][0][:3]
+        nav.append(InlineKeyboardButton('⬅️ Новее', callback_data=cb('hist', cid, 'p', kind, rid, ts, fields=HIST)))
+    if lines and has_older:
+        ts, kind, rid = lines[-1][0][:3]
+        nav.append(InlineKeyboardButton('Раньше ➡️', callback_data=cb('hist', cid, 'n', kind, rid, ts, fields=HIST)))
+    if nav:
+        kb.row(*nav)
+    body = '\n'.join(line for _, line in lines) or 'Пока пусто.'
+    return f"{header}\n{body}", kb
+
+@router.route('hist', *HIST)
+@router.route('history', *HIST)  # «📜 История» в старых сообщениях — history:<cid>
+async def cb_history(call: CallbackQuery, cid: int, direction: str, kind: str, key: int, ts: str):
+    row = await db.fetchone('SELECT name, trainer_id, chat_id FROM clients WHERE id = ?', (cid,))
+    if not row or (row[2] != call.message.chat.id and row[1] != await get_trainer_id_by_chat(call.message.chat.id)):
+        await call.answer('Нет доступа к этой истории.', show_alert=True)
+        return
+    pos = (ts, kind, key) if ts and kind in HISTORY_SOURCES and key is not None else None
+    text, kb = await build_history(cid, row[0], direction or 'n', pos)
+    if pos:
+        await call.message.edit_text(text, reply_markup=kb)
+    else:
+        await call.message.answer(text, reply_markup=kb)
+    await call.answer()
+
+# --- Экспорт ---
+# Строки идут курсором SQLite прямо в csv.writer внутри zip (или в write-only
+# XLSX): память не зависит от объёма. Порядок совпадает с индексами —
+# клиенты тренера по (status, id), их тренировки/платежи по времени — без сортировки.
+# Тренировки и платежи читаются из main и архива двумя курсорами, heapq.merge
+# сводит их по (status клиента, client_id, время; NULL как ''); status — служебная последняя колонка.
+EXPORT_TABLES = {
+    'clients': (['id', 'name', 'phone', 'notes', 'balance', 'status', 'username', 'tg_id', 'chat_id'],
+                'SELECT id, name, phone, notes, balance, status, username, tg_id, chat_id '
+                'FROM clients WHERE trainer_id = ? ORDER BY status, id'),
+    'sessions': (['id', 'client_id', 'client', 'datetime', 'status', 'comment'],
+                 'SELECT s.id, s.client_id, c.name, s.datetime, s.status, s.comment, c.status '
+                 'FROM clients c JOIN {}.sessions s ON s.client_id = c.id WHERE c.trainer_id = ? ORDER BY c.status, c.id, s.datetime'),
+    'payments': (['id', 'client_id', 'client', 'date', 'amount', 'note'],
+                 'SELECT p.id, p.client_id, c.name, p.date, p.amount, p.note, c.status '
+                 'FROM clients c JOIN {}.payments p ON p.client_id = c.id WHERE c.trainer_id = ? ORDER BY c.status, c.id, p.date'),
+}
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит Bot API на отправку файла
+XLSX_MAX_ROWS = 1_048_575  # строк данных на лист
+_exports_running = set()
+
+def export_rows(conn, tid: int, table: str, counter: list):
+    """Генератор строк таблицы тренера; counter[0] — сколько отдано."""
+    header, sql = EXPORT_TABLES[table]
+    schemas = ('main', 'archive') if table in ARCHIVE_TABLES else ('main',)
+    cursors = [conn.execute(sql.format(schema), (tid,)) for schema in schemas]
+    width = len(header)
+    try:
+        for row in heapq.merge(*cursors, key=lambda r: (r[-1] or '', r[1], r[3] or '')):
+            counter[0] += 1
+            yield row[:width]
+    finally:
+        for cur in cursors:
+            cur.close()
+
+def export_csv_zip(conn, tid: int, path: str) -> int:
+    counter = [0]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for table, (header, _) in EXPORT_TABLES.items():
+            with zf.open(f"{table}.csv", 'w', force_zip64=True) as raw:
+                # utf-8-sig — чтобы Excel сразу понял кириллицу
+                with io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as f:
+                    w = csv.writer(f)
+                    w.writerow(header)
+                    w.writerows(export_rows(conn, tid, table, counter))
+    return counter[0]
+
+def export_xlsx(conn, tid: int, path: str) -> int:
+    counter = [0]
+    wb = openpyxl.Workbook(write_only=True)
+    for table, (header, _) in EXPORT_TABLES.items():
+        rows = export_rows(conn, tid, table, counter)
+        part, row = 1, next(rows, None)
+        while True:
+            ws = wb.create_sheet(table if part == 1 else f"{table}_{part}")
+            ws.append(header)
+            # следующий лист — только если после полного остались строки
+            for _ in range(XLSX_MAX_ROWS):
+                if row is None:
+                    break
+                ws.append(row)
+                row = next(rows, None)
+            if row is None:
+                break
+            part += 1
+    wb.save(path)
+    return counter[0]
+
+@dp.message_handler(commands=['export'])
+@dp.message_handler(lambda m: m.text == '📤 Экспорт')
+async def trainer_export(message: types.Message):
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    if not tid:
+        await message.answer('Только для тренера.', reply_markup=CLIENT_KB)
+        return
+    xlsx = message.is_command() and message.get_args().strip().lower() == 'xlsx'
+    if xlsx and openpyxl is None:
+        await message.answer('XLSX недоступен (нет openpyxl) — выгружаю CSV.')
+        xlsx = False
+    if tid in _exports_running:
+        await message.answer('Экспорт уже готовится, подождите.')
+        return
+    _exports_running.add(tid)
+    fd, path = tempfile.mkstemp(suffix='.xlsx' if xlsx else '.zip', prefix='crm-export-')
+    os.close(fd)
+    try:
+        await message.answer('Готовлю выгрузку…')
+        t0 = time.monotonic()
+        rows = await db.read_bulk(export_xlsx if xlsx else export_csv_zip, tid, path)
+        size = os.path.getsize(path)
+        logger.info('Export trainer=%s rows=%s bytes=%s in %.1fs', tid, rows, size, time.monotonic() - t0)
+        if size > EXPORT_MAX_BYTES:
+            await message.answer('Выгрузка больше 50 МБ — Telegram не даст её отправить.', reply_markup=TRAINER_KB)
+            return
+        name = f"crm-{datetime.utcnow():%Y%m%d}.{'xlsx' if xlsx else 'zip'}"
+        await message.answer_document(types.InputFile(path, filename=name),
+                                      caption=f"Клиенты, тренировки и платежи: {rows} строк", reply_markup=TRAINER_KB)
+    finally:
+        _exports_running.discard(tid)
+        os.unlink(path)
+
+# --- Импорт клиентов ---
+# CSV: имя, телефон, заметка (заголовок необязателен, разделитель , ; или таб).
+# Разбор по пачкам; каждая пачка — одна транзакция писателя, и разбирается она
+# там же: декодирование, Sniffer и regex телефонов не занимают event loop.
+# Дубли по телефону ищутся через idx_clients_trainer_phone, вставка — executemany.
+IMPORT_CHUNK = 1000
+IMPORT_PROGRESS_EVERY = 3  # секунд между правками сообщения о ходе импорта
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # больше Bot API не отдаёт через getFile
+IMPORT_COLUMNS = {
+    'name': ('name', 'имя', 'фио', 'клиент'),
+    'phone': ('phone', 'телефон', 'тел', 'номер'),
+    'notes': ('notes', 'note', 'заметка', 'заметки', 'примечание', 'комментарий'),
+}
+
+def read_import_csv(data: bytes):
+    """-> генератор (номер строки, name, phone, notes) или (номер строки, None, ошибка, None)."""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('cp1251')  # Excel под русской Windows
+    try:
+        delimiter = csv.Sniffer().sniff(text[:4096], delimiters=',;\t').delimiter
+    except csv.Error:
+        delimiter = ','
+    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+    first = next(reader, None)
+    if first is None:
+        return
+    names = [c.strip().lower() for c in first]
+    cols = {key: next((i for i, c in enumerate(names) if c in aliases), None) for key, aliases in IMPORT_COLUMNS.items()}
+    if cols['name'] is None:
+        cols = {'name': 0, 'phone': 1, 'notes': 2}
+        rows = ((1, first), *((n, r) for n, r in enumerate(reader, 2)))
+    else:
+        rows = enumerate(reader, 2)
+    def cell(row, key):
+        i = cols[key]
+        return row[i].strip() if i is not None and i < len(row) else ''
+    for lineno, row in rows:
+        if not any(c.strip() for c in row):
+            continue
+        name = cell(row, 'name')
+        if not name:
+            yield lineno, None, 'нет имени', None
+            continue
+        try:
+            phone = normalize_phone(cell(row, 'phone'))
+        except ValueError:
+            yield lineno, None, f"телефон не распознан: {cell(row, 'phone')[:30]}", None
+            continue
+        yield lineno, name[:100], phone, cell(row, 'notes')[:1000]
+
+def import_clients_chunk(conn, tid: int, rows, seen: set, report: dict) -> int:
+    """Разбирает следующие IMPORT_CHUNK строк rows (генератор read_import_csv) и
+    вставляет новых клиентов; счётчики и ошибки — в report. -> сколько строк прочитано.
+    seen — ключи, уже встреченные в файле (телефон или имя без телефона)."""
+    chunk, n = [], 0
+    for lineno, name, phone, notes in islice(rows, IMPORT_CHUNK):
+        n += 1
+        if name is None:
+            report['errors'].append((lineno, phone))
+        else:
+            chunk.append((name, phone, notes))
+    phones = [p for _, p, _ in chunk if p]
+    existing = set()
+    for i in range(0, len(phones), 500):  # лимит параметров SQLite
+        part = phones[i:i + 500]
+        existing.update(r[0] for r in conn.execute(
+            f"SELECT phone FROM clients WHERE trainer_id = ? AND phone <> '' AND phone IN ({','.join('?' * len(part))})",
+            [tid] + part))
+    new = []
+    for name, phone, notes in chunk:
+        key = phone or 'name:' + name.casefold()
+        if key in seen or phone in existing:
+            report['duplicates'] += 1
+            continue
+        seen.add(key)
+        new.append((name, phone, notes, tid))
+    conn.executemany("INSERT INTO clients (name, phone, notes, trainer_id, status) VALUES (?, ?, ?, ?, 'approved')", new)
+    report['inserted'] += len(new)
+    return n
+
+async def import_clients(tid: int, data: bytes, progress=None) -> dict:
+    """Импорт пачками через поток-писатель; progress(report, строк прочитано) —
+    корутина, вызывается не чаще раза в IMPORT_PROGRESS_EVERY секунд."""
+    report = {'inserted': 0, 'duplicates': 0, 'errors': []}
+    # клиенты без телефона дедуплицируются по имени
+    seen = {'name:' + r[0].casefold() for r in await db.fetchall(
+        "SELECT name FROM clients WHERE trainer_id = ? AND coalesce(phone, '') = '' AND name IS NOT NULL", (tid,))}
+    rows = read_import_csv(data)  # генератор: разбор начнётся в потоке-писателе
+    total, next_progress = 0, time.monotonic() + IMPORT_PROGRESS_EVERY
+    while True:
+        n = await db.transaction(import_clients_chunk, tid, rows, seen, report)
+        total += n
+        if n < IMPORT_CHUNK:
+            return report
+        if progress and time.monotonic() >= next_progress:
+            next_progress = time.monotonic() + IMPORT_PROGRESS_EVERY
+            await progress(report, total)
+
+@router.route('import_clients')
+async def cb_import_clients(call: CallbackQuery):
+    await ImportClients.file.set()
+    await call.message.answer('Пришлите CSV-файл с клиентами: колонки «имя», «телефон», «заметка» '
+                              '(заголовок можно не указывать, разделитель — запятая или точка с запятой).\n'
+                              'Любое текстовое сообщение — отмена.')
+    await call.answer()
+
+@dp.message_handler(state=ImportClients.file, content_types=types.ContentType.DOCUMENT)
+async def st_import_clients_file(message: types.Message, state: FSMContext):
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    await state.finish()
+    if not tid:
+        await message.answer('Только для тренера.')
+        return
+    if (message.document.file_size or 0) > IMPORT_MAX_BYTES:
+        await message.answer('Файл больше 20 МБ — разбейте его на части.', reply_markup=TRAINER_KB)
+        return
+    buf = io.BytesIO()
+    await message.document.download(destination_file=buf)
+    t0 = time.monotonic()
+    status = await message.answer('📥 Импорт…')
+
+    async def progress(report, total):
+        try:
+            await status.edit_text(f"📥 Импорт… строк: {total}, добавлено: {report['inserted']}")
+        except Exception:
+            pass  # ход импорта — не повод его прерывать
+
+    report = await import_clients(tid, buf.getvalue(), progress)
+    errors = report['errors']
+    logger.info('Import trainer=%s inserted=%s duplicates=%s errors=%s in %.1fs', tid, report['inserted'],
+                report['duplicates'], len(errors), time.monotonic() - t0)
+    lines = [f"Добавлено: {report['inserted']}", f"Дубли (пропущены): {report['duplicates']}", f"Ошибки: {len(errors)}"]
+    lines += [f"строка {n}: {reason}" for n, reason in errors[:30]]
+    if len(errors) > 30:
+        lines.append(f"…и ещё {len(errors) - 30}")
+    for text in split_message(lines, '📥 Импорт клиентов'):
+        await message.answer(text, reply_markup=TRAINER_KB)
+
+@dp.message_handler(state=ImportClients.file)
+async def st_import_clients_cancel(message: types.Message, state: FSMContext):
+    await state.finish()
+    await message.answer('Импорт отменён.', reply_markup=TRAINER_KB)
+
+# --- Статистика ---
+STATS_WEEKS = 6
+STATS_MONTHS = 6
+
+def _months_back(now: datetime, n: int) -> list:
+    y, m = now.year, now.month
+    out = []
+    for _ in range(n):
+        out.append(f"{y:04d}-{m:02d}")
+        y, m = (y, m - 1) if m > 1 else (y - 1, 12)
+    return out[::-1]
+
+def trainer_stats_text(conn, tid: int, now: datetime) -> str:
+    """Читает только агрегаты: диапазоны по первичным ключам trainer_stats / stats_client_month."""
+    monday = (now - timedelta(days=now.weekday())).date()
+    weeks = [(monday - timedelta(weeks=i)).isoformat() for i in range(STATS_WEEKS - 1, -1, -1)]
+    months = _months_back(now, STATS_MONTHS + 1)  # +1: удержание первого месяца считается от предыдущего
+    agg = {}
+    for lo, hi in (('W' + weeks[0], 'W' + weeks[-1]), ('M' + months[0], 'M' + months[-1])):
+        for period, planned, completed, revenue in conn.execute(
+                'SELECT period, planned, completed, revenue FROM trainer_stats '
+                'WHERE trainer_id = ? AND period BETWEEN ? AND ?', (tid, lo, hi)):
+            agg[period] = (planned, completed, revenue)
+    # активные клиенты месяца и сколько из них вернулись в следующем
+    active, retained = {}, {}
+    for month, total, stayed in conn.execute('''
+            SELECT a.month, count(*), count(b.client_id) FROM stats_client_month a
+            LEFT JOIN stats_client_month b ON b.trainer_id = a.trainer_id
+                AND b.month = strftime('%Y-%m', a.month || '-01', '+1 month') AND b.client_id = a.client_id
+            WHERE a.trainer_id = ? AND a.month BETWEEN ? AND ? GROUP BY a.month''', (tid, months[0], months[-1])):
+        active[month], retained[month] = total, stayed
+    clients = conn.execute("SELECT count(*) FROM clients WHERE trainer_id = ? AND status = 'approved'", (tid,)).fetchone()[0]
+
+    lines = ['📈 Статистика', f"Клиентов: {clients}, активных в этом месяце: {active.get(months[-1], 0)}", '',
+             'По неделям (запланировано / проведено):']
+    for w in weeks:
+        planned, completed, _ = agg.get('W' + w, (0, 0, 0))
+        lines.append(f"{datetime.fromisoformat(w).strftime('%d.%m')} — {planned} / {completed}")
+    lines += ['', 'По месяцам (план / проведено / выручка / активные / удержание):']
+    for prev, m in zip(months, months[1:]):
+        planned, completed, revenue = agg.get('M' + m, (0, 0, 0))
+        rate = f"{100 * retained[prev] / active[prev]:.0f}%" if active.get(prev) else '—'
+        lines.append(f"{m[5:]}.{m[:4]} — {planned} / {completed} / {revenue:.2f} / {active.get(m, 0)} / {rate}")
+    churn = [1 - retained[p] / active[p] for p in months[:-2] if active.get(p)]
+    if churn:
+        lines.append(f"\nОтток (среднее за {len(churn)} мес.): {100 * sum(churn) / len(churn):.0f}%")
+    return '\n'.join(lines)
+
 @dp.message_handler(lambda m: m.text == '📈 Статистика')
-async def stats_stub(message: types.Message):
-    await message.answer('Статистика появится в следующей версии 🙂', reply_markup=TRAINER_KB)
+async def trainer_stats(message: types.Message):
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    if not tid:
+        await message.answer('Только для тренера.', reply_markup=CLIENT_KB)
+        return
+    await message.answer(await db.read(trainer_stats_text, tid, datetime.utcnow()), reply_markup=TRAINER_KB)
+
+# --- Должники ---
+# Keyset по (balance, id) внутри частичного индекса idx_clients_debtors.
+# Итоги (число должников и общий долг) считаются один раз на первой странице
+# и едут дальше в callback_data — листание читает только страницу.
+DEBTORS_SQL = 'SELECT id, name, balance FROM clients WHERE trainer_id = ? AND balance < 0'
+DEBT_PAGE = (CB_STR, CB_FLOAT, CB_INT, CB_INT, CB_FLOAT)  # направление, balance, id, должников, долг
+
+async def fetch_debtors_page(tid: int, direction: str = 'n', balance: float = None, key: int = None):
+    """-> (rows, has_prev, has_next), самые большие долги первыми."""
+    if balance is None or key is None:
+        rows = await db.fetchall(f"{DEBTORS_SQL} ORDER BY balance, id LIMIT ?", (tid, PER_PAGE + 1))
+        return rows[:PER_PAGE], False, len(rows) > PER_PAGE
+    if direction == 'p':
+        rows = await db.fetchall(f"{DEBTORS_SQL} AND (balance, id) < (?, ?) ORDER BY balance DESC, id DESC LIMIT ?",
+                                 (tid, balance, key, PER_PAGE + 1))
+        if not rows:
+            return await fetch_debtors_page(tid)
+        return rows[:PER_PAGE][::-1], len(rows) > PER_PAGE, True
+    rows = await db.fetchall(f"{DEBTORS_SQL} AND (balance, id) > (?, ?) ORDER BY balance, id LIMIT ?",
+                             (tid, balance, key, PER_PAGE + 1))
+    return rows[:PER_PAGE], True, len(rows) > PER_PAGE
+
+async def build_debtors(tid: int, direction: str = 'n', balance: float = None, key: int = None,
+                        total: int = None, debt: float = None):
+    if total is None or debt is None:
+        total, debt = await db.fetchone('SELECT count(*), round(coalesce(sum(balance), 0), 2) FROM clients '
+                                        'WHERE trainer_id = ? AND balance < 0', (tid,))
+    if not total:
+        return 'Должников нет 🎉', None
+    rows, has_prev, has_next = await fetch_debtors_page(tid, direction, balance, key)
+    kb = InlineKeyboardMarkup(row_width=1)
+    for cid, name, bal in rows:
+        kb.add(InlineKeyboardButton(f"{name} — {bal:.2f}", callback_data=cb('client', cid)))
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton('⬅️ Назад', callback_data=cb('debt_page', 'p', rows[0][2], rows[0][0], total, debt, fields=DEBT_PAGE)))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton('Вперёд ➡️', callback_data=cb('debt_page', 'n', rows[-1][2], rows[-1][0], total, debt, fields=DEBT_PAGE)))
+    if nav:
+        kb.row(*nav)
+    return f"💸 Должники: {total}, общий долг {-debt:.2f}", kb
+
 @dp.message_handler(lambda m: m.text == '💸 Должники')
-async def debtors_stub(message: types.Message):
-    await message.answer('Список должников появится в следующей версии 🙂', reply_markup=TRAINER_KB)
+async def trainer_debtors(message: types.Message):
+    tid = await get_trainer_id_by_chat(message.chat.id)
+    if not tid:
+        await message.answer('Только для тренера.', reply_markup=CLIENT_KB)
+        return
+    text, kb = await build_debtors(tid)
+    await message.answer(text, reply_markup=kb or TRAINER_KB)
 
-# --- Background reminders ---
-async def reminders_loop():
-    logger.info('Reminders loop started')
+@router.route('debt_page', *DEBT_PAGE)
+async def cb_debtors_page(call: CallbackQuery, direction: str, balance: float, key: int, total: int, debt: float):
+    tid = await get_trainer_id_by_chat(call.message.chat.id)
+    text, kb = await build_debtors(tid, direction, balance, key, total, debt)
+    await call.message.edit_text(text, reply_markup=kb)
+    await call.answer()
+
+# Сверка журнала: баланс заново выводится из ledger одним GROUP BY
+def check_ledger(conn, fix: bool = False) -> dict:
+    drift = conn.execute('''SELECT c.id, c.trainer_id, coalesce(c.balance, 0), coalesce(l.total, 0)
+        FROM clients c LEFT JOIN (SELECT client_id, round(sum(amount), 2) AS total FROM ledger GROUP BY client_id) l
+            ON l.client_id = c.id
+        WHERE abs(coalesce(c.balance, 0) - coalesce(l.total, 0)) >= 0.005''').fetchall()
+    # проводки архивных строк остаются в журнале — ищем их в обеих частях
+    unposted = conn.execute(f'''SELECT p.id FROM {archive_union(conn, 'payments', 'id, amount')} p
+        LEFT JOIN ledger l ON l.kind = 'payment' AND l.ref_id = p.id
+        WHERE p.amount IS NOT NULL AND (l.id IS NULL OR abs(l.amount - p.amount) >= 0.005)''').fetchall()
+    payment, session = 'SELECT 1 FROM {}.payments WHERE id = l.ref_id', \
+        "SELECT 1 FROM {}.sessions WHERE id = l.ref_id AND status = 'completed'"
+    schemas = ('main', 'archive') if has_archive(conn, 'sessions') else ('main',)
+    orphans = conn.execute(f'''SELECT l.id FROM ledger l WHERE
+        (l.kind = 'payment' AND {' AND '.join(f'NOT EXISTS ({payment.format(s)})' for s in schemas)}) OR
+        (l.kind = 'session' AND {' AND '.join(f'NOT EXISTS ({session.format(s)})' for s in schemas)})''').fetchall()
+    if fix and drift:
+        conn.executemany('UPDATE clients SET balance = ? WHERE id = ?', [(derived, cid) for cid, _, _, derived in drift])
+        conn.commit()
+    return {'drift': drift, 'unposted_payments': [r[0] for r in unposted], 'orphan_entries': [r[0] for r in orphans]}
+
+def check_ledger_cli(argv) -> int:
+    fix = '--fix' in argv
+    report = check_ledger(db.writer_conn, fix=fix)
+    for cid, tid, stored, derived in report['drift']:
+        print(f"client {cid} (trainer {tid}): balance {stored:.2f}, ledger {derived:.2f}, drift {stored - derived:+.2f}")
+    print(f"clients with drift: {len(report['drift'])}{' (fixed)' if fix and report['drift'] else ''}; "
+          f"payments without ledger entry: {len(report['unposted_payments'])}; "
+          f"orphan ledger entries: {len(report['orphan_entries'])}")
+    return 1 if any(report.values()) and not fix else 0
+
+# --- Обслуживание хранилища ---
+async def archive_cold(now: datetime = None) -> dict:
+    """Проход архивации пачками по ARCHIVE_BATCH через поток-писатель, между
+    пачками обработчики пишут как обычно. -> {таблица: перенесено строк}."""
+    cutoff = archive_cutoff(now or datetime.utcnow()).isoformat()
+    moved = {}
+    for table in ARCHIVE_TABLES:
+        max_id = (await db.fetchone(f'SELECT max(id) FROM {table}'))[0] or 0
+        after, moved[table] = 0, 0
+        while True:
+            ids, copied = await db.transaction(archive_copy, table, cutoff, after, max_id)
+            if not ids:
+                break
+            moved[table] += await db.transaction(archive_drop, table, ids, copied)
+            after = ids[-1]
+        metrics.inc('archive_rows_total', moved[table], table=table)
+    return moved
+
+metrics.describe('archive_rows_total', 'counter', 'Строк перенесено в архив')
+
+async def storage_maintenance():
+    """PASSIVE-чекпойнт раз в DB_CHECKPOINT_INTERVAL, бэкап раз в BACKUP_INTERVAL
+    часов (отсчёт от самого свежего бэкапа, так что рестарт его не повторяет),
+    архивация — при старте и раз в ARCHIVE_INTERVAL часов."""
+    name = Path(db.path).stem
+    backups = list_backups(BACKUP_DIR, name)
+    next_backup = (backups[-1].stat().st_mtime if backups else 0) + BACKUP_INTERVAL * 3600
+    next_archive = time.time()
     while True:
+        if ARCHIVE_AFTER_DAYS and time.time() >= next_archive:
+            next_archive = time.time() + ARCHIVE_INTERVAL * 3600
+            try:
+                moved = await archive_cold()
+                metrics.inc('db_maintenance_total', op='archive', result='ok')
+                if any(moved.values()):
+                    logger.info('Archived: %s', moved)
+                    if BACKUP_INTERVAL:
+                        # архив меняется только здесь — его копия снимается после переезда
+                        await db.maintenance(backup_to, BACKUP_DIR, f"{name}-archive", BACKUP_KEEP, 'archive')
+            except Exception:
+                metrics.inc('db_maintenance_total', op='archive', result='failed')
+                logger.exception('Archival failed')
+        if DB_CHECKPOINT_INTERVAL:
+            try:
+                busy, _, _ = await db.maintenance(checkpoint)
+                metrics.inc('db_maintenance_total', op='checkpoint', result='busy' if busy else 'ok')
+            except Exception:
+                metrics.inc('db_maintenance_total', op='checkpoint', result='failed')
+                logger.exception('WAL checkpoint failed')
+        if BACKUP_INTERVAL and time.time() >= next_backup:
+            try:
+                path = await db.maintenance(backup_to, BACKUP_DIR, name)
+                metrics.inc('db_maintenance_total', op='backup', result='ok')
+                logger.info('DB backup written: %s', path)
+                next_backup = time.time() + BACKUP_INTERVAL * 3600
+            except Exception:
+                metrics.inc('db_maintenance_total', op='backup', result='failed')
+                logger.exception('DB backup failed')
+                next_backup = time.time() + 600
+        await asyncio.sleep(DB_CHECKPOINT_INTERVAL or 60)
+
+def _wal_bytes() -> int:
+    try:
+        return os.path.getsize(db.path + '-wal')
+    except OSError:
+        return 0
+
+metrics.gauge('db_wal_bytes', 'Размер WAL-файла базы', _wal_bytes)
+
+def backup_cli(argv) -> int:
+    path = backup_to(db.writer_conn, argv[0] if argv else BACKUP_DIR, Path(db.path).stem)
+    print(f"backup written: {path}")
+    return 0
+
+def archive_cli(argv) -> int:
+    """archive [--vacuum]: проход архивации сейчас; --vacuum затем сжимает main
+    (освобождённые страницы иначе просто переиспользуются). VACUUM блокирует запись —
+    при остановленном боте."""
+    moved = asyncio.run(archive_cold())
+    print('archived:', ', '.join(f"{table} {n}" for table, n in moved.items()))
+    if '--vacuum' in argv:
+        db.writer_conn.execute('VACUUM')
+    print(f"{db.path}: {os.path.getsize(db.path) / 1e6:.1f} MB, "
+          f"{archive_path(db.path)}: {os.path.getsize(archive_path(db.path)) / 1e6:.1f} MB")
+    return 0
+
+def restore_cli(argv) -> int:
+    """restore <файл|latest>. Бот должен быть остановлен. Текущая база сперва
+    копируется в BACKUP_DIR (<имя>-pre-restore-*, без ротации), затем страницы
+    бэкапа переносятся в неё через Connection.backup (WAL и -shm остаются
+    согласованными, в отличие от копирования файла) и догоняются миграции.
+    Архив не откатывается: строки, уехавшие в него после бэкапа, убираются из main."""
+    name = Path(db.path).stem
+    if not argv:
+        print('usage: restore <file|latest>; backups in', BACKUP_DIR)
+        for path in list_backups(BACKUP_DIR, name):
+            print(' ', path)
+        return 2
+    backups = list_backups(BACKUP_DIR, name)
+    src_path = (backups[-1] if backups else None) if argv[0] == 'latest' else Path(argv[0])
+    if src_path is None or not src_path.is_file():
+        print('backup not found:', argv[0])
+        return 1
+    src = sqlite3.connect(src_path.absolute().as_uri() + '?mode=ro', uri=True)
+    try:
+        check = src.execute('PRAGMA integrity_check').fetchone()[0]
+        if check != 'ok':
+            print(f"{src_path}: integrity_check {check}")
+            return 1
+        saved = backup_to(db.writer_conn, BACKUP_DIR, f"{name}-pre-restore", keep=0)
+        src.backup(db.writer_conn)
+    finally:
+        src.close()
+    migrate(db.writer_conn)
+    for table in ARCHIVE_TABLES:
+        archive_drop(db.writer_conn, table)
+    archive_edges_reset(db.writer_conn)
+    db.writer_conn.commit()
+    print(f"restored {src_path}; previous database saved to {saved}")
+    return 0
+
+# --- Background reminders ---
+# (флаг в sessions, за сколько до начала, префикс для тренера, текст клиенту)
+REMINDERS = {
+    'remind24_sent': (timedelta(hours=24), 'За 24 часа — ', 'Привет! Напоминаем о тренировке {dt}.'),
+    'remind2_sent': (timedelta(hours=2), 'За 2 часа — ', 'Привет! Напоминаем о тренировке через 2 часа: {dt}.'),
+}
+REMINDER_HORIZON = timedelta(hours=int(os.getenv('REMINDER_HORIZON_HOURS', '12')))
+REMINDER_LEAD = max(offset for offset, _, _ in REMINDERS.values())
+REMINDER_RETRY = timedelta(seconds=int(os.getenv('REMINDER_RETRY_SECONDS', '60')))
+
+class ReminderScheduler:
+    """Мин-куча (due, session_id, flag) ближайших напоминаний.
+
+    В куче только напоминания со сроком до loaded_until; дальше окно
+    подгружается из БД по мере приближения. Цикл спит ровно до ближайшего
+    срока или до wakeup() при изменении сессии. Удаление ленивое: у каждой
+    сессии есть версия, устаревшие записи кучи пропускаются.
+    Просроченные за время простоя напоминания (сессия ещё впереди)
+    отправляются сразу после старта.
+
+    Флаг remind*_sent ставится только после доставки: пока сообщения в
+    очереди, (сессия, флаг) в inflight и повторно не рассылается; не
+    доставленное (RetryAfter, сеть, остановка) через REMINDER_RETRY уходит
+    снова — только тем чатам, что его ещё не получили (delivered)."""
+
+    def __init__(self, horizon: timedelta = REMINDER_HORIZON):
+        self.horizon = horizon
+        self.loaded_until = None
+        self.inflight = set()
+        self.delivered = {}  # (sid, flag) -> чаты, которым уже ушло
+        self._confirming = set()
+        self._heap = []
+        self._versions = {}
+        self._wakeup = asyncio.Event()
+
+    def _push(self, sid: int, dt: datetime, flag: str, due: datetime = None):
+        due = due or dt - REMINDERS[flag][0]
+        heapq.heappush(self._heap, (due, sid, flag, self._versions.get(sid, 0)))
+
+    def retry(self, sid: int, dt: datetime, flag: str):
+        """Недоставленное напоминание — в кучу снова, пока тренировка впереди."""
+        if dt > datetime.utcnow():
+            self._push(sid, dt, flag, datetime.utcnow() + REMINDER_RETRY)
+            self._wakeup.set()
+
+    def confirm(self, messages: list):
+        """Фоном ждёт доставки сообщений [(future, chat, [(sid, flag, время)])]."""
+        task = asyncio.create_task(confirm_reminders(messages))
+        self._confirming.add(task)
+        task.add_done_callback(self._confirming.discard)
+
+    async def flush(self):
+        """Остановка: дождаться отметок по уже завершённым отправкам."""
+        if self._confirming:
+            await asyncio.gather(*self._confirming, return_exceptions=True)
+
+    async def _load(self, until: datetime):
+        """Догружает напоминания со сроком (loaded_until, until]; в первый раз — все просроченные."""
+        now = datetime.utcnow()
+        # окно сдвигаем до чтения: сессии, добавленные во время загрузки, попадут
+        # в кучу через schedule_session (дубль безвреден — флаг перепроверяется)
+        prev, self.loaded_until = self.loaded_until, until
+        # повторения серий, до которых дошли напоминания, становятся строками sessions
+        await db.transaction(materialize_window, now, until + REMINDER_LEAD)
+        for flag, (offset, _, _) in REMINDERS.items():
+            lo = now if prev is None else max(now, prev + offset)
+            rows = await db.fetchall(
+                f"SELECT id, datetime FROM sessions WHERE status = 'planned' AND {flag} = 0 "
+                f"AND datetime > ? AND datetime <= ?",
+                (lo.isoformat(), (until + offset).isoformat()))
+            for sid, dt_iso in rows:
+                self._push(sid, datetime.fromisoformat(dt_iso), flag)
+
+    def schedule_session(self, sid: int, dt: datetime):
+        self._versions[sid] = self._versions.get(sid, 0) + 1
+        if self.loaded_until is None or dt <= datetime.utcnow():
+            return
+        for flag, (offset, _, _) in REMINDERS.items():
+            if dt - offset <= self.loaded_until:
+                self._push(sid, dt, flag)
+        self._wakeup.set()
+
+    def cancel_session(self, sid: int):
+        self._versions[sid] = self._versions.get(sid, 0) + 1
+
+    async def add_series(self, series_id: int):
+        """Новая серия: повторения внутри уже загруженного окна — сразу в sessions и в кучу."""
+        if self.loaded_until is None:
+            return
+        rows = await db.transaction(materialize_window, datetime.utcnow(), self.loaded_until + REMINDER_LEAD, series_id)
+        for sid, dt in rows:
+            self.schedule_session(sid, dt)
+
+    def _pop_due(self, now: datetime) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, sid, flag, version = heapq.heappop(self._heap)
+            if version == self._versions.get(sid, 0):
+                due.append((sid, flag))
+        # версии нужны, только пока сессия может быть в куче
+        if not self._heap:
+            self._versions.clear()
+        return due
+
+    async def run(self):
+        logger.info('Reminder scheduler started')
+        while True:
+            try:
+                now = datetime.utcnow()
+                if self.loaded_until is None or self.loaded_until - now < self.horizon / 2:
+                    await self._load(now + self.horizon)
+                if self._heap and self._heap[0][0] <= now:
+                    metrics.observe('reminder_lag_seconds', (now - self._heap[0][0]).total_seconds())
+                due = self._pop_due(now)
+                if due:
+                    await dispatch_reminders(due)
+                    continue
+                wake_at = self.loaded_until - self.horizon / 2
+                if self._heap:
+                    wake_at = min(wake_at, self._heap[0][0])
+                timeout = max(0.0, (wake_at - datetime.utcnow()).total_seconds())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Error in reminder scheduler')
+                await asyncio.sleep(5)
+
+reminder_scheduler = ReminderScheduler()
+metrics.gauge('reminder_heap_size', 'Напоминаний в куче планировщика', lambda: len(reminder_scheduler._heap))
+
+# --- Outbound message queue ---
+MESSAGE_LIMIT = 4096
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до следующего токена (0 — можно сразу)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class SendQueue:
+    """Очередь исходящих сообщений с лимитами Telegram: не больше global_rate
+    сообщений в секунду всего и chat_rate в один чат. Несколько воркеров;
+    на RetryAfter вся очередь ждёт указанное время и сообщение уходит повторно.
+    send() возвращает future с исходом: SENT, FAILED (чат недоступен — повтор
+    не поможет) или RETRY (попытки кончились, сеть, выброшено при остановке)."""
+
+    MAX_ATTEMPTS = 5
+    SENT, FAILED, RETRY = 'sent', 'failed', 'retry'
+
+    def __init__(self, workers: int = 8, global_rate: float = 30, chat_rate: float = 1):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.counters = {'sent': 0, 'failed': 0, 'retry_after': 0}
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._paused_until = 0.0
+        self._queue = asyncio.Queue()
+        self._busy = 0
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
         try:
-            now = datetime.utcnow()
-            t24_from, t24_to = now + timedelta(hours=24), now + timedelta(hours=24, minutes=1)
-            t2_from, t2_to = now + timedelta(hours=2), now + timedelta(hours=2, minutes=1)
-
-            cur.execute('''SELECT s.id, s.client_id, s.datetime, s.comment, c.chat_id, c.name, c.trainer_id
-                           FROM sessions s
-                           JOIN clients c ON s.client_id=c.id
-                           WHERE s.remind24_sent = 0 AND s.status = 'planned' AND s.datetime BETWEEN ? AND ?''',
-                        (t24_from.isoformat(), t24_to.isoformat()))
-            for sid, cid, dt_iso, comment, client_chat, client_name, trainer_id in cur.fetchall():
-                dt = datetime.fromisoformat(dt_iso)
-                txt = f"Напоминание: тренировка {dt.strftime('%d.%m.%Y %H:%M')} — {client_name} (id={cid})."
-                if comment:
-                    txt += "\n" + comment
-                cur.execute('SELECT chat_id FROM trainers WHERE id = ?', (trainer_id,))
-                row = cur.fetchone()
-                if row:
-                    tchat = row[0]
-                    try:
-                        await bot.send_message(tchat, "За 24 часа — " + txt)
-                    except Exception:
-                        logger.exception('Failed send 24h to trainer')
-                if client_chat:
-                    try:
-                        await bot.send_message(client_chat, f"Привет! Напоминаем о тренировке {dt.strftime('%d.%m.%Y %H:%M')}.")
-                    except Exception:
-                        logger.exception('Failed send 24h to client')
-                cur.execute('UPDATE sessions SET remind24_sent = 1 WHERE id = ?', (sid,))
-                conn.commit()
-
-            cur.execute('''SELECT s.id, s.client_id, s.datetime, s.comment, c.chat_id, c.name, c.trainer_id
-                           FROM sessions s
-                           JOIN clients c ON s.client_id=c.id
-                           WHERE s.remind2_sent = 0 AND s.status = 'planned' AND s.datetime BETWEEN ? AND ?''',
-                        (t2_from.isoformat(), t2_to.isoformat()))
-            for sid, cid, dt_iso, comment, client_chat, client_name, trainer_id in cur.fetchall():
-                dt = datetime.fromisoformat(dt_iso)
-                txt = f"Напоминание: тренировка {dt.strftime('%d.%m.%Y %H:%М')} — {client_name} (id={cid})."
-                if comment:
-                    txt += "\n" + comment
-                cur.execute('SELECT chat_id FROM trainers WHERE id = ?', (trainer_id,))
-                row = cur.fetchone()
-                if row:
-                    tchat = row[0]
-                    try:
-                        await bot.send_message(tchat, "За 2 часа — " + txt)
-                    except Exception:
-                        logger.exception('Failed send 2h to trainer')
-                if client_chat:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            # и ждущие в очереди, и взятые воркерами: их future получат RETRY
+            logger.warning('Send queue: %s messages dropped on shutdown', self._queue.qsize() + self._busy)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        while not self._queue.empty():
+            _, _, _, fut = self._queue.get_nowait()
+            self._resolve(fut, self.RETRY)
+
+    def send(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((chat_id, text, kwargs, fut))
+        return fut
+
+    @staticmethod
+    def _resolve(fut: asyncio.Future, outcome: str):
+        if not fut.done():
+            fut.set_result(outcome)
+
+    async def _acquire(self, chat_id: int):
+        while True:
+            now = time.monotonic()
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                if len(self._chats) > 10000:
+                    self._chats = {c: b for c, b in self._chats.items() if now - b.updated < 60}
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, 1)
+            wait = max(self._paused_until - now, bucket.delay(now), self._global.delay(now))
+            if wait <= 0:
+                bucket.tokens -= 1
+                self._global.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, fut = await self._queue.get()
+            outcome = self.RETRY
+            self._busy += 1
+            try:
+                for attempt in range(self.MAX_ATTEMPTS):
+                    await self._acquire(chat_id)
                     try:
-                        await bot.send_message(client_chat, f"Привет! Напоминаем о тренировке через 2 часа: {dt.strftime('%d.%m.%Y %H:%M')}.")
-                    except Exception:
-                        logger.exception('Failed send 2h to client')
-                cur.execute('UPDATE sessions SET remind2_sent = 1 WHERE id = ?', (sid,))
-                conn.commit()
-        except Exception:
-            logger.exception('Error in reminders loop')
-        await asyncio.sleep(60)
+                        await bot.send_message(chat_id, text, **kwargs)
+                        self.counters['sent'] += 1
+                        outcome = self.SENT
+                        break
+                    except RetryAfter as e:
+                        self.counters['retry_after'] += 1
+                        self._paused_until = max(self._paused_until, time.monotonic() + e.timeout)
+                        logger.warning('RetryAfter %ss (chat %s)', e.timeout, chat_id)
+                else:
+                    self.counters['failed'] += 1
+            except (Unauthorized, BadRequest):
+                # бот заблокирован, чат не найден и т. п.
+                self.counters['failed'] += 1
+                outcome = self.FAILED
+                logger.warning('Message to %s not deliverable', chat_id, exc_info=True)
+            except Exception:
+                self.counters['failed'] += 1
+                logger.exception('Failed to send message to %s', chat_id)
+            finally:
+                self._busy -= 1
+                self._resolve(fut, outcome)
+                self._queue.task_done()
+
+send_queue = SendQueue(workers=int(os.getenv('SEND_WORKERS', '8')))
+metrics.gauge('send_queue_messages', 'Очередь исходящих: отправлено, ошибки, RetryAfter, ждут',
+              lambda: {**{(('stat', k),): v for k, v in send_queue.counters.items()},
+                       (('stat', 'queued'),): send_queue._queue.qsize()})
+
+def split_message_keyed(entries, header: str = '') -> list:
+    """[(строка, ключ)] -> [(сообщение не длиннее MESSAGE_LIMIT, ключи его строк)]."""
+    out, buf, keys = [], header, []
+    for line, key in entries:
+        if buf and len(buf) + len(line) + 1 > MESSAGE_LIMIT:
+            out.append((buf, keys))
+            buf, keys = '', []
+        buf = f"{buf}\n{line}" if buf else line
+        keys.append(key)
+    if buf:
+        out.append((buf, keys))
+    return out
+
+def split_message(lines, header: str = '') -> list:
+    """Склеивает строки в сообщения не длиннее MESSAGE_LIMIT."""
+    return [text for text, _ in split_message_keyed(((line, None) for line in lines), header)]
+
+async def dispatch_reminders(due: list):
+    """Пачка наступивших напоминаний: один JOIN на всю пачку, дайджест на
+    тренера вместо сообщения на каждую тренировку. Флаги пропущенных после
+    простоя ставятся сразу, отправленных — в confirm_reminders после доставки."""
+    now = datetime.utcnow()
+    flags_by_sid = {}
+    for sid, flag in due:
+        if (sid, flag) not in reminder_scheduler.inflight:
+            flags_by_sid.setdefault(sid, set()).add(flag)
+    rows = []
+    sids = list(flags_by_sid)
+    for i in range(0, len(sids), 500):
+        chunk = sids[i:i + 500]
+        rows += await db.fetchall(
+            f'''SELECT s.id, s.client_id, s.datetime, s.comment, s.remind24_sent, s.remind2_sent,
+                       c.chat_id, c.name, t.chat_id
+                FROM sessions s
+                JOIN clients c ON s.client_id = c.id
+                LEFT JOIN trainers t ON t.id = c.trainer_id
+                WHERE s.status = 'planned' AND s.id IN ({','.join('?' * len(chunk))})''', chunk)
+    skipped = []
+    trainer_lines = {}  # chat -> [(строка, (sid, flag, время))]
+    client_msgs = []
+    for sid, cid, dt_iso, comment, r24, r2, client_chat, client_name, trainer_chat in rows:
+        sent = {'remind24_sent': r24, 'remind2_sent': r2}
+        dt = datetime.fromisoformat(dt_iso)
+        for flag in sorted(flags_by_sid[sid], key=lambda f: -REMINDERS[f][0]):
+            if sent[flag]:
+                continue
+            offset, trainer_prefix, client_text = REMINDERS[flag]
+            # после простоя: если уже пора и более позднее напоминание — отправим только его
+            if any(dt - o <= now for o, _, _ in REMINDERS.values() if o < offset):
+                skipped.append((flag, sid))
+                continue
+            key = (sid, flag, dt)
+            delivered = reminder_scheduler.delivered.get((sid, flag), set())
+            txt = f"Напоминание: тренировка {dt.strftime('%d.%m.%Y %H:%M')} — {client_name} (id={cid})."
+            if comment:
+                txt += "\n" + comment
+            if trainer_chat and trainer_chat not in delivered:
+                trainer_lines.setdefault(trainer_chat, []).append((trainer_prefix + txt, key))
+            if client_chat and client_chat not in delivered:
+                client_msgs.append((client_chat, client_text.format(dt=dt.strftime('%d.%m.%Y %H:%M')), key))
+            if not (trainer_chat and trainer_chat not in delivered) and not (client_chat and client_chat not in delivered):
+                skipped.append((flag, sid))  # слать некому или уже всем доставлено
+
+    if skipped:
+        await db.transaction(mark_reminders, skipped)
+
+    messages = []
+    for tchat, entries in trainer_lines.items():
+        keys = [key for _, key in entries]
+        if len(entries) == 1:
+            messages.append((send_queue.send(tchat, entries[0][0]), tchat, keys))
+        else:
+            # ключ напоминания идёт с тем куском дайджеста, где его строка
+            messages += [(send_queue.send(tchat, text), tchat, part_keys) for text, part_keys
+                         in split_message_keyed(entries, f'Напоминания о тренировках ({len(entries)}):')]
+    for chat, text, key in client_msgs:
+        messages.append((send_queue.send(chat, text), chat, [key]))
+    for _, _, keys in messages:
+        reminder_scheduler.inflight.update((sid, flag) for sid, flag, _ in keys)
+    if messages:
+        reminder_scheduler.confirm(messages)
+
+def mark_reminders(conn, marks: list):
+    """marks — [(флаг, sid)]: напоминание доставлено или слать его больше не нужно."""
+    for flag in REMINDERS:
+        params = [(sid,) for f, sid in marks if f == flag]
+        if params:
+            conn.executemany(f'UPDATE sessions SET {flag} = 1 WHERE id = ?', params)
+
+async def confirm_reminders(messages: list):
+    """Ставит флаг, когда все сообщения напоминания доставлены (или чат недоступен);
+    остальное — в планировщик на повтор."""
+    outcomes = await asyncio.gather(*(fut for fut, _, _ in messages))
+    pending, when = {}, {}
+    for (_, chat, keys), outcome in zip(messages, outcomes):
+        for sid, flag, dt in keys:
+            when[sid, flag] = dt
+            if outcome == SendQueue.RETRY:
+                pending[sid, flag] = True
+            else:
+                pending.setdefault((sid, flag), False)
+                reminder_scheduler.delivered.setdefault((sid, flag), set()).add(chat)
+    done = [(flag, sid) for (sid, flag), retry in pending.items() if not retry]
+    try:
+        if done:
+            await db.transaction(mark_reminders, done)
+    except Exception:
+        logger.exception('Failed to mark reminders')
+        done = []
+    for (sid, flag), retry in pending.items():
+        reminder_scheduler.inflight.discard((sid, flag))
+        if (flag, sid) in done:
+            reminder_scheduler.delivered.pop((sid, flag), None)
+        else:
+            metrics.inc('reminder_retries_total')
+            reminder_scheduler.retry(sid, when[sid, flag], flag)
+
+metrics.describe('reminder_retries_total', 'counter', 'Напоминаний, отправленных повторно после сбоя доставки')
+
+# --- Webhook ---
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+WEBHOOK_MAX_INFLIGHT = int(os.getenv('WEBHOOK_MAX_INFLIGHT', '32'))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '25'))
+
+class WebhookGate:
+    """Не больше limit апдейтов в обработке одновременно (остальные ждут слот,
+    Telegram при этом держит соединение), дренаж при остановке."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.inflight = 0
+        self.ready = False
+        self.draining = False
+        self._sem = asyncio.Semaphore(limit)
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def run(self, coro):
+        self.inflight += 1
+        self._idle.clear()
+        try:
+            async with self._sem:
+                return await coro
+        finally:
+            self.inflight -= 1
+            if not self.inflight:
+                self._idle.set()
+
+    async def drain(self, timeout: float):
+        """Новые апдейты получают 503 (Telegram повторит их после рестарта),
+        принятые дорабатывают до конца или до timeout."""
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Webhook drain: %s updates still in flight after %ss', self.inflight, timeout)
+
+webhook_gate = WebhookGate(WEBHOOK_MAX_INFLIGHT)
+
+class GatedWebhookHandler(WebhookRequestHandler):
+    async def post(self):
+        if WEBHOOK_SECRET and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            raise web.HTTPUnauthorized()
+        if webhook_gate.draining:
+            raise web.HTTPServiceUnavailable()
+        return await webhook_gate.run(super().post())
+
+async def healthz(request):
+    return web.json_response({'status': 'ok'})
+
+async def readyz(request):
+    body = {'ready': webhook_gate.ready and not webhook_gate.draining,
+            'inflight': webhook_gate.inflight, 'limit': webhook_gate.limit}
+    if body['ready']:
+        try:
+            await db.fetchone('SELECT 1')
+        except Exception as e:
+            body.update(ready=False, error=str(e))
+    return web.json_response(body, status=200 if body['ready'] else 503)
+
+async def on_startup_webhook(dp):
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, max_connections=min(WEBHOOK_MAX_INFLIGHT, 100),
+                              secret_token=WEBHOOK_SECRET or None)
+    webhook_gate.ready = True
+    logger.info('Webhook listening on %s:%s%s', WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+
+async def on_shutdown_webhook(dp):
+    # aiohttp вызывает on_shutdown до ожидания активных запросов — сначала дренаж, потом закрываем БД
+    await webhook_gate.drain(WEBHOOK_DRAIN_TIMEOUT)
+    await on_shutdown(dp)
+
+def start_webhook():
+    app = web.Application()
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/readyz', readyz)
+    app.router.add_get('/metrics', metrics_handler)
+    runner = executor.Executor(dp, skip_updates=False)
+    runner.on_startup([on_startup, on_startup_webhook])
+    runner.on_shutdown(on_shutdown_webhook)
+    runner.set_webhook(webhook_path=WEBHOOK_PATH, request_handler=GatedWebhookHandler, web_app=app)
+    # вебхук при остановке не снимаем: апдейты копятся у Telegram и придут после рестарта
+    runner.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT, shutdown_timeout=WEBHOOK_DRAIN_TIMEOUT + 5, loop=runner.loop)
 
 # --- Startup ---
+_metrics_runner = None
+_storage_task = None
+
+async def start_metrics_server():
+    """Отдельный /metrics для long polling (в режиме webhook он на том же приложении)."""
+    global _metrics_runner
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    _metrics_runner = web.AppRunner(app, access_log=None)
+    await _metrics_runner.setup()
+    await web.TCPSite(_metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info('Metrics on http://%s:%s/metrics', METRICS_HOST, METRICS_PORT)
+
 async def on_startup(dp):
-    asyncio.create_task(reminders_loop())
-    logger.info('on_startup finished — reminders loop scheduled.')
+    global _storage_task
+    if BOT_MODE != 'webhook' and METRICS_PORT:
+        await start_metrics_server()
+    _storage_task = asyncio.create_task(storage_maintenance())
+    send_queue.start()
+    asyncio.create_task(reminder_scheduler.run())
+    logger.info('on_startup finished — reminder scheduler started.')
+
+async def on_shutdown(dp):
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+    if _storage_task is not None:
+        _storage_task.cancel()
+    await send_queue.stop()
+    await reminder_scheduler.flush()
+    await geocoder.close()
+    await dp.storage.close()
+    db.close()
 
 if __name__ == '__main__':
-    logger.info('Bot is starting...')
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    cli = {'check-ledger': check_ledger_cli, 'backup': backup_cli, 'restore': restore_cli, 'archive': archive_cli}.get(sys.argv[1] if len(sys.argv) > 1 else None)
+    if cli:
+        code = cli(sys.argv[2:])
+        db.close()
+        sys.exit(code)
+    logger.info('Bot is starting (%s)...', BOT_MODE)
+    if BOT_MODE == 'webhook':
+        start_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file